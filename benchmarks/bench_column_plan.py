@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the CsvExporter row rendering.
+
+Renders synthetic skeletons of a 100-column structure once per cell via
+renderBoneValue (like renderRow did before the column plan) and once via the
+precompiled column plan, and prints the rows/sec of both.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from viur_csv_exporter import CsvExporter  # noqa: E402
+
+
+def buildStructure(columns: int) -> dict:
+	structure = {}
+
+	for i in range(columns):
+		kind = i % 5
+
+		if kind == 0:
+			structure[f"str{i}"] = {"type": "str", "descr": f"String {i}", "multiple": False}
+		elif kind == 1:
+			structure[f"lang{i}"] = {"type": "str", "descr": f"Translated {i}", "multiple": False,
+									 "languages": ["de", "en"]}
+		elif kind == 2:
+			structure[f"select{i}"] = {"type": "select", "descr": f"Select {i}", "multiple": True,
+									   "values": [[f"v{x}", f"Value {x}"] for x in range(20)]}
+		elif kind == 3:
+			structure[f"numeric{i}"] = {"type": "numeric", "descr": f"Numeric {i}", "multiple": False,
+										"precision": 2}
+		else:
+			structure[f"relational{i}"] = {"type": "relational.tree.node", "descr": f"Relational {i}",
+										   "multiple": False, "format": "$(dest.name) ($(dest.city))",
+										   "relskel": None}
+
+	return structure
+
+
+def buildSkel(structure: dict, nr: int) -> dict:
+	skel = {}
+
+	for boneName, boneStructure in structure.items():
+		if boneStructure.get("languages"):
+			skel[boneName] = {"de": f"Wert {nr}", "en": f"Value {nr}"}
+		elif boneStructure["type"] == "select":
+			skel[boneName] = [f"v{nr % 20}", f"v{(nr + 7) % 20}"]
+		elif boneStructure["type"] == "numeric":
+			skel[boneName] = nr * 1.2345
+		elif boneStructure["type"].startswith("relational"):
+			skel[boneName] = {"dest": {"key": f"key{nr % 50}", "name": f"Name {nr % 50}", "city": "Dortmund"},
+							  "rel": None}
+		else:
+			skel[boneName] = f"String {nr}"
+
+	return skel
+
+
+def renderRowPerCell(exporter: CsvExporter, skel: dict, structure: dict) -> list:
+	"""The row rendering without a column plan."""
+	data = []
+
+	for boneName, boneStructure in structure.items():
+		if boneStructure.get("languages"):
+			for lang in boneStructure["languages"]:
+				data.append(exporter.renderBoneValue(boneName, skel[boneName], structure, lang))
+		else:
+			data.append(exporter.renderBoneValue(boneName, skel[boneName], structure))
+
+	return data
+
+
+def measure(render, skels: list, repeat: int) -> float:
+	best = None
+
+	for _ in range(repeat):
+		start = time.perf_counter()
+		for skel in skels:
+			render(skel)
+		duration = time.perf_counter() - start
+		best = duration if best is None else min(best, duration)
+
+	return len(skels) / best
+
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser(description="Benchmark per-cell rendering against the column plan")
+	ap.add_argument("-c", "--columns", type=int, default=100, help="Number of bones in the structure")
+	ap.add_argument("-n", "--rows", type=int, default=5000, help="Number of rendered rows")
+	ap.add_argument("-r", "--repeat", type=int, default=5, help="Take the best of this many runs")
+	args = ap.parse_args()
+
+	structure = buildStructure(args.columns)
+	skels = [buildSkel(structure, nr) for nr in range(args.rows)]
+
+	exporter = CsvExporter(None)
+	plan = exporter.buildColumnPlan(structure)
+
+	assert all(renderRowPerCell(exporter, skel, structure) == exporter.renderRow(skel, plan) for skel in skels[:100])
+
+	before = measure(lambda skel: renderRowPerCell(exporter, skel, structure), skels, args.repeat)
+	after = measure(lambda skel: exporter.renderRow(skel, plan), skels, args.repeat)
+
+	print(f"{args.columns} bones, {len(plan)} columns, {args.rows} rows")
+	print(f"per-cell:    {before:10.0f} rows/sec")
+	print(f"column plan: {after:10.0f} rows/sec ({after / before:.2f}x)")
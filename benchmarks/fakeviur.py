@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a ViUR application, for offline benchmarks of the tools in this repository.
+
+It serves the endpoints used by viur_csv_exporter.py, csvimport.py, download-files.py and
+copyblobs.py from a generated, deterministic dataset, with a configurable latency per request:
+
+- /vi/skey, /vi/config and /vi/user/* login, logout and view/self (skeys are single-use, unknown ones
+  get a 412)
+- /vi/{module}/structure, /vi/{module}/view/{key}, paginated /vi/{module}/list with filters
+  (bone, bone$gt, bone$lt), orderby/orderdir, amount and cursor
+- /vi/{module}/add and /vi/{module}/edit
+- /vi/file/listRootNodes, /vi/file/list/{leaf,node}/{key} and /vi/file/download/{dlkey} (with Range)
+- /dbtransfer/exportBlob2, /dbtransfer/hasblob, /dbtransfer/getUploadURL, the upload URL and
+  /file/download/{blobkey} in the pickled format of copyblobs.py
+
+Run it standalone or use FakeViur from another script.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import pickle
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STRUCTURE = [
+	["key", {"type": "key", "descr": "Key", "visible": False, "multiple": False, "languages": None}],
+	["name", {"type": "str", "descr": "Name", "visible": True, "multiple": False, "languages": None}],
+	["title", {"type": "str", "descr": "Title", "visible": True, "multiple": False, "languages": ["de", "en"]}],
+	["tags", {"type": "str", "descr": "Tags", "visible": True, "multiple": True, "languages": None}],
+	["status", {"type": "select", "descr": "Status", "visible": True, "multiple": False, "languages": None,
+				"values": [["active", "Active"], ["inactive", "Inactive"], ["archived", "Archived"]]}],
+	["colors", {"type": "select", "descr": "Colors", "visible": True, "multiple": True, "languages": None,
+				"values": [[f"c{i}", f"Color {i}"] for i in range(12)]}],
+	["price", {"type": "numeric", "descr": "Price", "visible": True, "multiple": False, "languages": None,
+			   "precision": 2}],
+	["category", {"type": "relational.tree.node.category", "descr": "Category", "visible": True,
+				  "multiple": False, "languages": None, "format": "$(dest.name)", "relskel": []}],
+	["image", {"type": "treeitem.file", "descr": "Image", "visible": True, "multiple": False, "languages": None,
+			   "format": "$(dest.name)", "relskel": []}],
+	["creationdate", {"type": "date", "descr": "Created", "visible": True, "multiple": False, "languages": None}],
+	["changedate", {"type": "date", "descr": "Changed", "visible": True, "multiple": False, "languages": None}],
+]
+
+SKEY_REJECTED_STATUS = 412
+
+# Prefix of the routes answering for any module of FakeViur.modules
+MODULE_ROUTE = r"/(?:vi|json)/(\w+)/"
+
+
+class Dataset(object):
+	"""The generated content of the fake application."""
+
+	def __init__(self, entities: int = 1000, categories: int = 50, folders: int = 10, depth: int = 2,
+				 filesPerFolder: int = 20, fileSize: int = 4096, blobs: int = 100, blobSize: int = 65536,
+				 seed: int = 1):
+		rnd = random.Random(seed)
+		start = datetime(2020, 1, 1)
+
+		self.fileSize = fileSize
+		self.blobSize = blobSize
+		self.lock = threading.Lock()
+
+		self.entities = []
+		for nr in range(entities):
+			created = start + timedelta(minutes=nr * 7)
+			category = nr % categories
+			self.entities.append({
+				"key": "ent%08d" % nr,
+				"name": "Entry %d" % nr,
+				"title": {"de": "Eintrag %d" % nr, "en": "Entry %d" % nr},
+				"tags": ["tag%d" % rnd.randrange(30) for _ in range(rnd.randrange(4))],
+				"status": rnd.choice(["active", "inactive", "archived"]),
+				"colors": ["c%d" % rnd.randrange(12) for _ in range(rnd.randrange(3))],
+				"price": round(rnd.uniform(0, 1000), 4),
+				"category": {"dest": {"key": "cat%04d" % category, "name": "Category %d" % category}, "rel": None},
+				"image": {"dest": {"key": "img%05d" % nr, "name": "image%d.jpg" % nr, "dlkey": "dl-img-%d" % nr,
+								   "servingurl": "https://example.com/img%d" % nr}, "rel": None},
+				"creationdate": created.isoformat(),
+				"changedate": (created + timedelta(days=rnd.randrange(100))).isoformat(),
+			})
+
+		self.nextKey = itertools.count(entities)
+
+		# File tree: node key -> (folders, files)
+		self.rootKey = "node-root"
+		self.nodes = {}
+		self.dlkeys = {}
+		self._buildTree(self.rootKey, folders, depth, filesPerFolder, fileSize)
+
+		self.blobs = [{"key": "blob%06d" % nr, "content_type": "image/png" if nr % 7 else "application/pdf"}
+					  for nr in range(blobs)]
+		self.storedBlobs = {}
+
+	def _buildTree(self, key: str, folders: int, depth: int, filesPerFolder: int, fileSize: int) -> None:
+		files = []
+		for nr in range(filesPerFolder):
+			dlkey = "dl-%s-%d" % (key, nr)
+			# Every 5th file has the content of another folder's file, like uploads into several folders
+			content = "dl-node-root-%d" % nr if nr % 5 == 0 else dlkey
+			self.dlkeys[dlkey] = content
+			files.append({"key": "file-%s-%d" % (key, nr), "name": "file%d.bin" % nr, "dlkey": dlkey,
+						  "size": str(fileSize), "mimetype": "application/octet-stream",
+						  "changedate": "2020-01-01T00:00:00", "parententry": key})
+
+		subfolders = []
+		if depth > 0:
+			for nr in range(folders):
+				child = "%s-%d" % (key, nr)
+				subfolders.append({"key": child, "name": "folder%d" % nr, "parententry": key})
+				self._buildTree(child, folders if depth > 1 else 0, depth - 1, filesPerFolder, fileSize)
+
+		self.nodes[key] = (subfolders, files)
+
+	def fileContent(self, dlkey: str) -> bytes:
+		seed = hashlib.sha1(self.dlkeys[dlkey].encode()).digest()
+		return (seed * (self.fileSize // len(seed) + 1))[:self.fileSize]
+
+	def blobContent(self, blobKey: str) -> bytes:
+		seed = hashlib.sha1(blobKey.encode()).digest()
+		return (seed * (self.blobSize // len(seed) + 1))[:self.blobSize]
+
+	def query(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+		entities = self.entities
+
+		for name, value in params.items():
+			if name in ("orderby", "orderdir", "amount", "cursor", "skey", "search"):
+				continue
+
+			if name.endswith("$gt"):
+				entities = [e for e in entities if self._sortKey(e.get(name[:-3])) > self._sortKey(value)]
+			elif name.endswith("$lt"):
+				entities = [e for e in entities if self._sortKey(e.get(name[:-3])) < self._sortKey(value)]
+			elif name.endswith("$lk"):
+				entities = [e for e in entities if str(e.get(name[:-3])).startswith(value)]
+			elif "$" not in name:
+				entities = [e for e in entities if str(e.get(name)) == value]
+
+		if params.get("orderby"):
+			entities = sorted(entities, key=lambda e: (self._sortKey(e.get(params["orderby"])), e["key"]),
+							  reverse=str(params.get("orderdir")) == "1")
+
+		return entities
+
+	@staticmethod
+	def _sortKey(value: Any) -> Tuple[int, Any]:
+		if value is None:
+			return (0, 0)
+
+		if isinstance(value, (int, float)):
+			return (1, value)
+
+		try:
+			return (1, float(value))
+		except (TypeError, ValueError):
+			return (2, str(value))
+
+
+class FakeViurHandler(BaseHTTPRequestHandler):
+	server: "FakeViur"
+	protocol_version = "HTTP/1.1"
+	# Headers and body are written separately, don't let them wait for a delayed ACK
+	disable_nagle_algorithm = True
+
+	def log_message(self, format, *args):
+		logger.debug(format, *args)
+
+	def do_GET(self):
+		self.handle_request(b"")
+
+	def do_POST(self):
+		self.handle_request(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+
+	def handle_request(self, body: bytes):
+		server = self.server
+		if server.latency:
+			time.sleep(server.latency)
+
+		url = urllib.parse.urlparse(self.path)
+		path = re.sub("/+", "/", url.path)
+		params = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+		params.update(self.parseBody(body))
+
+		with server.statsLock:
+			server.requests += 1
+			server.bytesReceived += len(body)
+
+		for pattern, handler in server.routes:
+			match = re.fullmatch(pattern, path)
+			if match and not (pattern.startswith(MODULE_ROUTE) and match.group(1) not in server.modules):
+				try:
+					return handler(self, params, *match.groups())
+				except Exception as e:
+					logger.exception(e)
+					return self.send(500, b"Internal Server Error", "text/plain")
+
+		self.send(404, b"Not Found", "text/plain")
+
+	def parseBody(self, body: bytes) -> Dict[str, str]:
+		contentType = self.headers.get("Content-Type", "")
+
+		if contentType.startswith("application/x-www-form-urlencoded"):
+			return dict(urllib.parse.parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+
+		if contentType.startswith("multipart/"):
+			boundary = re.search(r'boundary="?([^";]+)', contentType)
+			if not boundary:
+				return {}
+
+			boundary = boundary.group(1).encode()
+			fields = {}
+
+			for part in body.split(b"--" + boundary):
+				head, sep, content = part.partition(b"\n\n")
+				if not sep:
+					head, sep, content = part.partition(b"\r\n\r\n")
+
+				name = re.search(rb'name="([^"]*)"', head)
+				if name and b"filename=" not in head:
+					fields[name.group(1).decode()] = content.rstrip(b"\r\n").decode("utf-8", "replace")
+
+			return fields
+
+		return {}
+
+	def send(self, status: int, body: bytes, contentType: str = "application/json", headers: Dict = None):
+		self.send_response(status)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+
+		self.end_headers()
+		self.wfile.write(body)
+
+		with self.server.statsLock:
+			self.server.bytesSent += len(body)
+
+	def sendJson(self, data: Any, status: int = 200):
+		self.send(status, json.dumps(data).encode("utf-8"))
+
+	def sendPickle(self, data: Any):
+		self.send(200, pickle.dumps(data, protocol=2).hex().encode("ascii"), "text/plain")
+
+	def checkSkey(self, params: Dict[str, str]) -> bool:
+		with self.server.statsLock:
+			try:
+				self.server.skeys.remove(params.get("skey"))
+			except KeyError:
+				self.send(SKEY_REJECTED_STATUS, b"Precondition Failed", "text/plain")
+				return False
+
+		return True
+
+	# ViUR endpoints
+
+	def skey(self, params):
+		skey = secrets.token_hex(16)
+
+		with self.server.statsLock:
+			self.server.skeys.add(skey)
+
+		self.sendJson(skey)
+
+	def login(self, params):
+		if self.checkSkey(params):
+			self.sendJson("OKAY")
+
+	def logout(self, params):
+		if self.checkSkey(params):
+			self.sendJson("OKAY")
+
+	def viewSelf(self, params):
+		self.sendJson({"action": "view", "values": {"key": "user-1", "name": "bench"}})
+
+	def config(self, params):
+		self.sendJson({"modules": {name: {"handler": handler, "name": name.capitalize()}
+								   for name, handler in self.server.modules.items()}})
+
+	def structure(self, params, module):
+		self.sendJson({"action": "view", "structure": STRUCTURE})
+
+	def view(self, params, module, key):
+		for entity in self.server.dataset.entities:
+			if entity["key"] == key:
+				return self.sendJson({"action": "view", "values": entity, "structure": STRUCTURE})
+
+		self.send(404, b"Not Found", "text/plain")
+
+	def list(self, params, module):
+		amount = min(int(params.get("amount") or self.server.pageSize), self.server.maxPageSize)
+		start = int(params.get("cursor") or 0)
+		entities = self.server.dataset.query(params)[start:start + amount]
+
+		self.sendJson({"action": "list", "skellist": entities, "cursor": str(start + len(entities)),
+					   "structure": STRUCTURE})
+
+	def sendErrors(self, action, params, errors):
+		structure = [[name, dict(bone, error=errors.get(name))] for name, bone in STRUCTURE]
+		self.sendJson({"action": action, "values": params, "structure": structure})
+
+	@staticmethod
+	def validate(params):
+		errors = {}
+
+		try:
+			float(params.get("price") or 0)
+		except ValueError:
+			errors["price"] = "Invalid value entered"
+
+		return errors
+
+	def add(self, params, module):
+		if not self.checkSkey(params):
+			return
+
+		errors = self.validate(params)
+		if errors:
+			return self.sendErrors("add", params, errors)
+
+		dataset = self.server.dataset
+		entity = {k: v for k, v in params.items() if k != "skey"}
+		entity["key"] = "ent%08d" % next(dataset.nextKey)
+
+		with dataset.lock:
+			dataset.entities.append(entity)
+
+		self.sendJson({"action": "addSuccess", "values": entity, "structure": STRUCTURE})
+
+	def edit(self, params, module):
+		if not self.checkSkey(params):
+			return
+
+		errors = self.validate(params)
+		if errors:
+			return self.sendErrors("edit", params, errors)
+
+		for entity in self.server.dataset.entities:
+			if entity["key"] == params.get("key"):
+				entity.update({k: v for k, v in params.items() if k != "skey"})
+				return self.sendJson({"action": "editSuccess", "values": entity, "structure": STRUCTURE})
+
+		self.sendErrors("edit", params, {"key": "Unknown key"})
+
+	def listRootNodes(self, params):
+		self.sendJson([{"key": self.server.dataset.rootKey, "name": "Files"}])
+
+	def listTree(self, params, kind, key):
+		folders, files = self.server.dataset.nodes.get(key, ([], []))
+		entries = files if kind == "leaf" else folders
+
+		amount = min(int(params.get("amount") or self.server.pageSize), self.server.maxPageSize)
+		start = int(params.get("cursor") or 0)
+		page = entries[start:start + amount]
+
+		self.sendJson({"action": "list", "skellist": page,
+					   "cursor": str(start + len(page)) if start + len(page) < len(entries) else None})
+
+	def download(self, params, dlkey):
+		dataset = self.server.dataset
+		if dlkey not in dataset.dlkeys:
+			return self.send(404, b"Not Found", "text/plain")
+
+		self.sendRange(dataset.fileContent(dlkey))
+
+	def sendRange(self, content: bytes):
+		match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+		if not match:
+			return self.send(200, content, "application/octet-stream", {"Accept-Ranges": "bytes"})
+
+		first = int(match.group(1))
+		last = int(match.group(2)) if match.group(2) else len(content) - 1
+		if first >= len(content):
+			return self.send(416, b"", "application/octet-stream", {"Content-Range": "bytes */%d" % len(content)})
+
+		self.send(206, content[first:last + 1], "application/octet-stream",
+				  {"Content-Range": "bytes %d-%d/%d" % (first, last, len(content))})
+
+	# dbtransfer endpoints of copyblobs.py
+
+	def exportBlob2(self, params):
+		start = int(params.get("cursor") or 0)
+		page = self.server.dataset.blobs[start:start + self.server.pageSize]
+		self.sendPickle({"values": page, "cursor": str(start + len(page))})
+
+	def hasBlob(self, params, blobKey, key):
+		self.send(200, b"true" if blobKey in self.server.dataset.storedBlobs else b"false", "text/plain")
+
+	def getUploadUrl(self, params):
+		self.send(200, ("http://%s:%d/upload" % self.server.server_address[:2]).encode(), "text/plain")
+
+	def upload(self, params):
+		dlkey = "dl-%s" % params.get("oldkey")
+		self.server.dataset.storedBlobs[params.get("oldkey")] = dlkey
+		self.sendJson({"action": "addSuccess", "values": [{"dlkey": dlkey}]})
+
+	def blobDownload(self, params, blobKey):
+		self.sendRange(self.server.dataset.blobContent(blobKey))
+
+
+class FakeViur(ThreadingHTTPServer):
+	"""HTTP server answering like a ViUR application with a generated dataset."""
+	daemon_threads = True
+	# Concurrent clients open many connections at once
+	request_queue_size = 128
+
+	routes = [
+		(r"/(?:vi|json)/skey", FakeViurHandler.skey),
+		(r"/(?:vi|json)/user/auth_(?:userpassword|loginkey)/login", FakeViurHandler.login),
+		(r"/(?:vi|json)/user/logout", FakeViurHandler.logout),
+		(r"/(?:vi|json)/user/view/self", FakeViurHandler.viewSelf),
+		(r"/(?:vi|json)/config", FakeViurHandler.config),
+		(r"/(?:vi|json)/file/listRootNodes", FakeViurHandler.listRootNodes),
+		(r"/(?:vi|json)/file/list/(leaf|node)/([^/]+)", FakeViurHandler.listTree),
+		(r"/(?:vi|json)/file/download/([^/]+)", FakeViurHandler.download),
+		(MODULE_ROUTE + r"(?:view/)?structure", FakeViurHandler.structure),
+		(MODULE_ROUTE + r"view/([^/]+)", FakeViurHandler.view),
+		(MODULE_ROUTE + r"list", FakeViurHandler.list),
+		(MODULE_ROUTE + r"add", FakeViurHandler.add),
+		(MODULE_ROUTE + r"edit", FakeViurHandler.edit),
+		(r"/dbtransfer/exportBlob2", FakeViurHandler.exportBlob2),
+		(r"/dbtransfer/hasblob/([^/]+)/([^/]+)", FakeViurHandler.hasBlob),
+		(r"/dbtransfer/getUploadURL", FakeViurHandler.getUploadUrl),
+		(r"/upload", FakeViurHandler.upload),
+		(r"/file/download/([^/]+)", FakeViurHandler.blobDownload),
+	]
+
+	def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0), dataset: Optional[Dataset] = None,
+				 latency: float = 0.0, pageSize: int = 30, maxPageSize: int = 99):
+		super().__init__(address, FakeViurHandler)
+		self.dataset = dataset or Dataset()
+		self.latency = latency
+		self.pageSize = pageSize
+		self.maxPageSize = maxPageSize
+
+		# All list modules serve the same entities
+		self.modules = {"bench": "list", "person": "list", "order": "list", "file": "tree", "page": "hierarchy"}
+
+		self.skeys = set()
+		self.statsLock = threading.Lock()
+		self.requests = 0
+		self.bytesReceived = 0
+		self.bytesSent = 0
+
+	def handle_error(self, request, client_address):
+		# Clients exiting with open keep-alive connections are no errors worth a traceback
+		if not isinstance(sys.exc_info()[1], ConnectionError):
+			super().handle_error(request, client_address)
+
+	@property
+	def url(self) -> str:
+		return "http://%s:%d" % self.server_address[:2]
+
+	def start(self) -> "FakeViur":
+		"""Serve in a background thread."""
+		threading.Thread(target=self.serve_forever, name="FakeViur", daemon=True).start()
+		return self
+
+	def stop(self) -> None:
+		self.shutdown()
+		self.server_close()
+
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser(description="Local stand-in for a ViUR application")
+	ap.add_argument("-b", "--bind", default="127.0.0.1", help="Address to listen on")
+	ap.add_argument("-P", "--port", type=int, default=8080, help="Port to listen on")
+	ap.add_argument("-l", "--latency", type=float, default=0.0, help="Seconds to delay every request")
+	ap.add_argument("-n", "--entities", type=int, default=1000, help="Number of entities in every module")
+	ap.add_argument("--page-size", type=int, default=30, help="Default amount of list requests")
+	ap.add_argument("--folders", type=int, default=10, help="Folders per folder in the file tree")
+	ap.add_argument("--depth", type=int, default=2, help="Depth of the file tree")
+	ap.add_argument("--files", type=int, default=20, help="Files per folder in the file tree")
+	ap.add_argument("--file-size", type=int, default=4096, help="Size of every file in bytes")
+	ap.add_argument("--blobs", type=int, default=100, help="Number of blobs served to copyblobs")
+	ap.add_argument("--blob-size", type=int, default=65536, help="Size of every blob in bytes")
+	ap.add_argument("-V", "--verbose", action="store_true", help="Log every request")
+	args = ap.parse_args()
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+	dataset = Dataset(entities=args.entities, folders=args.folders, depth=args.depth, filesPerFolder=args.files,
+					  fileSize=args.file_size, blobs=args.blobs, blobSize=args.blob_size)
+	server = FakeViur((args.bind, args.port), dataset, latency=args.latency, pageSize=args.page_size)
+
+	logger.info("Fake ViUR application listening on %s", server.url)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the ViUR client scripts.
+
+Runs viur_csv_exporter.py, csvimport.py, download-files.py and copyblobs.py as subprocesses
+against the local stand-in server of fakeviur.py and writes the throughput of every run into a
+JSON report. Given the report of an earlier run via --compare, it fails when a benchmark got
+slower than the tolerance allows.
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeviur import Dataset, FakeViur  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+MODULE = "bench"
+
+BENCHMARKS = []
+
+
+class Skipped(Exception):
+	pass
+
+
+def benchmark(name: str) -> Callable:
+	def decorator(func: Callable) -> Callable:
+		BENCHMARKS.append((name, func))
+		return func
+
+	return decorator
+
+
+def runScript(args: List[str], cwd: str, python: str = sys.executable) -> None:
+	# Keep caches of the scripts within the benchmark's working directory
+	env = dict(os.environ, XDG_CACHE_HOME=os.path.join(cwd, "cache"))
+	proc = subprocess.run([python] + args, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+						  stdin=subprocess.DEVNULL, timeout=3600)
+
+	if proc.returncode:
+		output = proc.stdout.decode("utf-8", "replace").strip().splitlines()
+
+		if any("ModuleNotFoundError" in line or "ImportError" in line for line in output[-3:]):
+			raise Skipped(output[-1])
+
+		raise RuntimeError("%s exited with %d: %s" % (args[0], proc.returncode, "\n".join(output[-10:])))
+
+
+def script(name: str) -> str:
+	return os.path.join(ROOT, name)
+
+
+def login(server: FakeViur) -> List[str]:
+	return ["-c", server.url, "-u", "bench", "-p", "bench"]
+
+
+def exportBenchmark(prefetch: int, format: str = "csv", compression: Optional[str] = None) -> Callable:
+	def run(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+		output = os.path.join(workdir, "export")
+		statsFile = os.path.join(workdir, "export.stats.json")
+
+		runScript([script("viur_csv_exporter.py")] + login(server) + [
+			"-e", MODULE, "-o", output, "-f", format, "--prefetch", str(prefetch), "--no-checkpoint",
+			"--stats-json", statsFile] + (["-z", compression] if compression else []), workdir)
+
+		with open(statsFile) as f:
+			stats = json.load(f)
+
+		return {"items": stats["rows"], "bytes": stats["bytesReceived"], "details": stats}
+
+	return run
+
+
+benchmark("export-csv")(exportBenchmark(prefetch=0))
+benchmark("export-csv-prefetch")(exportBenchmark(prefetch=2))
+benchmark("export-jsonl-gzip")(exportBenchmark(prefetch=2, format="jsonl", compression="gzip"))
+
+
+@benchmark("export-all-modules")
+def benchExportModules(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+	statsFile = os.path.join(workdir, "export.stats.json")
+
+	runScript([script("viur_csv_exporter.py")] + login(server) + [
+		"-a", "--output-dir", workdir, "--concurrency", "4", "--no-checkpoint", "--stats-json", statsFile], workdir)
+
+	with open(statsFile) as f:
+		stats = json.load(f)
+
+	return {"items": stats["rows"], "bytes": stats["bytesReceived"], "details": stats}
+
+
+def writeImportFile(fileName: str, rows: int, name: str = "Entry %d", repeat: int = 1) -> None:
+	with open(fileName, "w", newline="") as f:
+		writer = csv.writer(f, delimiter=";")
+		writer.writerow(["name", "status", "price"])
+
+		for nr in range(rows):
+			writer.writerow([name % (nr // repeat), "active" if nr % 2 else "inactive", "%.2f" % (nr * 1.5)])
+
+
+@benchmark("csvimport-add")
+def benchImportAdd(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+	fileName = os.path.join(workdir, "import.csv")
+	writeImportFile(fileName, args.import_rows)
+
+	before = len(server.dataset.entities)
+	runScript([script("csvimport.py"), fileName, "-m", MODULE] + login(server), workdir)
+
+	return {"items": len(server.dataset.entities) - before, "bytes": server.bytesReceived}
+
+
+@benchmark("csvimport-add-jobs")
+def benchImportAddJobs(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+	fileName = os.path.join(workdir, "import.csv")
+	writeImportFile(fileName, args.import_rows)
+
+	before = len(server.dataset.entities)
+	runScript([script("csvimport.py"), fileName, "-m", MODULE, "-j", "8"] + login(server), workdir)
+
+	return {"items": len(server.dataset.entities) - before, "bytes": server.bytesReceived}
+
+
+@benchmark("csvimport-dup-keys")
+def benchImportDuplicateKeys(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+	# Every new name appears twice; rows of the same name must not both add the entity
+	fileName = os.path.join(workdir, "import.csv")
+	writeImportFile(fileName, args.import_rows, name="New %d", repeat=2)
+
+	before = len(server.dataset.entities)
+	runScript([script("csvimport.py"), fileName, "-m", MODULE, "-k", "name", "-U", "-j", "8"] + login(server), workdir)
+
+	added = len(server.dataset.entities) - before
+	expected = (args.import_rows + 1) // 2
+	if added != expected:
+		raise RuntimeError("%d entities added for %d distinct names" % (added, expected))
+
+	return {"items": args.import_rows, "bytes": server.bytesReceived}
+
+
+@benchmark("csvimport-update")
+def benchImportUpdate(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+	fileName = os.path.join(workdir, "import.csv")
+	writeImportFile(fileName, min(args.import_rows, len(server.dataset.entities)))
+
+	runScript([script("csvimport.py"), fileName, "-m", MODULE, "-k", "name", "-U"] + login(server), workdir)
+
+	return {"items": min(args.import_rows, len(server.dataset.entities)), "bytes": server.bytesReceived}
+
+
+def downloadBenchmark(*options: str) -> Callable:
+	def run(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+		target = os.path.join(workdir, "files")
+		runScript([script("download-files.py"), target] + login(server) + list(options), workdir)
+
+		files = 0
+		size = 0
+		for path, dirs, names in os.walk(target):
+			files += len(names)
+			size += sum(os.path.getsize(os.path.join(path, name)) for name in names)
+
+		return {"items": files, "bytes": size}
+
+	return run
+
+
+benchmark("download-files")(downloadBenchmark())
+benchmark("download-files-async")(downloadBenchmark("--async"))
+
+
+@benchmark("copyblobs")
+def benchCopyBlobs(server: FakeViur, workdir: str, args: argparse.Namespace) -> Dict[str, Any]:
+	python = args.python2 or shutil.which("python2") or shutil.which("python2.7")
+	if not python:
+		raise Skipped("No Python 2 interpreter found (use --python2)")
+
+	host = "localhost:%d" % server.server_address[1]
+	runScript([script("copyblobs.py"), "--srcappid", host, "--srckey", "src",
+			   "--dstappid", host, "--dstkey", "dst"], workdir, python)
+
+	copied = len(server.dataset.storedBlobs)
+	return {"items": copied, "bytes": copied * server.dataset.blobSize}
+
+
+def runBenchmark(name: str, func: Callable, args: argparse.Namespace) -> Dict[str, Any]:
+	result = {"name": name, "status": "ok"}
+	best = None
+
+	for _ in range(args.repeat):
+		dataset = Dataset(entities=args.entities, folders=args.folders, depth=args.depth,
+						  filesPerFolder=args.files, fileSize=args.file_size, blobs=args.blobs,
+						  blobSize=args.blob_size)
+		server = FakeViur(dataset=dataset, latency=args.latency, pageSize=args.page_size).start()
+
+		try:
+			with tempfile.TemporaryDirectory(prefix="viur-bench-") as workdir:
+				start = time.perf_counter()
+				metrics = func(server, workdir, args)
+				seconds = time.perf_counter() - start
+		except Skipped as e:
+			return dict(result, status="skipped", reason=str(e))
+		except Exception as e:
+			return dict(result, status="failed", reason=str(e))
+		finally:
+			server.stop()
+
+		if best is None or seconds < best["seconds"]:
+			best = dict(metrics, seconds=seconds, requests=server.requests)
+
+	result.update(
+		seconds=round(best["seconds"], 3),
+		items=best["items"],
+		itemsPerSecond=round(best["items"] / best["seconds"], 1),
+		bytes=best["bytes"],
+		bytesPerSecond=round(best["bytes"] / best["seconds"], 1),
+		requests=best["requests"],
+	)
+
+	if "details" in best:
+		result["details"] = best["details"]
+
+	return result
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+	"""Return descriptions of all benchmarks which got slower than the baseline by more than tolerance."""
+	previous = {result["name"]: result for result in baseline["results"] if result["status"] == "ok"}
+	regressions = []
+
+	for result in results:
+		old = previous.get(result["name"])
+		if result["status"] != "ok" or not old:
+			continue
+
+		result["baseline"] = old["itemsPerSecond"]
+		result["change"] = round(result["itemsPerSecond"] / old["itemsPerSecond"] - 1, 3)
+
+		if result["change"] < -tolerance:
+			regressions.append("%s: %.1f items/s, baseline %.1f items/s (%+.0f%%)" % (
+				result["name"], result["itemsPerSecond"], old["itemsPerSecond"], result["change"] * 100))
+
+	return regressions
+
+
+if __name__ == "__main__":
+	ap = argparse.ArgumentParser(description="Benchmark the ViUR client scripts against a local fake server")
+	ap.add_argument("-r", "--report", metavar="FILE", default="benchmark-report.json", help="JSON report to write")
+	ap.add_argument("--compare", metavar="FILE", help="Earlier report to check for regressions")
+	ap.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown against --compare (0.2 = 20%%)")
+	ap.add_argument("-k", "--only", metavar="NAME", action="append", help="Only run benchmarks starting with NAME")
+	ap.add_argument("--repeat", type=int, default=1, help="Take the best of this many runs")
+	ap.add_argument("--python2", metavar="PATH", help="Python 2 interpreter for copyblobs.py")
+	ap.add_argument("-l", "--latency", type=float, default=0.005, help="Seconds the server delays every request")
+	ap.add_argument("-n", "--entities", type=int, default=5000, help="Number of entities to export")
+	ap.add_argument("--import-rows", type=int, default=500, help="Number of rows to import")
+	ap.add_argument("--page-size", type=int, default=30, help="Default amount of list requests")
+	ap.add_argument("--folders", type=int, default=5, help="Folders per folder in the file tree")
+	ap.add_argument("--depth", type=int, default=2, help="Depth of the file tree")
+	ap.add_argument("--files", type=int, default=10, help="Files per folder in the file tree")
+	ap.add_argument("--file-size", type=int, default=65536, help="Size of every file in bytes")
+	ap.add_argument("--blobs", type=int, default=100, help="Number of blobs to copy")
+	ap.add_argument("--blob-size", type=int, default=65536, help="Size of every blob in bytes")
+	args = ap.parse_args()
+
+	results = []
+	for name, func in BENCHMARKS:
+		if args.only and not any(name.startswith(only) for only in args.only):
+			continue
+
+		result = runBenchmark(name, func, args)
+		results.append(result)
+
+		if result["status"] == "ok":
+			print("%-22s %8.2fs %8d items %10.1f items/s %8.1f MiB/s %6d requests" % (
+				name, result["seconds"], result["items"], result["itemsPerSecond"],
+				result["bytesPerSecond"] / 2 ** 20, result["requests"]))
+		else:
+			print("%-22s %s: %s" % (name, result["status"], result["reason"].splitlines()[-1]))
+
+	regressions = []
+	if args.compare:
+		with open(args.compare) as f:
+			regressions = compare(results, json.load(f), args.tolerance)
+
+	report = {
+		"created": datetime.now().isoformat(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"config": {k: v for k, v in vars(args).items() if k not in ("report", "compare", "only")},
+		"results": results,
+		"regressions": regressions,
+	}
+
+	with open(args.report, "w") as f:
+		json.dump(report, f, indent=2)
+
+	for regression in regressions:
+		print("REGRESSION", regression)
+
+	sys.exit(1 if regressions or any(result["status"] == "failed" for result in results) else 0)
@@ -3,7 +3,7 @@ import pickle
 import urllib2
 from urllib import quote_plus
 from time import time, sleep
-import pickle, json, random, mimetypes, string, sys, os
+import pickle, json, random, mimetypes, string, sys, os, shutil, tempfile
 import argparse
 
 parser = argparse.ArgumentParser(description='Copies the complete Blob-Store from the given application to the destination Application.')
@@ -13,6 +13,7 @@ parser.add_argument('--dstappid', type=str, help='Appspot-ID of the dst Applicat
 parser.add_argument('--dstkey', type=str, help='Download-Key for the dst Application.', required=True, dest="dstkey")
 parser.add_argument('--localblobdb', type=str, help='Hold and use local hasblob DB to reduce amount of hasblob calls')
 parser.add_argument('--override', type=bool, default=False, help='Override blobs even if they already exists')
+parser.add_argument('--buffersize', type=int, default=64 * 1024, help='Bytes of a blob held in memory at once while copying it', dest="buffersize")
 
 args = parser.parse_args()
 
@@ -27,11 +28,15 @@ class NetworkService( object ):
 		urllib2.install_opener( self.opener )
 
 	@staticmethod
-	def genReqStr( params ):
+	def genReqParts( params ):
+		"""
+			Returns the parts of the multipart body for params, in order, and its boundary.
+
+			Parts are byte strings, or the file objects of file params, which are read only while sending.
+		"""
 		boundary_str = "---"+''.join( [ random.choice(string.ascii_lowercase+string.ascii_uppercase + string.digits) for x in range(13) ] )
 		boundary = boundary_str.encode("UTF-8")
-		res = b'Content-Type: multipart/mixed; boundary="'+boundary+b'"\nMIME-Version: 1.0\n'
-		res += b'\n--'+boundary
+		parts = [b'Content-Type: multipart/mixed; boundary="'+boundary+b'"\nMIME-Version: 1.0\n', b'\n--'+boundary]
 		for(key, value) in list(params.items()):
 			if all( [x in dir( value ) for x in ["name", "read"] ] ): #File
 
@@ -44,28 +49,28 @@ class NetworkService( object ):
 					except:
 						type = b"application/octet-stream"
 
-				res += b'\nContent-Type: '+type.encode("UTF-8")+b'\nMIME-Version: 1.0\nContent-Disposition: form-data; name="'+key.encode("UTF-8")+b'"; filename="'+os.path.basename(value.name).decode(sys.getfilesystemencoding()).encode("UTF-8")+b'"\n\n'
-				res += value.read()
-				res += b'\n--'+boundary
+				parts.append(b'\nContent-Type: '+type.encode("UTF-8")+b'\nMIME-Version: 1.0\nContent-Disposition: form-data; name="'+key.encode("UTF-8")+b'"; filename="'+os.path.basename(value.name).decode(sys.getfilesystemencoding()).encode("UTF-8")+b'"\n\n')
+				parts.append(value if getattr(value, "size", None) is not None else value.read())
+				parts.append(b'\n--'+boundary)
 			elif isinstance( value, list ):
 				for val in value:
-					res += b'\nContent-Type: application/octet-stream\nMIME-Version: 1.0\nContent-Disposition: form-data; name="'+key.encode("UTF-8")+b'"\n\n'
+					parts.append(b'\nContent-Type: application/octet-stream\nMIME-Version: 1.0\nContent-Disposition: form-data; name="'+key.encode("UTF-8")+b'"\n\n')
 					if isinstance( val, unicode ):
-						res += val.encode("UTF-8")
+						parts.append(val.encode("UTF-8"))
 					else:
-						res += str(val)
-					res += b'\n--'+boundary
+						parts.append(str(val))
+					parts.append(b'\n--'+boundary)
 			else:
-				res += b'\nContent-Type: application/octet-stream\nMIME-Version: 1.0\nContent-Disposition: form-data; name="'+key.encode("UTF-8")+b'"\n\n'
+				parts.append(b'\nContent-Type: application/octet-stream\nMIME-Version: 1.0\nContent-Disposition: form-data; name="'+key.encode("UTF-8")+b'"\n\n')
 				if isinstance( value, unicode ):
-					res += unicode( value ).encode("UTF-8")
+					parts.append(unicode( value ).encode("UTF-8"))
 				else:
-					res += str( value )
-				res += b'\n--'+boundary
-		res += b'--\n'
-		return( res, boundary )
+					parts.append(str( value ))
+				parts.append(b'\n--'+boundary)
+		parts.append(b'--\n')
+		return( parts, boundary )
 
-	def request( self, url, params=None, secure=False, extraHeaders=None, noParse=False ):
+	def request( self, url, params=None, secure=False, extraHeaders=None, noParse=False, stream=False, retries=3 ):
 		def rWrap( self, url, params=None, secure=False, extraHeaders=None, noParse=False):
 			if secure:
 				skey = json.loads( urllib2.urlopen( self.baseURL+ "/skey" ).read() )
@@ -79,20 +84,25 @@ class NetworkService( object ):
 			if not url.lower().startswith("https://") and not url.lower().startswith("http://"):
 				url = self.baseURL+url
 			if isinstance( params,  dict ):
-				res, boundary = self.genReqStr( params )
-				r = urllib2.Request((url).encode("UTF-8"), res, headers={b"Content-Type": b'multipart/form-data; boundary='+boundary+b'; charset=utf-8'})
+				parts, boundary = self.genReqParts( params )
+				body = MultipartStream( parts )
+				# urllib2 can't take the length of a stream itself
+				r = urllib2.Request((url).encode("UTF-8"), body, headers={b"Content-Type": b'multipart/form-data; boundary='+boundary+b'; charset=utf-8',
+				                                                          b"Content-Length": str(len(body))})
 				req = urllib2.urlopen( r )
 			else:
 				req = urllib2.urlopen( url )
+			if stream:
+				return( req )
 			if noParse:
 				return( req.read() )
 			else:
 				return( pickle.loads( req.read().decode("HEX") ) )
-		for x in range(0,4):
+		for x in range(0,retries+1):
 			try:
 				return( rWrap( self, url, params, secure, extraHeaders, noParse ) )
 			except Exception as e:
-				if x<3:
+				if x<retries:
 					print("Error during network request:", e, "Retrying in 60 seconds"  )
 					sleep( 60 )
 				else:
@@ -101,21 +111,120 @@ class NetworkService( object ):
 					print( url, params, secure, extraHeaders, noParse)
 					raise
 
+class MultipartStream(object):
+	"""
+		File-like multipart body, reading the parts of NetworkService.genReqParts one after another.
+
+		httplib sends it in blocks, so file parts are piped through without ever being held in memory.
+	"""
+	def __init__(self, parts):
+		super( MultipartStream, self ).__init__()
+		self.parts = list(parts)
+		self.length = sum([len(x) if isinstance(x, bytes) else x.size for x in self.parts])
+		self.offset = 0
+
+	def __len__(self):
+		return( self.length )
+
+	def read(self, size=-1):
+		while self.parts:
+			part = self.parts[0]
+
+			if isinstance(part, bytes):
+				if size < 0 or len(part) - self.offset <= size:
+					data = part[self.offset:]
+					self.parts.pop(0)
+					self.offset = 0
+				else:
+					data = part[self.offset:self.offset + size]
+					self.offset += size
+			else:
+				data = part.read(bufferSize if size < 0 else min(size, bufferSize))
+				if not data:
+					self.parts.pop(0)
+
+			if data:
+				return( data )
+
+		return( b"" )
+
 class fwrap(object):
-	def __init__(self, blob, name="", content_type=""):
+	"""
+		A file param streaming its content from the file object blob, which provides size bytes.
+	"""
+	def __init__(self, blob, name="", content_type="", size=None):
 		super( fwrap, self ).__init__()
 		self._blob = blob
 		self.name = name.encode(sys.getfilesystemencoding())
 		self.content_type = content_type
+		self.size = size
 
 	def read(self, *args, **kwargs):
-		return( self._blob )
+		return( self._blob.read(*args, **kwargs) )
+
+class BlobDB(object):
+	"""
+		Local database of the blobs known to exist on the destination, kept in SQLite.
+
+		Writes are collected and committed once per batch of blobs.
+	"""
+	SQLITE_HEADER = b"SQLite format 3\x00"
+
+	def __init__(self, fileName=":memory:"):
+		super(BlobDB, self).__init__()
+		legacyKeys = []
+
+		if fileName != ":memory:" and os.path.isfile(fileName):
+			with open(fileName, "rb") as f:
+				isSqlite = f.read(len(self.SQLITE_HEADER)) == self.SQLITE_HEADER
+
+			if not isSqlite:
+				# Former text file with one blob key per line
+				with open(fileName, "r") as f:
+					legacyKeys = [x.strip() for x in f if x.strip()]
+
+				os.rename(fileName, fileName + ".old")
+				print("Converting %d entries of the old local blob DB, kept as %s.old" % (len(legacyKeys), fileName))
+
+		self.db = sqlite3.connect(fileName)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS blobs (key TEXT PRIMARY KEY, content_type TEXT, size INTEGER, dlkey TEXT)")
+
+		for key in legacyKeys:
+			self.add(key)
+
+		self.commit()
+
+	def __len__(self):
+		return self.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
 
-def haveBlob( blobKey ):
-	global dstNetworkService, dstBackupKey, blobdbfile, knownblobs
+	def add(self, blobKey, content_type=None, size=None, dlkey=None):
+		self.db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?)", (blobKey, content_type, size, dlkey))
 
-	if blobKey in knownblobs:
-		return True
+	def missing(self, blobKeys):
+		"""
+			Returns those of blobKeys not recorded yet, in their given order.
+		"""
+		known = set()
+
+		# Stay below SQLite's limit of 999 parameters per statement
+		for i in range(0, len(blobKeys), 500):
+			chunk = blobKeys[i:i + 500]
+			known.update(key for (key,) in self.db.execute(
+				"SELECT key FROM blobs WHERE key IN (%s)" % ",".join("?" * len(chunk)), chunk))
+
+		return [key for key in blobKeys if key not in known]
+
+	def commit(self):
+		self.db.commit()
+
+	def close(self):
+		self.db.commit()
+		self.db.close()
+
+def haveBlob( blobKey, content_type = None ):
+	global dstNetworkService, dstBackupKey, blobdb
 
 	answ = dstNetworkService.request(
 			"/dbtransfer/hasblob/%s/%s" % (blobKey,dstBackupKey), noParse=True)
@@ -123,34 +232,76 @@ def haveBlob( blobKey ):
 	answ = answ.lower() == "true"
 
 	if answ:
-		knownblobs.append(blobKey)
+		blobdb.add(blobKey, content_type)
 
-		if blobdbfile:
-			blobdbfile.write("%s\n" % blobKey)
-		
 	return answ
 
 def fetchBlob( blobKey ):
+	"""
+		Opens the download of blobKey from the source and returns it as a file object, with its size.
+	"""
 	global srcNetworkService
-	return( srcNetworkService.request("/file/download/%s" %blobKey, noParse=True))
+	# Failures are retried by copyBlob
+	src = srcNetworkService.request("/file/download/%s" %blobKey, stream=True, retries=0)
+	size = src.info().getheader("Content-Length")
 
-def storeBlob( blobKey, blob, content_type = ""):
+	if size is not None:
+		return( src, int(size) )
+
+	# Without a Content-Length the upload size is unknown, buffer the blob on disk
+	tmp = tempfile.TemporaryFile()
+	try:
+		shutil.copyfileobj(src, tmp, bufferSize)
+	finally:
+		src.close()
+
+	size = tmp.tell()
+	tmp.seek(0)
+	return( tmp, size )
+
+def storeBlob( blobKey, blob, content_type = "", size = None):
+	"""
+		Uploads blob, a file object providing size bytes, to the destination and returns its new dlkey.
+	"""
 	global dstNetworkService, dstBackupKey
 
 	#print(blobKey)
 
-	ulurl = dstNetworkService.request("/dbtransfer/getUploadURL",{"key":dstBackupKey}, noParse=True ).decode("UTF-8")
+	# Failures are retried by copyBlob, which has to start over with a new download anyway
+	ulurl = dstNetworkService.request("/dbtransfer/getUploadURL",{"key":dstBackupKey}, noParse=True, retries=0 ).decode("UTF-8")
 	#print("-------")
 	#print( ulurl )
 
-	data = dstNetworkService.request(ulurl, {   "file": fwrap(blob,"file1", content_type),
+	# A stream can't be sent twice, copyBlob retries the whole transfer
+	data = dstNetworkService.request(ulurl, {   "file": fwrap(blob,"file1", content_type, size),
 	                                            "key":dstBackupKey,
 	                                            "oldkey":blobKey},
-	                                 noParse=True ).decode("UTF-8")
+	                                 noParse=True, retries=0 ).decode("UTF-8")
 	data = json.loads(data)
 	if data["action"] == "addSuccess":
 		return( data["values"][0]["dlkey"])
 
+def copyBlob( blobKey, content_type = "" ):
+	"""
+		Pipes the download of blobKey from the source into its upload to the destination.
+
+		Returns the new dlkey and the size of the blob.
+	"""
+	for x in range(0,4):
+		blob = None
+		try:
+			blob, size = fetchBlob( blobKey )
+			return( storeBlob( blobKey, blob, content_type, size ), size )
+		except Exception as e:
+			if x<3:
+				print("Error copying blob %s:" % blobKey, e, "Retrying in 60 seconds"  )
+				sleep( 60 )
+			else:
+				raise
+		finally:
+			if blob is not None:
+				blob.close()
+
 if not "localhost" in args.srcappid:
 	viurSrcHost = "https://%s.appspot.com/" % args.srcappid
 else:
@@ -166,20 +317,16 @@ srcBackupKey = args.srckey
 dstBackupKey = args.dstkey
 localblobdb = args.localblobdb
 override = args.override
-knownblobs = []
-blobdbfile = None
+bufferSize = args.buffersize
 
 print("Source Host: %s" % viurSrcHost)
 print("Destination Host: %s" % viurDstHost)
 if localblobdb:
 	print("Local blob DB: %s" % localblobdb)
-	try:
-		blobdbfile = open(localblobdb, "r+")
-		knownblobs = [x.strip() for x in blobdbfile.readlines()]
-
-		print("%d entries in local blob DB found!" % len(knownblobs))
-	except:
-		blobdbfile = open(localblobdb, "w")
+	blobdb = BlobDB(localblobdb)
+	print("%d entries in local blob DB found!" % len(blobdb))
+else:
+	blobdb = BlobDB()
 
 srcNetworkService = NetworkService(viurSrcHost)
 dstNetworkService = NetworkService(viurDstHost)
@@ -193,16 +340,32 @@ while res["values"]:
 	numBlobs += len( res["values"] )
 	print("Got a total of %s blobs so far" % numBlobs )
 	newBlobs = 0
+
+	# Only blobs unknown to the local DB are checked on the destination
+	if override:
+		missing = set(r["key"] for r in res["values"])
+	else:
+		missing = set(blobdb.missing([r["key"] for r in res["values"]]))
+
 	for r in res["values"]:
-		if override or not haveBlob( r["key"] ):
+		if r["key"] not in missing:
+			continue
+
+		if override or not haveBlob( r["key"], r["content_type"] ):
 			print("Fetching new blobkey %s" % r["key"] )
 			if r["content_type"] == "application/pdf":
 				print("- Ignoring: %r" % r["content_type"])
 				continue
 
-			storeBlob( r["key"], fetchBlob( r["key"] ), r["content_type"] )
+			dlkey, size = copyBlob( r["key"], r["content_type"] )
+			if dlkey:
+				blobdb.add(r["key"], r["content_type"], size, dlkey)
+
 			newBlobs += 1
+
+	blobdb.commit()
 	print("%s of the last batch of %s where new" % (newBlobs, len(res["values"])))
 	res = srcNetworkService.request("/dbtransfer/exportBlob2", {"cursor":res["cursor"], "key": srcBackupKey})
 
+blobdb.close()
 print("Finished copying %d files" % numBlobs)
@@ -1,5 +1,15 @@
 # -*- coding: utf-8 -*-
-import re, json, csv, requests, sys, codecs, argparse, logging, os, logics
+import re, json, csv, requests, sys, codecs, argparse, logging, os, random, sqlite3, threading, time, asyncio, logics
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from viur_async import AsyncViurClient
+from viur_skey import SkeyPool
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
 
 root = logging.getLogger()
 root.setLevel(logging.INFO)
@@ -7,10 +17,17 @@ root.setLevel(logging.INFO)
 sys.stdout = codecs.getwriter("utf8")(sys.stdout)
 
 class Importer(requests.Session):
-	def __init__(self, host, username=None, password=None, loginKey=None, render="json"):
+	def __init__(self, host, username=None, password=None, loginKey=None, render="json", rate_limit=None,
+				 pool_size=10):
 		super(Importer, self).__init__()
 
 		self.render = render
+		self.rate_limit = rate_limit
+
+		# Keep a connection per worker alive
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+		self.mount("http://", adapter)
+		self.mount("https://", adapter)
 
 		self.host = host
 
@@ -20,6 +37,8 @@ class Importer(requests.Session):
 
 		assert (self.username and self.password) or self.loginKey
 
+		self.skeys = SkeyPool(self.fetch_skey)
+
 		if not self.login():
 			raise IOError("Unable to logon to '%s'" % self.host)
 
@@ -30,7 +49,7 @@ class Importer(requests.Session):
 				data={
 					"name": self.username,
 					"password": self.password,
-					"skey": self.skey()
+					"skey": self.fetch_skey()
 				},
 				timeout=30)
 		else:
@@ -38,10 +57,13 @@ class Importer(requests.Session):
 				"/user/auth_loginkey/login",
 				data={
 					"key": self.loginKey,
-					"skey": self.skey()
+					"skey": self.fetch_skey()
 				},
 				timeout=30)
 
+		# The session has changed, skeys of the anonymous session are useless now
+		self.skeys.invalidate()
+
 		if not answ.status_code == 200:
 			logging.error("Unable to logon to '%s'" % self.host)
 			return False
@@ -59,15 +81,29 @@ class Importer(requests.Session):
 		return True
 
 	def logout(self):
-		return self.get("/user/logout", params={"skey": self.skey()}, timeout=10).json()
+		res = self.get("/user/logout", params={"skey": self.fetch_skey()}, timeout=10).json()
+		self.skeys.close()
+		return res
 
 	def skey(self):
+		return self.skeys.get()
+
+	def fetch_skey(self):
 		return self.get("/skey", timeout=15).json()
 
+	def secure_post(self, url, data, *args, **kwargs):
+		"""
+		POST data with a pooled skey, retrying with a fresh one when the server rejects it.
+		"""
+		return self.skeys.retry(lambda skey: self.post(url, data=dict(data, skey=skey), *args, **kwargs))
+
 	def get(self, url, *args, **kwargs):
 		if url.startswith("/"):
 			url = url[1:]
 
+		if self.rate_limit:
+			self.rate_limit.acquire()
+
 		logging.debug("GET  %s %s" % ("/".join([self.host, self.render, url]), kwargs))
 		return super(Importer, self).get("/".join([self.host, self.render, url]), *args, **kwargs)
 
@@ -75,6 +111,9 @@ class Importer(requests.Session):
 		if url.startswith("/"):
 			url = url[1:]
 
+		if self.rate_limit:
+			self.rate_limit.acquire()
+
 		logging.debug("POST %s %s" % ("/".join([self.host, self.render, url]), kwargs))
 		return super(Importer, self).post("/".join([self.host, self.render, url]), *args, **kwargs)
 
@@ -87,6 +126,31 @@ class Importer(requests.Session):
 
 		return req.json()
 
+	def list_all(self, module, amount=99, **kwargs):
+		"""
+		Yields all entries of a module matching the filters in kwargs, following the cursor page by page.
+		"""
+		cursor = None
+
+		while True:
+			params = dict(kwargs, amount=amount)
+			if cursor:
+				params["cursor"] = cursor
+
+			answ = self.list(module, **params)
+			if answ is None:
+				raise IOError("Unable to list %s" % module)
+
+			if not answ["skellist"]:
+				break
+
+			for skel in answ["skellist"]:
+				yield skel
+
+			cursor = answ.get("cursor")
+			if not cursor:
+				break
+
 	def logic_lookup(self, module, field, value, result = "key"):
 		ret = self.list(module, **{field: value, "amount": 1})
 
@@ -96,6 +160,697 @@ class Importer(requests.Session):
 		return None
 
 
+class AsyncImporter(object):
+	"""
+	Imports through an AsyncViurClient, running all requests on an event loop in one background thread.
+
+	Offers the submit and shutdown methods of the ThreadPoolExecutor used otherwise, but submit takes a
+	coroutine function, so jobs rows are in flight at once without a thread per row.
+	"""
+	def __init__(self, host, username=None, password=None, loginKey=None, rate_limit=None, jobs=1):
+		self.render = "vi"
+		self.rate_limit = rate_limit
+		self.client = AsyncViurClient(host, username, password, loginKey, render=self.render, maxConcurrency=jobs)
+		self.futures = set()
+		self.closed = False
+
+		self.loop = asyncio.new_event_loop()
+		self.thread = threading.Thread(target=self.loop.run_forever, name="AsyncImporter", daemon=True)
+		self.thread.start()
+
+		try:
+			self.run(self.client.open())
+		except Exception:
+			self.stop()
+			raise
+
+	def run(self, coro):
+		"""
+		Runs coro on the event loop and returns its result.
+		"""
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+	def submit(self, fn, *args):
+		if self.closed:
+			raise RuntimeError("cannot schedule new rows after shutdown")
+
+		future = asyncio.run_coroutine_threadsafe(fn(*args), self.loop)
+		self.futures.add(future)
+		future.add_done_callback(self.futures.discard)
+		return future
+
+	def shutdown(self, wait=True, cancel_futures=False):
+		"""
+		Waits for all submitted rows, logs out and stops the event loop.
+
+		Rows are never cancelled, as their requests may have been sent already.
+		"""
+		self.closed = True
+		wait_futures(list(self.futures))
+
+		try:
+			self.run(self.client.close())
+		finally:
+			self.stop()
+
+	def stop(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.close()
+
+	async def throttle(self):
+		if self.rate_limit:
+			await self.rate_limit.acquire_async()
+
+	async def secure_post(self, url, data):
+		"""
+		POST data with a pooled skey, retrying with a fresh one when the server rejects it.
+		"""
+		await self.throttle()
+		return await self.client.request("/%s/%s" % (self.render, url), data=data, method="POST")
+
+	async def list(self, module, **kwargs):
+		await self.throttle()
+		req = await self.client.request("/%s/%s/list" % (self.render, module), params=kwargs, addSkey=False)
+
+		if not req.status_code == 200:
+			logging.error("Error %d, unable to fetch items" % req.status_code)
+			return None
+
+		return req.json()
+
+	def list_all(self, module, amount=99, **kwargs):
+		"""
+		Yields all entries of a module like Importer.list_all, fetching the pages on the event loop.
+		"""
+		cursor = None
+
+		while True:
+			params = dict(kwargs, amount=amount)
+			if cursor:
+				params["cursor"] = cursor
+
+			answ = self.run(self.list(module, **params))
+			if answ is None:
+				raise IOError("Unable to list %s" % module)
+
+			if not answ["skellist"]:
+				break
+
+			for skel in answ["skellist"]:
+				yield skel
+
+			cursor = answ.get("cursor")
+			if not cursor:
+				break
+
+
+class TokenBucket(object):
+	"""
+	Thread-safe token bucket limiting the request rate to rate requests per second, with bursts of up to burst.
+	"""
+	def __init__(self, rate, burst=None):
+		assert rate > 0
+		self.rate = rate
+		self.burst = burst or max(1, rate)
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def reserve(self):
+		"""
+		Takes a token and returns the seconds to wait until it was earned.
+		"""
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+
+			return -self.tokens / self.rate if self.tokens < 0 else 0
+
+	def acquire(self):
+		# The token is reserved under the lock, the wait happens outside of it
+		delay = self.reserve()
+		if delay:
+			time.sleep(delay)
+
+	async def acquire_async(self):
+		delay = self.reserve()
+		if delay:
+			await asyncio.sleep(delay)
+
+
+class KeyIndex(object):
+	"""
+	Maps the values of the key column to the keys of the existing entities, kept in memory or in a SQLite file.
+
+	Given fields, it also keeps the current values of these fields of every entity, to detect unchanged rows.
+	"""
+	def __init__(self, filename=None, fields=None, rebuild=False):
+		self.lock = threading.Lock()
+		self.size = 0
+		self.fields = fields
+
+		if filename:
+			if os.path.exists(filename) and not rebuild:
+				raise IOError("%s already exists" % filename)
+
+			# Remove the database together with the WAL files of an earlier run
+			for name in (filename, filename + "-wal", filename + "-shm"):
+				if os.path.exists(name):
+					os.remove(name)
+
+			self.db = sqlite3.connect(filename, check_same_thread=False)
+			self.db.execute("PRAGMA journal_mode=WAL")
+			self.db.execute("PRAGMA synchronous=OFF")
+			self.db.execute("CREATE TABLE entries (value TEXT NOT NULL, key TEXT NOT NULL, data TEXT)")
+			self.entries = None
+		else:
+			self.db = None
+			self.entries = {}
+			self.data = {}
+
+	def project(self, skel):
+		if self.fields is None or skel is None:
+			return None
+
+		return {field: skel[field] for field in self.fields if field in skel}
+
+	def add(self, value, key, skel=None):
+		data = self.project(skel)
+
+		with self.lock:
+			self.size += 1
+
+			if self.db:
+				self.db.execute("INSERT INTO entries VALUES (?, ?, ?)",
+								(value, key, None if data is None else json.dumps(data)))
+			else:
+				self.entries.setdefault(value, []).append(key)
+				self.data[key] = data
+
+	def update(self, value, key, skel):
+		"""
+		Replaces the current values of an entity after it was edited.
+		"""
+		data = self.project(skel)
+
+		with self.lock:
+			if self.db:
+				self.db.execute("UPDATE entries SET data = ? WHERE value = ? AND key = ?",
+								(None if data is None else json.dumps(data), value, key))
+			else:
+				self.data[key] = data
+
+	def current(self, value, key):
+		"""
+		Returns the current values of the entity key, found by value, or None when they are not kept.
+		"""
+		with self.lock:
+			if self.db:
+				for data, in self.db.execute("SELECT data FROM entries WHERE value = ? AND key = ?", (value, key)):
+					return None if data is None else json.loads(data)
+
+				return None
+
+			return self.data.get(key)
+
+	def lookup(self, value):
+		"""
+		Returns the keys of all entities having value in the key column.
+		"""
+		with self.lock:
+			if self.db:
+				return [key for key, in self.db.execute("SELECT key FROM entries WHERE value = ? LIMIT 2", (value, ))]
+
+			return self.entries.get(value, [])
+
+	def build(self, imp, module, column):
+		"""
+		Indexes all entities of module by one paginated scan.
+		"""
+		for skel in imp.list_all(module):
+			value = skel.get(column)
+
+			# Translated and multiple values are never matched by a CSV value
+			if value is not None and not isinstance(value, (dict, list)):
+				self.add(str(value), skel["key"], skel)
+
+		if self.db:
+			with self.lock:
+				self.db.execute("CREATE INDEX entries_value ON entries (value)")
+				self.db.commit()
+
+	def close(self):
+		if self.db:
+			self.db.close()
+
+
+class ExpressionRule(object):
+	"""
+	One -e rule, compiled once, with the time spent evaluating it.
+	"""
+	def __init__(self, nr, field, source, compiled):
+		self.nr = nr
+		self.field = field
+		self.source = source
+		self.compiled = compiled
+		self.rows = 0
+		self.seconds = 0.0
+
+
+class ExpressionPipeline(object):
+	"""
+	Compiles the -e rules once and applies them, in their given order, to batches of rows.
+	"""
+	def __init__(self, vil, expressions):
+		self.vil = vil
+		self.rules = []
+		errors = []
+
+		for nr, (field, source) in enumerate(expressions or [], start=1):
+			try:
+				compiled = vil.compile(source)
+			except Exception as e:
+				compiled = None
+				errors.append("Expression %d (%s) does not compile: %s" % (nr, field, e))
+			else:
+				if compiled is None:
+					errors.append("Expression %d (%s) does not compile: %r" % (nr, field, source))
+
+			self.rules.append(ExpressionRule(nr, field, source, compiled))
+
+		if errors:
+			raise ValueError("\n".join(errors))
+
+	def validate(self, row):
+		"""
+		Evaluates all rules on a copy of row, so broken rules fail before anything was imported.
+		"""
+		row = dict(row)
+
+		for rule in self.rules:
+			try:
+				row[rule.field] = self.vil.execute(rule.compiled, row)
+			except Exception as e:
+				raise ValueError("Expression %d (%s) fails on the first row: %s" % (rule.nr, rule.field, e))
+
+	def apply(self, rows):
+		"""
+		Evaluates all rules on a batch of rows; every rule sees the results of the rules before it.
+
+		Returns a list with the error message of every row, or None for the rows without errors.
+		"""
+		execute = self.vil.execute
+		errors = [None] * len(rows)
+
+		for rule in self.rules:
+			start = time.perf_counter()
+
+			for i, row in enumerate(rows):
+				if errors[i]:
+					continue
+
+				try:
+					row[rule.field] = execute(rule.compiled, row)
+				except Exception as e:
+					errors[i] = "Expression %d (%s) failed: %s" % (rule.nr, rule.field, e)
+
+			rule.seconds += time.perf_counter() - start
+			rule.rows += len(rows)
+
+		return errors
+
+	def report(self):
+		for rule in self.rules:
+			logging.info("Expression %d %s = %r: %.3fs for %d rows (%.1f µs/row)", rule.nr, rule.field, rule.source,
+						 rule.seconds, rule.rows, rule.seconds * 1e6 / rule.rows if rule.rows else 0)
+
+
+class OffsetReader(object):
+	"""
+	Reads the rows of a CSV-File opened in binary mode as dicts, like csv.DictReader does.
+
+	The file is read in chunks of the file object's buffer size. Every row is yielded together with the byte
+	offset right behind it, which is where reading continues after an interruption.
+	"""
+	def __init__(self, f, delimiter, fieldnames=None, encoding="utf-8"):
+		self.file = f
+		self.encoding = encoding
+		self.consumed = f.tell()
+		self.reader = csv.reader(self.lines(), delimiter=delimiter)
+
+		if fieldnames is None:
+			fieldnames = next(self.reader, None)
+
+		self.fieldnames = fieldnames
+
+	def lines(self):
+		# csv.reader pulls exactly the lines of one row before returning it
+		for line in self.file:
+			self.consumed += len(line)
+			yield line.decode(self.encoding)
+
+	def __iter__(self):
+		for values in self.reader:
+			if not values:
+				continue
+
+			row = dict(zip(self.fieldnames, values))
+			for name in self.fieldnames[len(values):]:
+				row[name] = None
+
+			yield self.consumed, row
+
+
+class Journal(object):
+	"""
+	Sidecar file of an import, recording how far the CSV-File was imported.
+	"""
+	def __init__(self, filename, module, header):
+		self.filename = filename + ".journal"
+		self.source = os.path.abspath(filename)
+		self.module = module
+		self.header = header
+
+	def load(self):
+		with open(self.filename) as f:
+			state = json.load(f)
+
+		if state["file"] != self.source or state["module"] != self.module:
+			raise ValueError("%s was written for %s into %s" % (self.filename, state["file"], state["module"]))
+
+		if state["header"] != self.header:
+			raise ValueError("The header of %s changed since %s was written" % (self.source, self.filename))
+
+		if os.path.getsize(self.source) < state["offset"]:
+			raise ValueError("%s is shorter than the journaled offset %d" % (self.source, state["offset"]))
+
+		return state
+
+	def save(self, offset, row, counters):
+		with open(self.filename + ".tmp", "w") as f:
+			json.dump({"file": self.source, "module": self.module, "header": self.header, "offset": offset,
+					   "row": row, "counters": counters}, f)
+
+		os.replace(self.filename + ".tmp", self.filename)
+
+	def remove(self):
+		if os.path.exists(self.filename):
+			os.remove(self.filename)
+
+
+def read_batches(reader, size):
+	"""
+	Yields the rows of reader in lists of up to size rows.
+	"""
+	batch = []
+
+	for row in reader:
+		batch.append(row)
+
+		if len(batch) >= size:
+			yield batch
+			batch = []
+
+	if batch:
+		yield batch
+
+
+class RowError(Exception):
+	"""
+	A row was rejected by the application; retrying it won't help.
+	"""
+
+
+class AddFailed(Exception):
+	"""
+	The add request of a row failed after it may have reached the server, so the entity may exist already.
+	"""
+
+
+def request_not_sent(e):
+	"""
+	Tells whether a request failed before it reached the server, e.g. as the connection was refused.
+	"""
+	if isinstance(e, requests.exceptions.ConnectionError):
+		reason = e.args[0] if e.args else None
+		# urllib3 wraps the cause into a MaxRetryError
+		reason = getattr(reason, "reason", reason)
+		return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+	return aiohttp is not None and isinstance(e, aiohttp.ClientConnectorError)
+
+
+def request_failed(action, e):
+	"""
+	Returns the exception to raise after the add or edit request of a row failed with e.
+
+	/add is not idempotent, so an add which may have reached the server becomes an AddFailed.
+	"""
+	if action != "add" or isinstance(e, RowError) or request_not_sent(e):
+		return e
+
+	error = AddFailed("%s; the entity may have been added" % (str(e) or type(e).__name__))
+	error.__cause__ = e
+	return error
+
+
+def format_errors(answ):
+	return ", ".join([("%s=%s: %s" % (bone, answ["values"].get(bone), struct["error"]))
+					  for bone, struct in answ["structure"] if struct.get("error")])
+
+
+def same_value(current, value):
+	"""
+	Compares the value of a bone, as rendered by the server, with a CSV value.
+	"""
+	if current is None:
+		return value in (None, "")
+
+	if isinstance(current, bool):
+		return str(value).lower() in (("1", "true", "yes") if current else ("0", "false", "no", ""))
+
+	if isinstance(current, (int, float)):
+		try:
+			return float(value) == current
+		except (TypeError, ValueError):
+			return False
+
+	if isinstance(current, (dict, list)):
+		# Translated, multiple and relational values can't be compared to a CSV value
+		return False
+
+	return str(current) == ("" if value is None else str(value))
+
+
+def diff_row(current, row):
+	"""
+	Returns (field, current value, new value) for every field of row differing from the current values.
+
+	Fields the entity doesn't have are no bones and are ignored by the server as well.
+	"""
+	return [(field, current[field], value) for field, value in row.items()
+			if field != "key" and field in current and not same_value(current[field], value)]
+
+
+def chain(source, target):
+	"""
+	Passes the outcome of the future source on to the future target once it is done.
+	"""
+	def done(source):
+		if source.cancelled():
+			target.cancel()
+		elif source.exception() is not None:
+			target.set_exception(source.exception())
+		else:
+			target.set_result(source.result())
+
+	source.add_done_callback(done)
+
+
+def plan_row(args, index, row, answ=None, lookup=False):
+	"""
+	Decides how to import a row, looking up existing entities in index or, without one or with lookup, in answ,
+	the list answer of the server for the key column value of the row.
+
+	Returns a tuple like import_row, but with the action "add" or "edit" when that request is still to be made.
+	"""
+	key = None
+	current = None
+
+	if args.keyColumn:
+		if index is not None and not lookup:
+			keys = index.lookup(row[args.keyColumn])
+		else:
+			if answ is None:
+				raise IOError("Unable to look up %r" % row[args.keyColumn])
+
+			keys = [skel["key"] for skel in answ["skellist"]]
+
+			if len(keys) == 1:
+				current = answ["skellist"][0]
+
+				# The entity was added by a failed attempt of this row, later rows have to find it
+				if index is not None and not index.lookup(row[args.keyColumn]):
+					index.add(row[args.keyColumn], keys[0], current)
+
+		if len(keys) == 1:
+			key = keys[0]
+
+			if not args.updateEntry:
+				return "skipped", key, None
+
+		elif len(keys) > 1:
+			raise RowError("Multiple matches on '%s'? IMPOSSIBLE!!" % row[args.keyColumn])
+
+	if not key:
+		return "add", None, None
+
+	changes = None
+
+	if args.skip_unchanged:
+		if index is not None and not lookup:
+			current = index.current(row[args.keyColumn], key)
+
+		if current is not None:
+			changes = diff_row(current, row)
+
+			if not changes:
+				return "unchanged", key, changes
+
+	row["key"] = key
+	return "edit", key, changes
+
+
+def apply_answer(args, index, row, action, key, changes, answ):
+	"""
+	Checks the answer of the add or edit request of a row and records the entity in index.
+
+	Returns the result of import_row.
+	"""
+	answ.raise_for_status()
+	answ = answ.json()
+
+	if action == "edit":
+		if answ["action"] != "editSuccess":
+			raise RowError("%s/edit/%s failed with errors: %s" % (args.module, key, format_errors(answ)))
+
+		# Later rows with the same value compare against the edited entry
+		if index is not None and args.skip_unchanged:
+			index.update(row[args.keyColumn], key, answ.get("values"))
+
+		return "updated", key, changes
+
+	if answ["action"] != "addSuccess":
+		raise RowError("%s/add failed with errors: %s" % (args.module, format_errors(answ)))
+
+	# Later rows with the same value update this entry
+	if index is not None:
+		index.add(row[args.keyColumn], answ["values"]["key"], answ["values"])
+
+	return "added", answ["values"]["key"], None
+
+
+def retry_delay(args, nr, attempt, e):
+	"""
+	Returns the seconds to wait before row nr is tried again after it failed with e, or None if it must not be.
+	"""
+	if isinstance(e, RowError) or attempt == args.retries:
+		return None
+
+	# Repeating an add which may have been stored could add the entity twice. With a key column, the
+	# next attempt looks the entity up on the server first.
+	if isinstance(e, AddFailed) and not args.keyColumn:
+		return None
+
+	delay = args.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+	logging.warning("Row %d failed (%s), retry %d/%d in %.1fs", nr, e, attempt + 1, args.retries, delay)
+	return delay
+
+
+def import_row(imp, args, index, row, lookup=False):
+	"""
+	Add or update the entity of one row, looking up existing entities in index or, without one, on the server.
+
+	With lookup, the key column value is looked up on the server even with an index.
+
+	Returns a tuple of the action ("added", "updated", "unchanged" or "skipped"), the entity key and, with
+	--skip-unchanged, the changes of an updated entity.
+	"""
+	answ = None
+	if args.keyColumn and (index is None or lookup):
+		answ = imp.list(args.module, **{args.keyColumn: row[args.keyColumn]})
+
+	action, key, changes = plan_row(args, index, row, answ, lookup)
+	if action not in ("add", "edit"):
+		return action, key, changes
+
+	try:
+		answ = imp.secure_post("%s/%s" % (args.module, action), row)
+		return apply_answer(args, index, row, action, key, changes, answ)
+	except Exception as e:
+		raise request_failed(action, e)
+
+
+def import_row_with_retry(imp, args, index, nr, row):
+	"""
+	Run import_row, retrying failed requests with exponential backoff.
+	"""
+	lookup = False
+
+	for attempt in range(args.retries + 1):
+		try:
+			return import_row(imp, args, index, dict(row), lookup)
+
+		except Exception as e:
+			delay = retry_delay(args, nr, attempt, e)
+			if delay is None:
+				raise
+
+			lookup = lookup or isinstance(e, AddFailed)
+			time.sleep(delay)
+
+
+async def import_row_async(imp, args, index, row, lookup=False):
+	"""
+	Coroutine counterpart of import_row for an AsyncImporter.
+	"""
+	answ = None
+	if args.keyColumn and (index is None or lookup):
+		answ = await imp.list(args.module, **{args.keyColumn: row[args.keyColumn]})
+
+	action, key, changes = plan_row(args, index, row, answ, lookup)
+	if action not in ("add", "edit"):
+		return action, key, changes
+
+	try:
+		answ = await imp.secure_post("%s/%s" % (args.module, action), row)
+		return apply_answer(args, index, row, action, key, changes, answ)
+	except Exception as e:
+		raise request_failed(action, e)
+
+
+async def import_row_with_retry_async(imp, args, index, nr, row):
+	"""
+	Coroutine counterpart of import_row_with_retry for an AsyncImporter.
+	"""
+	lookup = False
+
+	for attempt in range(args.retries + 1):
+		try:
+			return await import_row_async(imp, args, index, dict(row), lookup)
+
+		except Exception as e:
+			delay = retry_delay(args, nr, attempt, e)
+			if delay is None:
+				raise
+
+			lookup = lookup or isinstance(e, AddFailed)
+			await asyncio.sleep(delay)
+
+
 if __name__ == "__main__":
 	ap = argparse.ArgumentParser(description="csv2viur - Generic CSV importer for ViUR.")
 
@@ -112,81 +867,278 @@ if __name__ == "__main__":
 	ap.add_argument("-l", "--loginkey", type=str, help="LoginKey")
 	ap.add_argument("-e", "--expression", metavar=("column", "expression"), action="append", nargs=2, type=str,
 					help="Define additional field expression")
+	ap.add_argument("-b", "--batch-size", default=500, type=int, help="Number of rows the expressions are evaluated on at once")
+	ap.add_argument("-j", "--jobs", default=1, type=int, help="Number of rows imported concurrently")
+	ap.add_argument("--async", action="store_true", dest="use_async", help="Import the --jobs rows from one event loop instead of a thread each (requires aiohttp)")
+	ap.add_argument("-r", "--rate", type=float, help="Maximum number of requests per second")
+	ap.add_argument("--retries", default=3, type=int, help="Retries of a row after failed requests")
+	ap.add_argument("--backoff", default=1.0, type=float, help="Seconds to wait before the first retry, doubled for every further one")
+	ap.add_argument("--no-key-index", action="store_true", help="Look up every key column value on the server instead of indexing the module up front")
+	ap.add_argument("--index-db", type=str, help="Keep the key index in this SQLite file instead of in memory, for huge modules")
+	ap.add_argument("--rebuild-index", action="store_true", help="Replace an existing --index-db file")
+	ap.add_argument("--resume", action="store_true", help="Continue an interrupted import after the last row recorded in <filename>.journal")
+	ap.add_argument("--chunk-size", default=1024 * 1024, type=int, help="Bytes read from the CSV-File at once")
+	ap.add_argument("--skip-unchanged", action="store_true", help="Only edit entries differing from their row, requires --update and --key-column")
+	ap.add_argument("--diff-report", type=str, help="CSV-File receiving the changed fields of every edited entry, with --skip-unchanged")
+	ap.add_argument("--rejects", type=str, help="CSV-File receiving the failed rows (<filename>.rejects.csv by default)")
 
 	args = ap.parse_args()
 	#print(args)
 
-	imp = Importer(args.connect, args.username, args.password, args.loginkey, render="vi")
+	if args.skip_unchanged and not (args.updateEntry and args.keyColumn):
+		ap.error("--skip-unchanged requires --update and --key-column")
 
-	if not args.module:
-		args.module = os.path.splitext(args.filename)[0]
-
-	reader = csv.DictReader(open(args.filename, "r"), delimiter=args.delimiter)
+	if args.diff_report and not args.skip_unchanged:
+		ap.error("--diff-report requires --skip-unchanged")
 
-	added = 0
-	updated = 0
+	if args.index_db and os.path.exists(args.index_db) and not args.rebuild_index:
+		ap.error("%s already exists, pass --rebuild-index to replace it" % args.index_db)
 
 	vil = logics.Interpreter()
 	#vil.functions["lookup"] = logics.Function(imp.logic_lookup, None)
 	#vil.functions["csvlookup"] = logics.Function(imp.logic_lookup, None)
 
-	rules = {}
+	try:
+		pipeline = ExpressionPipeline(vil, args.expression)
+	except ValueError as e:
+		logging.error("%s", e)
+		sys.exit(1)
 
-	for row in reader:
-		key = None
+	if args.use_async:
+		imp = AsyncImporter(args.connect, args.username, args.password, args.loginkey,
+							rate_limit=TokenBucket(args.rate) if args.rate else None, jobs=args.jobs)
+	else:
+		imp = Importer(args.connect, args.username, args.password, args.loginkey, render="vi",
+					   rate_limit=TokenBucket(args.rate) if args.rate else None, pool_size=max(10, args.jobs + 2))
 
-		if args.expression:
-			for i, expr in enumerate(args.expression):
-				#print(expr[0], expr[1], row.get(expr[0]))
-				field = expr[0]
+	if not args.module:
+		args.module = os.path.splitext(args.filename)[0]
 
-				if field not in rules:
-					rules[(field, i)] = vil.compile(expr[1])
+	if not args.rejects:
+		args.rejects = os.path.splitext(args.filename)[0] + ".rejects.csv"
 
-				row[field] = vil.execute(rules[(field, i)], row)
-				#print("=", row[field])
+	counters = {"added": 0, "updated": 0, "unchanged": 0, "skipped": 0, "failed": 0}
+	nr = 0
 
-		if args.keyColumn:
-			if args.keyColumn not in reader.fieldnames:
-				logging.error("Key field '%s' does not exist in %s." % (args.keyColumn, args.filename))
-				sys.exit(1)
+	csv_file = open(args.filename, "rb", buffering=args.chunk_size)
+	reader = OffsetReader(csv_file, args.delimiter)
 
-			answ = imp.list(args.module, **{args.keyColumn: row[args.keyColumn]})
+	if not reader.fieldnames:
+		logging.error("%s is empty." % args.filename)
+		sys.exit(1)
 
-			if len(answ["skellist"]) == 1:
-				key = answ["skellist"][0]["key"]
+	journal = Journal(args.filename, args.module, reader.fieldnames)
 
-				if not args.updateEntry:
-					logging.info("Entry %s exists and will not be updated." % row[args.keyColumn])
-					continue
+	if args.resume:
+		try:
+			state = journal.load()
+		except (OSError, ValueError) as e:
+			logging.error("Unable to resume: %s", e)
+			sys.exit(1)
 
-			elif len(answ["skellist"]) > 1:
-				logging.error("Multiple matches on '%s'? IMPOSSIBLE!!" % row[args.keyColumn])
-				continue
+		nr = state["row"]
+		counters.update(state["counters"])
 
-		row["skey"] = imp.skey()
+		csv_file.seek(state["offset"])
+		reader = OffsetReader(csv_file, args.delimiter, reader.fieldnames)
+		logging.info("Resuming after row %d", nr)
 
-		if key:
-			row["key"] = key
-			answ = imp.post(args.module + "/edit", data=row).json()
+	if args.keyColumn and args.keyColumn not in reader.fieldnames:
+		logging.error("Key field '%s' does not exist in %s." % (args.keyColumn, args.filename))
+		sys.exit(1)
 
-			if answ["action"] != "editSuccess":
-				logging.error(
-					"%s/edit/%s failed with errors: %s", args.module, key,
-					", ".join([("%s=%s: %s" % (bone, answ["values"][bone], struct["error"]))
-							   for bone, struct in answ["structure"] if struct["error"]])
-				)
-				continue
+	index = None
+	if args.keyColumn and not args.no_key_index:
+		start = time.time()
+		fields = None
+		if args.skip_unchanged:
+			fields = list(reader.fieldnames) + [rule.field for rule in pipeline.rules]
+
+		index = KeyIndex(args.index_db, fields, args.rebuild_index)
+		index.build(imp, args.module, args.keyColumn)
+		logging.info("Indexed %d entries of %s by %s in %.1fs", index.size, args.module, args.keyColumn, time.time() - start)
+
+	rejects_file = rejects = None
+	committed = None
+
+	diff_file = diff = None
+	if args.diff_report:
+		append = args.resume and os.path.exists(args.diff_report)
+		diff_file = open(args.diff_report, "a" if append else "w", newline="")
+		diff = csv.writer(diff_file, delimiter=args.delimiter)
+		if not append:
+			diff.writerow(["row", "key", "field", "current", "new"])
+
+	def finish(nr, offset, original, row, future):
+		"""
+		Handles the result of a row; the row stays pending until this returned, so an interruption redoes it.
+		"""
+		global committed
+
+		handle_result(nr, original, row, future)
+		release(nr, row)
+
+		# Rows are finished in file order, so everything up to here is done
+		committed = (offset, nr)
+		if nr % args.batch_size == 0:
+			commit()
+
+	def handle_result(nr, original, row, future):
+		global rejects_file, rejects
+
+		try:
+			action, key, changes = future.result()
+
+		except Exception as e:
+			logging.error("Row %d failed: %s", nr, e)
+			counters["failed"] += 1
+
+			if rejects is None:
+				append = args.resume and os.path.exists(args.rejects)
+				rejects_file = open(args.rejects, "a" if append else "w", newline="")
+				rejects = csv.DictWriter(rejects_file, reader.fieldnames + ["error"], delimiter=args.delimiter,
+										 extrasaction="ignore")
+				if not append:
+					rejects.writeheader()
 
-			logging.info("%r updated successfully", key)
-			updated += 1
+			rejects.writerow(dict(original, error=str(e)))
+			return
+
+		counters[action] += 1
+
+		if action == "skipped":
+			logging.info("Entry %s exists and will not be updated." % row[args.keyColumn])
+		elif action == "unchanged":
+			logging.info("Entry %s is unchanged." % row[args.keyColumn])
 		else:
-			answ = imp.post(args.module + "/add", data=row).json()
+			if diff and changes:
+				for field, current, value in changes:
+					diff.writerow([nr, key, field, current if isinstance(current, str) else json.dumps(current), value])
+
+			logging.info("%r %s successfully", key, "created" if action == "added" else action)
+
+	def commit():
+		if committed:
+			# The rejects of all committed rows must be on disk before the journal skips them
+			if rejects_file:
+				rejects_file.flush()
+
+			if diff_file:
+				diff_file.flush()
+
+			journal.save(committed[0], committed[1], counters)
+
+	# Rows are imported by the workers, but their results are handled in file order
+	pending = deque()
+	validated = False
+
+	# Rows sharing a key column value are imported one after another, or each of them would add the entity.
+	# Holds the rows of every value in flight, the first one is being imported, the others wait for it.
+	waiting = {}
+
+	def submit(nr, row):
+		if not args.keyColumn:
+			return executor.submit(import_job, imp, args, index, nr, row)
+
+		queued = waiting.setdefault(row[args.keyColumn], deque())
+		future = Future() if queued else executor.submit(import_job, imp, args, index, nr, row)
+		queued.append((future, nr, row))
+		return future
+
+	def release(nr, row):
+		"""
+		Starts the next row waiting for row nr, which is finished.
+		"""
+		queued = waiting.get(row[args.keyColumn]) if args.keyColumn else None
+		if not queued or queued[0][1] != nr:
+			return
+
+		queued.popleft()
+		if not queued:
+			del waiting[row[args.keyColumn]]
+			return
+
+		future, nr, row = queued[0]
+		try:
+			chain(executor.submit(import_job, imp, args, index, nr, row), future)
+		except RuntimeError:
+			# The executor was shut down by an interruption
+			future.cancel()
+
+	if args.use_async:
+		executor, import_job = imp, import_row_with_retry_async
+	else:
+		executor, import_job = ThreadPoolExecutor(args.jobs), import_row_with_retry
+
+	try:
+		for batch in read_batches(reader, args.batch_size):
+			offsets = [offset for offset, row in batch]
+			batch = [row for offset, row in batch]
+			originals = [dict(row) for row in batch]
+			errors = [None] * len(batch)
+
+			if pipeline.rules:
+				if not validated:
+					try:
+						pipeline.validate(batch[0])
+					except ValueError as e:
+						logging.error("%s", e)
+						sys.exit(1)
+
+					validated = True
+
+				errors = pipeline.apply(batch)
+
+			for offset, original, row, error in zip(offsets, originals, batch, errors):
+				nr += 1
+
+				if error:
+					future = Future()
+					future.set_exception(RowError(error))
+				else:
+					future = submit(nr, row)
+
+				pending.append((nr, offset, original, row, future))
+
+				while len(pending) > args.jobs * 2:
+					finish(*pending[0])
+					pending.popleft()
+
+		while pending:
+			finish(*pending[0])
+			pending.popleft()
+
+	except KeyboardInterrupt:
+		# Finish the rows already being imported, so the journal covers them
+		executor.shutdown(cancel_futures=True)
+
+		while pending and not pending[0][-1].cancelled():
+			finish(*pending[0])
+			pending.popleft()
+
+		commit()
+		logging.info("Interrupted after row %d, continue with --resume", committed[1] if committed else nr)
+		sys.exit(130)
+
+	executor.shutdown()
+	journal.remove()
+
+	pipeline.report()
+	logging.info("%(added)d added, %(updated)d updated, %(unchanged)d unchanged, %(skipped)d skipped, %(failed)d failed",
+				 counters)
+
+	if index is not None:
+		index.close()
+
+	if rejects_file:
+		rejects_file.close()
 
-			if answ["action"] == "addSuccess":
-				logging.info("%r created successfully", answ["values"]["key"])
-				added += 1
+	if diff_file:
+		diff_file.close()
+		logging.info("Changes were written to %s", args.diff_report)
 
-		#break
+	csv_file.close()
 
-	logging.info("%d added, %d updated", added, updated)
+	if counters["failed"]:
+		logging.error("Failed rows were written to %s", args.rejects)
+		sys.exit(1)
@@ -1,20 +1,29 @@
-import re, json, requests, sys, argparse, logging, os
+import re, json, requests, sys, argparse, logging, os, queue, threading, time, sqlite3, hashlib, shutil, asyncio
+from viur_async import AsyncViurClient
+from viur_skey import SkeyPool
 
 root = logging.getLogger()
 root.setLevel(logging.INFO)
 
 class Exporter(requests.Session):
-    def __init__(self, host, username=None, password=None, loginKey=None, render="json"):
+    def __init__(self, host, username=None, password=None, loginKey=None, render="json", pool_size=10):
         super().__init__()
         self.render = render
         self.host = host
 
+        # Keep a connection per worker alive
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
         self.username = username
         self.password = password
         self.loginKey = loginKey
 
         assert (self.username and self.password) or self.loginKey
 
+        self.skeys = SkeyPool(self.fetch_skey)
+
         if not self.login():
             raise IOError("Unable to logon to '%s'" % self.host)
 
@@ -25,7 +34,7 @@ class Exporter(requests.Session):
                 data={
                     "name": self.username,
                     "password": self.password,
-                    "skey": self.skey()
+                    "skey": self.fetch_skey()
                 },
                 timeout=30)
         else:
@@ -33,10 +42,13 @@ class Exporter(requests.Session):
                 "/user/auth_loginkey/login",
                 data={
                     "key": self.loginKey,
-                    "skey": self.skey()
+                    "skey": self.fetch_skey()
                 },
                 timeout=30)
 
+        # The session has changed, skeys of the anonymous session are useless now
+        self.skeys.invalidate()
+
         if not answ.status_code == 200:
             logging.error("Unable to logon to '%s'" % self.host)
             return False
@@ -54,11 +66,22 @@ class Exporter(requests.Session):
         return True
 
     def logout(self):
-        return self.get("/user/logout", params={"skey": self.skey()}, timeout=10).json()
+        res = self.get("/user/logout", params={"skey": self.fetch_skey()}, timeout=10).json()
+        self.skeys.close()
+        return res
 
     def skey(self):
+        return self.skeys.get()
+
+    def fetch_skey(self):
         return self.get("/skey", timeout=15).json()
 
+    def secure_post(self, url, data, *args, **kwargs):
+        """
+        POST data with a pooled skey, retrying with a fresh one when the server rejects it.
+        """
+        return self.skeys.retry(lambda skey: self.post(url, data=dict(data, skey=skey), *args, **kwargs))
+
     def get(self, url, *args, **kwargs):
         if url.startswith("/"):
             url = url[1:]
@@ -73,6 +96,647 @@ class Exporter(requests.Session):
         logging.debug("POST %s %s" % ("/".join([self.host, self.render, url]), kwargs))
         return super().post("/".join([self.host, self.render, url]), *args, **kwargs)
 
+    def list_tree(self, kind, node_key, amount=99):
+        """
+        Yields the leafs or nodes of a folder, following the cursor page by page.
+        """
+        cursor = None
+
+        while True:
+            params = {"amount": amount}
+            if cursor:
+                params["cursor"] = cursor
+
+            answ = self.get("/file/list/%s/%s" % (kind, node_key), params=params, timeout=60)
+            answ.raise_for_status()
+            answ = answ.json()
+
+            if not answ["skellist"]:
+                break
+
+            yield from answ["skellist"]
+
+            cursor = answ.get("cursor")
+            if not cursor:
+                break
+
+
+class Manifest(object):
+    """
+    Records the downloaded files of a target folder in a SQLite file, so a sync only fetches what changed.
+
+    Every file is recorded with its dlkey, size and change date as listed by the server, the SHA-256 of its
+    content and whether it was downloaded completely. Changes are committed in batches.
+    """
+    def __init__(self, filename, commit_every=100):
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        # Entries not seen since this run started vanished from the server
+        self.run = time.time()
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dlkey TEXT NOT NULL, size TEXT, "
+                        "changedate TEXT, hash TEXT, complete INTEGER NOT NULL, seen REAL NOT NULL)")
+        self.db.commit()
+
+    def execute(self, sql, params):
+        with self.lock:
+            self.db.execute(sql, params)
+            self.uncommitted += 1
+
+            if self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def get(self, path):
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE path = ?", (path, )).fetchone()
+
+    def is_unchanged(self, path, file, filename):
+        entry = self.get(path)
+
+        return bool(entry and entry["complete"] and entry["dlkey"] == file["dlkey"]
+                    and entry["size"] == str(file.get("size")) and entry["changedate"] == file.get("changedate")
+                    and os.path.isfile(filename) and str(os.path.getsize(filename)) == entry["size"])
+
+    def is_partial(self, path, file):
+        entry = self.get(path)
+        return bool(entry and not entry["complete"] and entry["dlkey"] == file["dlkey"])
+
+    def start(self, path, file):
+        self.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL, 0, ?)",
+                     (path, file["dlkey"], str(file.get("size")), file.get("changedate"), self.run))
+
+    def finish(self, path, content_hash):
+        self.execute("UPDATE files SET hash = ?, complete = 1, seen = ? WHERE path = ?",
+                     (content_hash, self.run, path))
+
+    def mark_seen(self, path):
+        self.execute("UPDATE files SET seen = ? WHERE path = ?", (self.run, path))
+
+    def vanished(self):
+        with self.lock:
+            return [row["path"] for row in self.db.execute("SELECT path FROM files WHERE seen < ?", (self.run, ))]
+
+    def remove(self, path):
+        self.execute("DELETE FROM files WHERE path = ?", (path, ))
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class ContentStore(object):
+    """
+    Content-addressed store holding every distinct file content once, below the target folder.
+
+    Contents are kept as objects/<sha256>, and index.db records the content of every downloaded dlkey, so a
+    dlkey occurring in several folders is fetched only once. The files of the tree are hardlinks or
+    reflinks to the objects, falling back to copies where the filesystem supports neither.
+    """
+    def __init__(self, directory, link="hardlink", commit_every=100):
+        assert link in ("hardlink", "reflink")
+
+        self.directory = directory
+        self.link = link
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+        self.lock = threading.Lock()
+        self.linked = 0
+        self.duplicates = 0
+
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+
+        self.db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS dlkeys (dlkey TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        self.db.commit()
+
+    def object_path(self, content_hash):
+        return os.path.join(self.directory, "objects", content_hash[:2], content_hash)
+
+    def link_dlkey(self, dlkey, filename):
+        """
+        Links filename to the stored content of dlkey and returns its hash, or None if dlkey wasn't stored yet.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM dlkeys WHERE dlkey = ?", (dlkey, )).fetchone()
+
+        if not row:
+            return None
+
+        content_hash = row[0]
+        if not os.path.isfile(self.object_path(content_hash)):
+            return None
+
+        self.materialize(self.object_path(content_hash), filename)
+
+        with self.lock:
+            self.linked += 1
+
+        return content_hash
+
+    def add(self, filename, content_hash, dlkey, target_filename):
+        """
+        Moves the downloaded filename into the store, unless its content is stored already, and links
+        target_filename to it.
+        """
+        object_filename = self.object_path(content_hash)
+        os.makedirs(os.path.dirname(object_filename), exist_ok=True)
+
+        if os.path.isfile(object_filename):
+            os.remove(filename)
+
+            with self.lock:
+                self.duplicates += 1
+        else:
+            os.replace(filename, object_filename)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO dlkeys VALUES (?, ?)", (dlkey, content_hash))
+            self.uncommitted += 1
+
+            if self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+        self.materialize(object_filename, target_filename)
+
+    def materialize(self, object_filename, filename):
+        if os.path.lexists(filename):
+            os.remove(filename)
+
+        try:
+            if self.link == "hardlink":
+                os.link(object_filename, filename)
+            else:
+                clone_file(object_filename, filename)
+
+        except OSError as e:
+            # Another filesystem, too many links, or no reflink support
+            logging.debug("Copying %r, unable to %s it: %s", filename, self.link, e)
+            shutil.copyfile(object_filename, filename)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def clone_file(src, dst):
+    """
+    Creates dst as a copy-on-write clone of src, on filesystems supporting reflinks (Btrfs, XFS, ...).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflinks are not supported on this platform")
+
+    FICLONE = 0x40049409
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class TreeDownloader(object):
+    """
+    Downloads a file tree breadth-first.
+
+    Lister threads take folders from a work queue, create them locally, queue their subfolders and hand their
+    files to a pool of download workers, so listing and downloading overlap.
+
+    With a manifest, unchanged files are skipped and partially downloaded files are resumed. With a store, every
+    content is downloaded and stored once.
+    """
+    def __init__(self, downloader, jobs=8, listers=2, manifest=None, delete=False, page_size=99, store=None):
+        self.downloader = downloader
+        self.jobs = jobs
+        self.listers = listers
+        self.page_size = page_size
+        self.manifest = manifest
+        self.delete = delete
+        self.store = store
+        self.target = None
+
+        self.folders = queue.Queue()
+        # Bounded, so listing doesn't run arbitrarily far ahead of the downloads
+        self.files = queue.Queue(maxsize=jobs * 4)
+
+        self.lock = threading.Lock()
+        self.downloaded = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.size = 0
+        self.failed = 0
+
+    def list_folders(self):
+        while True:
+            node_key, target_folder = self.folders.get()
+
+            try:
+                logging.info("Folder %r", target_folder)
+                os.makedirs(target_folder, exist_ok=True)
+
+                # Files are handed on page by page, downloads start while the folder is still being listed
+                for file in self.downloader.list_tree("leaf", node_key, self.page_size):
+                    if file["dlkey"]:
+                        self.files.put((file, local_path(target_folder, file)))
+
+                for node in self.downloader.list_tree("node", node_key, self.page_size):
+                    self.folders.put((node["key"], local_path(target_folder, node)))
+
+            except Exception as e:
+                self.record_failure("Unable to list folder %r: %s", target_folder, e)
+
+            finally:
+                self.folders.task_done()
+
+    def download_files(self):
+        while True:
+            item = self.files.get()
+            if item is None:
+                break
+
+            file, target_filename = item
+
+            try:
+                size = self.download_file(file, target_filename)
+            except Exception as e:
+                self.record_failure("Unable to download %r: %s", target_filename, e)
+                continue
+
+            self.record(target_filename, size)
+
+    def record(self, target_filename, size):
+        with self.lock:
+            if size is None:
+                self.unchanged += 1
+                return
+
+            self.downloaded += 1
+            self.size += size
+
+        logging.info("File %r", target_filename)
+
+    def record_failure(self, message, name, e):
+        logging.error(message, name, e)
+
+        with self.lock:
+            self.failed += 1
+
+    def download_file(self, file, target_filename):
+        """
+        Downloads a file unless the manifest records it as unchanged, resuming a partial download by a Range
+        request, or links it to the content of its dlkey in the store. Returns the number of bytes transferred,
+        or None for an unchanged file.
+        """
+        todo = self.prepare(file, target_filename)
+        if todo is None:
+            return None
+
+        filename, offset = todo
+        if filename is None:
+            return 0
+
+        size, content_hash = self.fetch(file, filename, offset)
+        return self.complete(file, target_filename, filename, size, content_hash)
+
+    def prepare(self, file, target_filename):
+        """
+        Decides how to get a file. Returns None for an unchanged file, and otherwise the file name to download
+        to and the offset to resume at, or (None, 0) if the file was linked to the store.
+        """
+        path = None
+
+        if self.manifest is not None:
+            path = os.path.relpath(target_filename, self.target)
+
+            if self.manifest.is_unchanged(path, file, target_filename):
+                self.manifest.mark_seen(path)
+                return None
+
+        if self.store is not None:
+            content_hash = self.store.link_dlkey(file["dlkey"], target_filename)
+
+            if content_hash:
+                if path is not None:
+                    self.manifest.start(path, file)
+                    self.manifest.finish(path, content_hash)
+
+                return None, 0
+
+        if path is None:
+            return (target_filename + ".part" if self.store is not None else target_filename), 0
+
+        part_filename = target_filename + ".part"
+
+        if self.manifest.is_partial(path, file) and os.path.isfile(part_filename):
+            return part_filename, os.path.getsize(part_filename)
+
+        self.manifest.start(path, file)
+        return part_filename, 0
+
+    def complete(self, file, target_filename, filename, size, content_hash):
+        """
+        Moves the downloaded filename to target_filename or into the store and records it. Returns size.
+        """
+        if self.store is not None:
+            self.store.add(filename, content_hash, file["dlkey"], target_filename)
+        elif filename != target_filename:
+            os.replace(filename, target_filename)
+
+        if self.manifest is not None:
+            self.manifest.finish(os.path.relpath(target_filename, self.target), content_hash)
+
+        return size
+
+    def open_part(self, filename, offset):
+        """
+        Opens filename for a download and returns it with the SHA-256 of its content so far. With an offset, the
+        download continues a partial file.
+        """
+        content_hash = hashlib.sha256()
+
+        if not offset:
+            return open(filename, "wb"), content_hash
+
+        logging.info("Resuming %r at %d bytes", filename, offset)
+
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                content_hash.update(chunk)
+
+        return open(filename, "ab"), content_hash
+
+    def fetch(self, file, filename, offset=0):
+        """
+        Downloads file into filename, continuing after its first offset bytes if the server supports it.
+        Returns the number of bytes transferred and the SHA-256 of the complete content.
+        """
+        size = 0
+
+        r = self.downloader.get("/file/download/" + file["dlkey"], stream=True, timeout=60,
+                                headers={"Range": "bytes=%d-" % offset} if offset else None)
+
+        if offset and r.status_code == 416:
+            # The partial file is as large as the file, or larger; start over
+            r.close()
+            r = self.downloader.get("/file/download/" + file["dlkey"], stream=True, timeout=60)
+
+        with r:
+            r.raise_for_status()
+
+            f, content_hash = self.open_part(filename, offset if r.status_code == 206 else 0)
+
+            with f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+                    content_hash.update(chunk)
+                    size += len(chunk)
+
+        return size, content_hash.hexdigest()
+
+    def delete_vanished(self):
+        """
+        Deletes the local files recorded in the manifest which were not listed by the server anymore.
+        """
+        for path in self.manifest.vanished():
+            filename = os.path.join(self.target, path)
+
+            for name in (filename, filename + ".part"):
+                if os.path.isfile(name):
+                    os.remove(name)
+
+            self.manifest.remove(path)
+            self.deleted += 1
+            logging.info("Deleted %r", filename)
+
+    def run(self, root_key, target_folder):
+        """
+        Downloads the tree below root_key into target_folder and returns the number of failed folders and files.
+        """
+        start = time.time()
+        self.target = target_folder
+
+        workers = [threading.Thread(target=self.download_files, daemon=True) for _ in range(self.jobs)]
+        for worker in workers:
+            worker.start()
+
+        for _ in range(self.listers):
+            threading.Thread(target=self.list_folders, daemon=True).start()
+
+        self.folders.put((root_key, target_folder))
+        self.folders.join()
+
+        for _ in workers:
+            self.files.put(None)
+
+        for worker in workers:
+            worker.join()
+
+        return self.finish(start)
+
+    def finish(self, start):
+        """
+        Deletes the vanished files after a complete sync, logs the totals and returns the number of failures.
+        """
+        if self.delete:
+            # Files missing from an incomplete listing may still exist
+            if self.failed:
+                logging.warning("Not deleting vanished files after failures")
+            else:
+                self.delete_vanished()
+
+        duration = max(time.time() - start, 0.001)
+        logging.info("%d files, %.1f MiB in %.1fs (%.1f files/s, %.2f MiB/s), %d unchanged, %d deleted, %d failed",
+                     self.downloaded, self.size / 2 ** 20, duration, self.downloaded / duration,
+                     self.size / 2 ** 20 / duration, self.unchanged, self.deleted, self.failed)
+
+        if self.store is not None:
+            logging.info("Store: %d files linked by dlkey, %d duplicate contents", self.store.linked,
+                         self.store.duplicates)
+
+        return self.failed
+
+
+class AsyncTreeDownloader(TreeDownloader):
+    """
+    TreeDownloader using an AsyncViurClient, with the listers and download workers as tasks of one event loop
+    instead of threads.
+    """
+    async def list_tree(self, kind, node_key, amount=99):
+        """
+        Yields the leafs or nodes of a folder like Exporter.list_tree.
+        """
+        cursor = None
+
+        while True:
+            params = {"amount": amount}
+            if cursor:
+                params["cursor"] = cursor
+
+            answ = await self.downloader.request("/%s/file/list/%s/%s" % (self.downloader.render, kind, node_key),
+                                                 params=params, addSkey=False)
+            answ.raise_for_status()
+            answ = answ.json()
+
+            if not answ["skellist"]:
+                break
+
+            for skel in answ["skellist"]:
+                yield skel
+
+            cursor = answ.get("cursor")
+            if not cursor:
+                break
+
+    async def list_folders_async(self):
+        while True:
+            node_key, target_folder = await self.folders.get()
+
+            try:
+                logging.info("Folder %r", target_folder)
+                os.makedirs(target_folder, exist_ok=True)
+
+                async for file in self.list_tree("leaf", node_key, self.page_size):
+                    if file["dlkey"]:
+                        await self.files.put((file, local_path(target_folder, file)))
+
+                async for node in self.list_tree("node", node_key, self.page_size):
+                    await self.folders.put((node["key"], local_path(target_folder, node)))
+
+            except Exception as e:
+                self.record_failure("Unable to list folder %r: %s", target_folder, e)
+
+            finally:
+                self.folders.task_done()
+
+    async def download_files_async(self):
+        while True:
+            item = await self.files.get()
+            if item is None:
+                break
+
+            file, target_filename = item
+
+            try:
+                size = await self.download_file_async(file, target_filename)
+            except Exception as e:
+                self.record_failure("Unable to download %r: %s", target_filename, e)
+                continue
+
+            self.record(target_filename, size)
+
+    async def download_file_async(self, file, target_filename):
+        """
+        Coroutine counterpart of TreeDownloader.download_file.
+        """
+        todo = self.prepare(file, target_filename)
+        if todo is None:
+            return None
+
+        filename, offset = todo
+        if filename is None:
+            return 0
+
+        size, content_hash = await self.fetch_async(file, filename, offset)
+        return self.complete(file, target_filename, filename, size, content_hash)
+
+    async def fetch_async(self, file, filename, offset=0):
+        """
+        Coroutine counterpart of TreeDownloader.fetch.
+        """
+        path = "/%s/file/download/%s" % (self.downloader.render, file["dlkey"])
+
+        async with self.downloader.stream(path, headers={"Range": "bytes=%d-" % offset} if offset else None) as r:
+            if not (offset and r.status == 416):
+                return await self.write_async(r, filename, offset)
+
+        # The partial file is as large as the file, or larger; start over
+        async with self.downloader.stream(path) as r:
+            return await self.write_async(r, filename, 0)
+
+    async def write_async(self, r, filename, offset):
+        r.raise_for_status()
+        size = 0
+
+        f, content_hash = self.open_part(filename, offset if r.status == 206 else 0)
+
+        with f:
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                f.write(chunk)
+                content_hash.update(chunk)
+                size += len(chunk)
+
+        return size, content_hash.hexdigest()
+
+    def run(self, root_key, target_folder):
+        raise NotImplementedError("Use run_async within the event loop of the AsyncViurClient")
+
+    async def run_async(self, root_key, target_folder):
+        """
+        Coroutine counterpart of TreeDownloader.run.
+        """
+        start = time.time()
+        self.target = target_folder
+
+        self.folders = asyncio.Queue()
+        self.files = asyncio.Queue(maxsize=self.jobs * 4)
+
+        workers = [asyncio.ensure_future(self.download_files_async()) for _ in range(self.jobs)]
+        listers = [asyncio.ensure_future(self.list_folders_async()) for _ in range(self.listers)]
+
+        try:
+            await self.folders.put((root_key, target_folder))
+            await self.folders.join()
+
+            for _ in workers:
+                await self.files.put(None)
+
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + listers:
+                task.cancel()
+
+        return self.finish(start)
+
+
+def local_path(folder, entry):
+    return os.path.join(folder, entry["name"].replace("/", "-"))
+
+
+def find_root_node(root_nodes, repo):
+    """
+    Returns the key of the root node named repo, or None.
+    """
+    for root_node in root_nodes:
+        if root_node["name"] == repo:
+            return root_node["key"]
+
+    return None
+
+
+async def download_async(args, manifest, store):
+    """
+    Downloads the repo given on the command line with an AsyncViurClient. Returns the number of failures.
+    """
+    async with AsyncViurClient(args.connect, args.username, args.password, args.loginkey, render="vi",
+                               maxConcurrency=args.jobs + args.listers) as client:
+        answ = await client.request("/vi/file/listRootNodes", addSkey=False)
+        answ.raise_for_status()
+
+        root_key = find_root_node(answ.json(), args.repo)
+        if root_key is None:
+            raise LookupError("Cannot find repo named %r" % args.repo)
+
+        return await AsyncTreeDownloader(client, args.jobs, args.listers, manifest, args.delete, args.page_size,
+                                         store).run_async(root_key, args.target)
+
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser(description="download-files.py - Download file trees from a ViUR system to local filesystem")
@@ -85,46 +749,58 @@ if __name__ == "__main__":
     ap.add_argument("-u", "--username", type=str, help="Username")
     ap.add_argument("-p", "--password", type=str, help="Password")
     ap.add_argument("-l", "--loginkey", type=str, help="LoginKey")
+    ap.add_argument("-j", "--jobs", default=8, type=int, help="Number of files downloaded concurrently")
+    ap.add_argument("--listers", default=2, type=int, help="Number of folders listed concurrently")
+    ap.add_argument("--page-size", default=99, type=int, help="Number of files or folders listed per request")
+    ap.add_argument("-s", "--sync", action="store_true", help="Only download new and changed files, as recorded in <target>/.viur-manifest.db")
+    ap.add_argument("--delete", action="store_true", help="Delete local files which vanished on the server, with --sync")
+    ap.add_argument("--store", action="store_true", help="Keep every content once in <target>/.viur-store and link the files to it")
+    ap.add_argument("--link", choices=["hardlink", "reflink"], default="hardlink",
+                    help="How files are linked to the store; hardlinked files must not be modified in place")
+    ap.add_argument("--async", action="store_true", dest="use_async",
+                    help="List and download from one event loop instead of a thread each (requires aiohttp)")
 
     args = ap.parse_args()
     #print(args)
 
-    downloader = Exporter(args.connect, args.username, args.password, args.loginkey, render="vi")
+    if args.delete and not args.sync:
+        ap.error("--delete requires --sync")
 
-    # Retrieve key of root node
-    rootNodes = downloader.get("/file/listRootNodes").json()
-    rootNodeKey = None
-    for rootNode in rootNodes:
-        if rootNode["name"] == args.repo:
-            rootNodeKey = rootNode["key"]
-            break
+    if not args.use_async:
+        downloader = Exporter(args.connect, args.username, args.password, args.loginkey, render="vi",
+                              pool_size=args.jobs + args.listers)
 
-    if rootNodeKey is None:
-        logging.error("Cannot find repo named %r", args.repo)
-        sys.exit(1)
+        # Retrieve key of root node
+        rootNodeKey = find_root_node(downloader.get("/file/listRootNodes").json(), args.repo)
 
-    def download_folder(node_key, target_folder):
-        logging.info("Folder %r", target_folder)
-        os.makedirs(target_folder, exist_ok=True)
+        if rootNodeKey is None:
+            logging.error("Cannot find repo named %r", args.repo)
+            sys.exit(1)
 
-        # Files
-        for file in downloader.get("/file/list/leaf/" + node_key).json()["skellist"]:
-            if not file["dlkey"]:
-                continue
-
-            target_filename = os.path.join(target_folder, file["name"].replace("/", "-"))
-
-            with downloader.get("/file/download/" + file["dlkey"], stream=True) as r:
-                r.raise_for_status()
-                with open(target_filename, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
+    manifest = None
+    if args.sync:
+        os.makedirs(args.target, exist_ok=True)
+        manifest = Manifest(os.path.join(args.target, ".viur-manifest.db"))
 
-            logging.info("File %r", target_filename)
+    store = None
+    if args.store:
+        store = ContentStore(os.path.join(args.target, ".viur-store"), args.link)
 
-        # Folders
-        for node in downloader.get("/file/list/node/" + node_key).json()["skellist"]:
-            download_folder(node["key"], os.path.join(target_folder, node["name"].replace("/", "-")))
+    try:
+        if args.use_async:
+            failed = asyncio.run(download_async(args, manifest, store))
+        else:
+            failed = TreeDownloader(downloader, args.jobs, args.listers, manifest, args.delete,
+                                    args.page_size, store).run(rootNodeKey, args.target)
+    except LookupError as e:
+        logging.error("%s", e)
+        sys.exit(1)
+    finally:
+        if manifest is not None:
+            manifest.close()
 
+        if store is not None:
+            store.close()
 
-    download_folder(rootNodeKey, args.target)
+    if failed:
+        sys.exit(1)
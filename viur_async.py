@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Asyncio client for ViUR applications.
+
+AsyncViurClient offers the surface of the synchronous clients of viur_csv_exporter.py,
+csvimport.py and download-files.py (request, list, view, login/logout and pooled skeys), but
+keeps many requests in flight from a single thread. The number of concurrent requests is
+limited by a semaphore, and connections are kept alive in a pool shared by all of them.
+
+Requires aiohttp.
+
+Example:
+
+	async with AsyncViurClient("https://example.appspot.com", "user", "secret", maxConcurrency=20) as client:
+		views = await asyncio.gather(*(client.view("person", key) for key in keys))
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple, Union
+
+try:
+	import aiohttp
+except ImportError:
+	aiohttp = None
+
+from viur_skey import AsyncSkeyPool
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse(NamedTuple):
+	"""A completely read response, usable like the parts of requests.Response the scripts rely on."""
+	status_code: int
+	headers: Dict[str, str]
+	content: bytes
+	url: str
+
+	@property
+	def ok(self) -> bool:
+		return self.status_code < 400
+
+	@property
+	def text(self) -> str:
+		return self.content.decode("utf-8", "replace")
+
+	def json(self) -> Any:
+		return json.loads(self.content)
+
+	def raise_for_status(self) -> None:
+		if not self.ok:
+			raise IOError("%d error for url %s" % (self.status_code, self.url))
+
+
+def encodeParams(params: Union[None, Dict[str, Any]]) -> Optional[List[Tuple[str, str]]]:
+	"""Flatten params like requests does, multiple values become repeated keys."""
+	if params is None:
+		return None
+
+	result = []
+	for key, value in params.items():
+		for item in value if isinstance(value, (list, tuple)) else [value]:
+			if item is not None:
+				result.append((key, str(item)))
+
+	return result
+
+
+class AsyncViurClient(object):
+	"""
+	:param host: URL of the ViUR application
+	:param user: Username for auth_userpassword
+	:param password: Password for auth_userpassword
+	:param loginKey: Key for auth_loginkey, instead of user and password
+	:param render: The render to talk to, "vi" or "json"
+	:param maxConcurrency: Maximum number of requests in flight
+	:param poolSize: Maximum number of kept-alive connections, defaults to maxConcurrency
+	:param skeyBatchSize: Amount of skeys kept in stock
+	:param timeout: Total timeout of a request in seconds
+	"""
+
+	def __init__(self, host: str, user: Optional[str] = None, password: Optional[str] = None,
+				 loginKey: Optional[str] = None, render: str = "vi", maxConcurrency: int = 10,
+				 poolSize: Optional[int] = None, skeyBatchSize: int = 10, timeout: float = 60):
+		if aiohttp is None:
+			raise ImportError("AsyncViurClient requires aiohttp, please install it (pip install aiohttp)")
+
+		assert (user and password) or loginKey
+		assert maxConcurrency > 0
+
+		self.host = host.rstrip("/")
+		self.user = user
+		self.password = password
+		self.loginKey = loginKey
+		self.render = render
+		self.maxConcurrency = maxConcurrency
+		self.poolSize = poolSize or maxConcurrency
+		self.timeout = timeout
+
+		self.session = None
+		self.semaphore = None
+		self.skeys = AsyncSkeyPool(self.getSkey, batchSize=skeyBatchSize)
+
+	async def __aenter__(self) -> "AsyncViurClient":
+		await self.open()
+		return self
+
+	async def __aexit__(self, exception, value, tb):
+		await self.close()
+		return False
+
+	async def open(self) -> None:
+		"""Open the connection pool and login."""
+		self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+		self.session = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(limit=self.poolSize),
+			timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+		await self._doLogin()
+
+	async def close(self) -> None:
+		"""Logout and close the connection pool."""
+		if self.session is None:
+			return
+
+		try:
+			await self.logout()
+		finally:
+			await self.session.close()
+			self.session = None
+
+	async def _doLogin(self) -> None:
+		if self.user and self.password:
+			path = f"/{self.render}/user/auth_userpassword/login"
+			data = {"name": self.user, "password": self.password}
+		else:
+			path = f"/{self.render}/user/auth_loginkey/login"
+			data = {"key": self.loginKey}
+
+		response = await self.request(path, data=data, params={"skey": await self.getSkey()},
+									  method="POST", addSkey=False)
+
+		# The session has changed, skeys of the anonymous session are useless now
+		self.skeys.invalidate()
+
+		if not response.ok:
+			raise IOError("Unable to logon to '%s'" % self.host)
+
+		assert (await self.request(f"/{self.render}/user/view/self", addSkey=False)).ok, "Login was not successful"
+
+	def url(self, path: str) -> str:
+		if path.startswith("/"):
+			return "".join((self.host, path))
+
+		return path
+
+	async def request(self, path: str, data: Union[Dict, None] = None,
+					  params: Union[Dict, None] = None,
+					  method: str = "GET", addSkey: bool = True,
+					  **kwargs) -> AsyncResponse:
+		"""Perform a request once a slot of the concurrency limit is free.
+
+		:param path: Path relative to the host, or a full URL
+		:param data: Form data for POST requests
+		:param params: Query parameters
+		:param method: The HTTP method
+		:param addSkey: Add a pooled skey to the params, and retry with a fresh one if it is rejected
+		"""
+		url = self.url(path)
+
+		if not addSkey:
+			return await self._send(method, url, params, data, **kwargs)
+
+		params = dict(params or {})
+
+		async def doRequest(skey: str) -> AsyncResponse:
+			params["skey"] = skey
+			return await self._send(method, url, params, data, **kwargs)
+
+		return await self.skeys.retry(doRequest)
+
+	async def _send(self, method: str, url: str, params: Union[Dict, None], data: Union[Dict, None],
+					**kwargs) -> AsyncResponse:
+		async with self.semaphore:
+			logger.debug("Do request: method=%r, url=%r, params=%r, data=%r", method, url, params, data)
+
+			async with self.session.request(method, url, params=encodeParams(params), data=encodeParams(data),
+											**kwargs) as response:
+				return AsyncResponse(response.status, dict(response.headers), await response.read(), str(response.url))
+
+	async def getSkey(self) -> str:
+		return (await self._send("POST", self.url(f"/{self.render}/skey"), None, None)).json()
+
+	async def listPages(self, module: str, params: Union[None, Dict] = None,
+						stats: Any = None) -> AsyncIterator[Dict[str, Any]]:
+		"""Yield the raw list responses of a module page by page.
+
+		:param module: The module name
+		:param params: Params for list request, e.g. filter or ordering
+		:param stats: Count the pages, bytes and request times here, e.g. an ExportStats of viur_csv_exporter.py
+		"""
+		params = dict(params or {})
+
+		while True:
+			start = time.perf_counter()
+			response = await self.request(f"/{self.render}/{module}/list", params=params, addSkey=False)
+			received = time.perf_counter()
+
+			assert response.ok, (response.status_code, response.content)
+			size = len(response.content)
+			response = response.json()
+
+			if stats:
+				stats.addPage(received - start, time.perf_counter() - received, size)
+
+			params["cursor"] = response["cursor"]
+
+			if not response["skellist"]:
+				break
+
+			yield response
+
+			if not response["cursor"]:
+				break
+
+	async def list(self, module: str, params: Union[None, Dict] = None) -> AsyncIterator[Dict[str, Any]]:
+		async for page in self.listPages(module, params):
+			for skel in page["skellist"]:
+				yield skel
+
+	async def view(self, module: str, key: str, **kwargs) -> AsyncResponse:
+		return await self.request(f"/{self.render}/{module}/view/{key}", addSkey=False, **kwargs)
+
+	async def getModules(self, handlers: Tuple[str, ...] = ("list",)) -> List[str]:
+		"""Return the names of all modules of the application with one of the given handler types.
+
+		:param handlers: Handler types to include, e.g. "list", "hierarchy", "tree" or "singleton"
+		"""
+		response = await self.request(f"/{self.render}/config", addSkey=False)
+		assert response.ok, (response.status_code, response.content)
+
+		return sorted(name for name, module in response.json()["modules"].items()
+					  if str(module.get("handler", "")).split(".")[0] in handlers)
+
+	@contextlib.asynccontextmanager
+	async def stream(self, path: str, method: str = "GET", **kwargs) -> AsyncIterator["aiohttp.ClientResponse"]:
+		"""Send a request and yield the aiohttp response before its body is read, e.g. to stream a download.
+
+		The request counts against maxConcurrency until the context is left. Its timeout applies to connecting
+		and to every read instead of the whole transfer.
+
+		:param path: Path relative to the host, or a full URL
+		:param method: The HTTP method
+		"""
+		kwargs.setdefault("timeout", aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout))
+
+		async with self.semaphore:
+			async with self.session.request(method, self.url(path), **kwargs) as response:
+				yield response
+
+	async def download(self, path: str, fileName: str, chunkSize: int = 64 * 1024, **kwargs) -> int:
+		"""Stream a file download to fileName without holding it in memory and return its size.
+
+		:param path: Path relative to the host, or a full URL
+		:param fileName: The target file
+		:param chunkSize: Size of the chunks read from the connection
+		"""
+		size = 0
+
+		async with self.stream(path, **kwargs) as response:
+			response.raise_for_status()
+
+			with open(fileName, "wb") as f:
+				async for chunk in response.content.iter_chunked(chunkSize):
+					f.write(chunk)
+					size += len(chunk)
+
+		return size
+
+	async def logout(self) -> bool:
+		try:
+			return (await self.request(f"/{self.render}/user/logout")).ok
+		finally:
+			self.skeys.close()
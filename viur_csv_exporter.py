@@ -5,18 +5,44 @@ __email__ = "se@mausbrand.de"
 __version__ = "1.1.0"
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import copy
 import csv
-import functools
+import gzip
+import hashlib
+import io
 import itertools
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import re
+import shutil
 import sys
 import threading
 import time
-from datetime import datetime
-from typing import Any, Dict, Iterator, List, Optional, Union
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 import requests
 
+from viur_async import AsyncViurClient
+from viur_skey import SkeyPool
+
+try:
+	import pyarrow
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
 logging.basicConfig(
 	format=f"%(asctime)s %(levelname)8s %(filename)s:%(lineno)03d :: %(message)s")
 logger = logging.getLogger(__name__)
@@ -120,40 +146,500 @@ def formatString(format, data, structure=None, prefix=None, language=None, _rec=
 	return res
 
 
-class Spinner(object):
-	run = False
-	DELAY = 0.15
+# Formats of date values rendered by ViUR; None stands for ISO 8601
+DATE_FORMATS = (None, "%d.%m.%Y %H:%M:%S", "%d.%m.%Y")
 
-	def runner(self):
-		chars = itertools.cycle([".  ", ".. ", "...", " ..", "  .", "   ",
-								 "  .", " ..", "...", ".. ", ".  ", "   "])
 
+def parseDate(value: str) -> Tuple[datetime, Optional[str]]:
+	"""Parse a date value rendered by ViUR and return it together with its entry of DATE_FORMATS."""
+	for dateFormat in DATE_FORMATS:
+		try:
+			if dateFormat is None:
+				return datetime.fromisoformat(value), dateFormat
+
+			return datetime.strptime(value, dateFormat), dateFormat
+		except ValueError:
+			continue
+
+	raise ValueError(f"Unknown date format of {value!r}")
+
+
+def formatDate(value: datetime, dateFormat: Optional[str]) -> str:
+	"""Render a date in one of DATE_FORMATS, the inverse of parseDate."""
+	return value.isoformat() if dateFormat is None else value.strftime(dateFormat)
+
+
+class _LegacyFormat(Exception):
+	"""Raised by CompiledFormat when a value can only be rendered by formatString."""
+
+
+class _FormatNode(object):
+	"""One path level of a CompiledFormat; placeholder is set when "$(path)" itself is referenced."""
+	__slots__ = ("placeholder", "children")
+
+	def __init__(self):
+		self.placeholder = None
+		self.children = {}
+
+
+class CompiledFormat(object):
+	"""
+	A format string of formatString, parsed once for a given structure.
+
+	The placeholders are parsed into a tree of referenced paths, so rendering only looks at
+	the referenced values of data. Structure lists and select values are converted to dicts
+	only once. The output is identical to formatString(format, data, structure, language=language);
+	the rare inputs where the sequential replacing of formatString makes a difference (values
+	containing placeholder syntax, relational bones without relskel) are rendered by
+	formatString itself.
+	"""
+
+	PLACEHOLDER = re.compile(r"\$\(([^)]*)\)")
+
+	def __init__(self, format: str, structure: Union[Dict, List, None] = None):
+		self.format = format
+		self.structure = structure
+
+		self.segments = []  # (literal text, placeholder or None)
+		self.root = _FormatNode()
+		self.legacy = False
+
+		self._dicts = {}
+		self._subFormats = {}
+
+		pos = 0
+		for match in self.PLACEHOLDER.finditer(format):
+			placeholder = match.group(0)
+			self.segments.append((format[pos:match.start()], placeholder))
+			pos = match.end()
+
+			if "$(" in match.group(1):
+				self.legacy = True
+
+			node = self.root
+			for part in match.group(1).split("."):
+				node = node.children.setdefault(part, _FormatNode())
+
+			node.placeholder = placeholder
+
+		self.segments.append((format[pos:], None))
+
+		# "$(" in the format which is not part of a placeholder
+		self.markers = format.count("$(") - len(self.segments) + 1
+
+		# The result for a relational value only depends on the referenced entity
+		self.destOnly = not self.legacy and set(self.root.children) <= {"dest"}
+
+	def render(self, data: Any, language: Optional[str] = None) -> str:
+		if self.legacy:
+			return formatString(self.format, data, self.structure, language=language)
+
+		if isinstance(data, list):
+			return ", ".join([self.render(x, language) for x in data])
+
+		elif isinstance(data, str):
+			return data
+
+		elif not data:
+			return self.format
+
+		values = {}
+		try:
+			self._resolve(self.root, data, self.structure, language, values)
+		except _LegacyFormat:
+			return formatString(self.format, data, self.structure, language=language)
+
+		res = []
+		unresolved = 0
+		for literal, placeholder in self.segments:
+			res.append(literal)
+
+			if placeholder is not None:
+				if placeholder in values:
+					res.append(values[placeholder])
+				else:
+					res.append(placeholder)
+					unresolved += 1
+
+		res = "".join(res)
+
+		# A value introduced new placeholder syntax, which formatString might have replaced again
+		if res.count("$(") != self.markers + unresolved:
+			return formatString(self.format, data, self.structure, language=language)
+
+		return res
+
+	def _asDict(self, value: Any) -> Any:
+		if not isinstance(value, list):
+			return value
+
+		try:
+			return self._dicts[id(value)][1]
+		except KeyError:
+			converted = {k: v for k, v in value}
+			self._dicts[id(value)] = (value, converted)  # keeps value alive, so its id stays unique
+			return converted
+
+	def _subFormat(self, format: str, structure: Any) -> "CompiledFormat":
+		try:
+			return self._subFormats[(format, id(structure))][1]
+		except KeyError:
+			compiled = CompiledFormat(format, structure)
+			self._subFormats[(format, id(structure))] = (structure, compiled)
+			return compiled
+
+	def _resolve(self, node: _FormatNode, data: Dict, structure: Any, language: Optional[str],
+				 values: Dict[str, str]) -> None:
+		structure = self._asDict(structure)
+
+		for key, child in node.children.items():
+			if key not in data:
+				continue
+
+			val = data[key]
+			struct = self._asDict(structure.get(key)) if structure else None
+
+			if isinstance(val, dict):
+				if struct and child.placeholder:
+					langs = struct.get("languages")
+					if not langs:
+						continue
+
+					if language and language in langs:
+						val = val.get(language, "")
+					else:
+						val = ", ".join(val.values())
+
+				else:
+					self._resolve(child, val, structure, language, values)
+
+			elif isinstance(val, list) and len(val) > 0 and isinstance(val[0], dict):
+				if struct and "dest" in val[0] and "rel" in val[0]:
+					if "relskel" not in struct or "format" not in struct:
+						raise _LegacyFormat()
+
+					if child.placeholder:
+						subFormat = self._subFormat(struct["format"], struct["relskel"])
+						values[child.placeholder] = ", ".join([subFormat.render(v, language) for v in val])
+
+					continue
+
+				self._resolve(child, val[0], struct, language, values)
+
+			elif isinstance(val, list):
+				val = ", ".join(val)
+
+			# Check for select-bones
+			if isinstance(struct, dict) and "values" in struct and struct["values"]:
+				vals = self._asDict(struct["values"])
+
+				if isinstance(vals, dict) and isinstance(val, str):
+					if val in vals:
+						val = vals[val]
+
+			if child.placeholder:
+				values[child.placeholder] = str(val)
+
+
+class RenderMemo(object):
+	"""
+	Bounded LRU memo of rendered relation and file fragments.
+
+	An export of a module referencing few entities renders the same referenced entity over and
+	over again. Fragments are keyed by the CompiledFormat (and with it the format and structure)
+	and the key of the referenced entity, so only formats referring to nothing but dest may be
+	memoized: values of rel differ per reference.
+
+	:param maxSize: Maximum number of kept fragments, 0 disables the memo
+	"""
+
+	def __init__(self, maxSize: int = 10000):
+		self.maxSize = maxSize
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key: Tuple, compute: Callable[[], str]) -> str:
+		"""Return the fragment stored for key, or compute and store it."""
+		with self.lock:
+			try:
+				value = self.entries[key]
+			except KeyError:
+				self.misses += 1
+			else:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return value
+
+		value = compute()
+
+		if self.maxSize > 0:
+			with self.lock:
+				self.entries[key] = value
+
+				if len(self.entries) > self.maxSize:
+					self.entries.popitem(last=False)
+
+		return value
+
+	@staticmethod
+	def getDestKey(relation: Any) -> Optional[str]:
+		"""Return the key of the entity referenced by a relational value, if it has one."""
+		if isinstance(relation, dict) and isinstance(relation.get("dest"), dict):
+			return relation["dest"].get("key")
+
+		return None
+
+	def summary(self) -> Dict[str, Any]:
+		lookups = self.hits + self.misses
+
+		return {
+			"size": len(self.entries),
+			"hits": self.hits,
+			"misses": self.misses,
+			"hitRate": round(self.hits / lookups, 4) if lookups else None,
+		}
+
+
+def prefetched(iterable: Iterable[Any], depth: int) -> Iterator[Any]:
+	"""Consume iterable in a background thread, staying up to depth items ahead of the caller.
+
+	The look-ahead is bounded, so at most depth items are held in memory. Exceptions raised
+	by the iterable are re-raised in the consuming thread.
+	"""
+	assert depth > 0
+	buffer = queue.Queue(maxsize=depth)
+	stop = threading.Event()
+	done = object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				buffer.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+
+		return False
+
+	def producer():
+		try:
+			for item in iterable:
+				if not put((item, None)):
+					return
+		except BaseException as e:
+			put((done, e))
+		else:
+			put((done, None))
+
+	threading.Thread(target=producer, name="prefetched", daemon=True).start()
+
+	try:
+		while True:
+			item, error = buffer.get()
+			if item is done:
+				if error is not None:
+					raise error
+				break
+
+			yield item
+	finally:
+		stop.set()
+
+
+async def prefetchedAsync(iterable: AsyncIterator[Any], depth: int) -> AsyncIterator[Any]:
+	"""Consume iterable in a task of the running event loop, staying up to depth items ahead of the caller.
+
+	The asyncio counterpart of :func:`prefetched`, without a thread.
+	"""
+	assert depth > 0
+	buffer = asyncio.Queue(maxsize=depth)
+	done = object()
+
+	async def producer():
+		try:
+			async for item in iterable:
+				await buffer.put((item, None))
+		except Exception as e:
+			await buffer.put((done, e))
+		else:
+			await buffer.put((done, None))
+
+	task = asyncio.ensure_future(producer())
+
+	try:
+		while True:
+			item, error = await buffer.get()
+			if item is done:
+				if error is not None:
+					raise error
+				break
+
+			yield item
+	finally:
+		task.cancel()
+
+
+class ExportStats(object):
+	"""Throughput counters of an export.
+
+	Pages, received bytes and the time spent on HTTP and JSON decoding are counted by
+	ViurClient.listPages, rows, written bytes and the time spent on rendering and writing by
+	CsvExporter.writeRows. With prefetching, HTTP and rendering overlap, so the phase times
+	can add up to more than the wall time.
+	"""
+	PHASES = ("http", "json", "render", "write")
+
+	def __init__(self, parent: Optional[Any] = None):
+		"""
+		:param parent: Pass pages, rows and written bytes on to these stats as they are counted, e.g. to
+			the combined stats of exports running side by side
+		"""
+		self.parent = parent
+		self.lock = threading.Lock()
+		self.started = time.time()
+		self.finished = None
+		self.pages = 0
+		self.rows = 0
+		self.bytesReceived = 0
+		self._bytesWritten = 0
+		self.pageLatencies = []
+		self.times = dict.fromkeys(self.PHASES, 0.0)
+
+	@property
+	def elapsed(self) -> float:
+		return (self.finished or time.time()) - self.started
+
+	@property
+	def bytesWritten(self) -> int:
+		return self._bytesWritten
+
+	@bytesWritten.setter
+	def bytesWritten(self, size: int) -> None:
+		self.addBytesWritten(size - self._bytesWritten)
+
+	def addPage(self, latency: float, decoding: float, size: int) -> None:
+		with self.lock:
+			self.pages += 1
+			self.bytesReceived += size
+			self.pageLatencies.append(latency)
+			self.times["http"] += latency
+			self.times["json"] += decoding
+
+		if self.parent is not None:
+			self.parent.addPage(latency, decoding, size)
+
+	def addRows(self, count: int, rendering: float, writing: float) -> None:
+		with self.lock:
+			self.rows += count
+			self.times["render"] += rendering
+			self.times["write"] += writing
+
+		if self.parent is not None:
+			self.parent.addRows(count, rendering, writing)
+
+	def addBytesWritten(self, size: int) -> None:
+		with self.lock:
+			self._bytesWritten += size
+
+		if self.parent is not None:
+			self.parent.addBytesWritten(size)
+
+	def finish(self) -> None:
+		self.finished = time.time()
+
+	def percentile(self, percent: float) -> Optional[float]:
+		if not self.pageLatencies:
+			return None
+
+		latencies = sorted(self.pageLatencies)
+		return round(latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))], 4)
+
+	def summary(self) -> Dict[str, Any]:
+		elapsed = self.elapsed
+
+		return {
+			"started": datetime.fromtimestamp(self.started).isoformat(),
+			"elapsed": round(elapsed, 3),
+			"pages": self.pages,
+			"rows": self.rows,
+			"rowsPerSecond": round(self.rows / elapsed, 1) if elapsed else None,
+			"bytesReceived": self.bytesReceived,
+			"bytesWritten": self.bytesWritten,
+			"pageLatency": {
+				"mean": round(sum(self.pageLatencies) / len(self.pageLatencies), 4) if self.pageLatencies else None,
+				"p50": self.percentile(50),
+				"p90": self.percentile(90),
+				"p99": self.percentile(99),
+				"max": round(max(self.pageLatencies), 4) if self.pageLatencies else None,
+			},
+			"times": {phase: round(seconds, 3) for phase, seconds in self.times.items()},
+		}
+
+	def progress(self) -> str:
+		elapsed = self.elapsed
+		busy = sum(self.times.values()) or 1
+		p50 = self.percentile(50)
+
+		return "%6.0fs %8d rows %7.0f rows/s %5d pages %8.1f MiB in %8.1f MiB out, p50 %s | %s" % (
+			elapsed, self.rows, self.rows / elapsed if elapsed else 0, self.pages,
+			self.bytesReceived / 2 ** 20, self.bytesWritten / 2 ** 20,
+			"%.0fms" % (p50 * 1000) if p50 is not None else "-",
+			" ".join("%s %2.0f%%" % (phase, seconds * 100 / busy) for phase, seconds in self.times.items()))
+
+
+class ProgressLine(object):
+	"""Shows the progress of an export in one continuously updated line, if stream is a terminal.
+
+	Pass None as stream to disable it, e.g. for exports running side by side.
+	"""
+	DELAY = 0.5
+
+	def __init__(self, stats: ExportStats, stream=sys.stderr):
+		self.stats = stats
+		self.stream = stream
+		self.run = False
+
+	def runner(self):
 		while self.run:
-			sys.stdout.write(next(chars))
-			sys.stdout.flush()
+			self.write()
 			time.sleep(self.DELAY)
-			sys.stdout.write("\b" * 3)
-			sys.stdout.flush()
+
+	def write(self, end: str = ""):
+		self.stream.write("\r" + self.stats.progress() + end)
+		self.stream.flush()
 
 	def __enter__(self):
-		self.run = True
-		threading.Thread(target=self.runner).start()
+		self.run = self.stream is not None and self.stream.isatty()
+		if self.run:
+			threading.Thread(target=self.runner, daemon=True).start()
+
 		return self
 
 	def __exit__(self, exception, value, tb):
-		self.run = False
-		time.sleep(self.DELAY)
+		self.stats.finish()
+
+		if self.run:
+			self.run = False
+			self.write("\n")
+
 		return False
 
 
 class ViurClient(object):
 
-	def __init__(self, host: str, user: str, password: str):
+	def __init__(self, host: str, user: str, password: str, skeyBatchSize: int = 10, poolSize: int = 10):
 		self.host = host.rstrip("/")
 		self.user = user
 		self.password = password
 
 		self.session = requests.Session()
+		# Keep a connection per thread sharing this client alive
+		adapter = requests.adapters.HTTPAdapter(pool_maxsize=poolSize)
+		self.session.mount("http://", adapter)
+		self.session.mount("https://", adapter)
+		self.skeys = SkeyPool(self.getSkey, batchSize=skeyBatchSize)
 
 		self._doLogin()
 
@@ -163,7 +649,10 @@ class ViurClient(object):
 			data={
 				"name": self.user,
 				"password": self.password,
-			}, method="POST")
+			}, params={"skey": self.getSkey()}, method="POST", addSkey=False)
+
+		# The session has changed, skeys of the anonymous session are useless now
+		self.skeys.invalidate()
 
 		assert self.request("/vi/user/view/self").ok, "Login was not successful"
 
@@ -175,50 +664,479 @@ class ViurClient(object):
 		if path.startswith("/"):
 			url = "".join((self.host, path))
 
-		if addSkey:
-			if params is None:
-				params = {}
-			params["skey"] = self.getSkey()
+		if not addSkey:
+			logger.debug("Do request: method=%r, url=%r, params=%r, data=%r",
+						 method, url, params, data)
+			return self.session.request(method, url, params, data, *args, **kwargs)
 
-		logger.debug("Do request: method=%r, url=%r, params=%r, data=%r",
-					 method, url, params, data)
-		return self.session.request(method, url, params, data, *args, **kwargs)
+		params = dict(params or {})
+
+		def doRequest(skey: str) -> requests.Response:
+			params["skey"] = skey
+			logger.debug("Do request: method=%r, url=%r, params=%r, data=%r",
+						 method, url, params, data)
+			return self.session.request(method, url, params, data, *args, **kwargs)
+
+		return self.skeys.retry(doRequest)
 
 	def getSkey(self) -> str:
 		return self.session.post(f"{self.host}/vi/skey").json()
 
-	def list(self, module: str, params: Union[None, Dict] = None) -> Iterator[Dict[str, Any]]:
+	def listPages(self, module: str, params: Union[None, Dict] = None,
+				  prefetch: int = 0, stats: Optional[ExportStats] = None) -> Iterator[Dict[str, Any]]:
+		"""Yield the raw list responses of a module page by page.
+
+		:param module: The module name
+		:param params: Params for list request, e.g. filter or ordering
+		:param prefetch: Fetch up to this many pages ahead in a background thread
+		:param stats: Count the pages, bytes and request times here
+		"""
 		if params is None:
 			params = {}
 
+		pages = self._fetchPages(module, params, stats)
+		if prefetch > 0:
+			pages = prefetched(pages, prefetch)
+
+		return pages
+
+	def _fetchPages(self, module: str, params: Dict, stats: Optional[ExportStats] = None) -> Iterator[Dict[str, Any]]:
 		while True:
+			start = time.perf_counter()
 			response = self.request(f"/vi/{module}/list", params=params, addSkey=False)
+			received = time.perf_counter()
+
 			assert response.ok, (response.status_code, response.content)
+			size = len(response.content)
 			response = response.json()
 
+			if stats:
+				stats.addPage(received - start, time.perf_counter() - received, size)
+
 			params["cursor"] = response["cursor"]
 
 			if not response["skellist"]:
 				break
 
-			for skel in response["skellist"]:
-				yield skel
+			yield response
+
+	def list(self, module: str, params: Union[None, Dict] = None,
+			 prefetch: int = 0) -> Iterator[Dict[str, Any]]:
+		for page in self.listPages(module, params, prefetch):
+			yield from page["skellist"]
 
 	def view(self, module: str, key: str, *args, **kwargs) -> requests.Response:
 		return self.request(f"/vi/{module}/view/{key}", addSkey=False, *args, **kwargs)
 
+	def getModules(self, handlers: Tuple[str, ...] = ("list",)) -> List[str]:
+		"""Return the names of all modules of the application with one of the given handler types.
+
+		:param handlers: Handler types to include, e.g. "list", "hierarchy", "tree" or "singleton"
+		"""
+		response = self.request("/vi/config", addSkey=False)
+		assert response.ok, (response.status_code, response.content)
+
+		return sorted(name for name, module in response.json()["modules"].items()
+					  if str(module.get("handler", "")).split(".")[0] in handlers)
+
 	def logout(self) -> bool:
-		return self.request("/vi/user/logout").ok
+		res = self.request("/vi/user/logout").ok
+		self.skeys.close()
+		return res
+
+
+class Column(NamedTuple):
+	"""One output column of a column plan."""
+	key: str  # header key, "bone" or "bone.language"
+	boneName: str
+	language: Optional[str]
+	boneType: str
+	render: Callable[[Any], Any]  # renders the raw bone value of a skel
+
+
+def writeJsonAtomic(fileName: str, data: Any) -> None:
+	"""Write data as JSON through a temporary file, so an interruption never leaves a broken file behind."""
+	with open(fileName + ".tmp", "w", encoding="utf-8") as json_file:
+		json.dump(data, json_file)
+
+	os.replace(fileName + ".tmp", fileName)
+
+
+class StructureCache(object):
+	"""
+	Persistent cache of module structures and the headers and column plans derived from them.
+
+	Every host and module is stored in its own JSON file. Within ttl seconds an entry is used
+	without asking the server. After that, the structure is fetched again, but the derived
+	headers and column plans are only rebuilt if the hash of the structure changed.
+
+	:param directory: Cache directory, defaults to viur-tools/structures in the user's cache directory
+	:param ttl: Seconds an entry is used without revalidation
+	"""
+
+	def __init__(self, directory: Optional[str] = None, ttl: float = 60 * 60):
+		if directory is None:
+			directory = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+									 "viur-tools", "structures")
+
+		self.directory = directory
+		self.ttl = ttl
+
+	def getFileName(self, host: str, module: str) -> str:
+		digest = hashlib.sha1(f"{host}|{module}".encode("utf-8")).hexdigest()[:16]
+		name = re.sub(r"[^\w.-]", "_", module)
+		return os.path.join(self.directory, f"{name}-{digest}.json")
+
+	@staticmethod
+	def hashStructure(rawStructure: List[List[Any]]) -> str:
+		return hashlib.sha256(json.dumps(rawStructure, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def isFresh(self, entry: Dict[str, Any]) -> bool:
+		return time.time() - entry["fetched"] <= self.ttl
+
+	def load(self, host: str, module: str) -> Optional[Dict[str, Any]]:
+		try:
+			with open(self.getFileName(host, module), encoding="utf-8") as cache_file:
+				entry = json.load(cache_file)
+		except (OSError, ValueError):
+			return None
+
+		if entry.get("host") != host or entry.get("module") != module:
+			return None
+
+		return entry
+
+	def save(self, host: str, module: str, entry: Dict[str, Any]) -> None:
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			writeJsonAtomic(self.getFileName(host, module), dict(entry, host=host, module=module))
+		except OSError as e:
+			logger.warning("Unable to write structure cache of %r: %s", module, e)
+
+
+def compressStream(raw: BinaryIO, compression: Optional[str] = None) -> BinaryIO:
+	"""Wrap a binary file to compress with gzip or zstd on the fly; closing the wrapper leaves raw open."""
+	if compression is None:
+		return raw
+
+	elif compression == "gzip":
+		return gzip.GzipFile(fileobj=raw, mode="wb")
+
+	elif compression == "zstd":
+		if zstandard is None:
+			raise ImportError("zstd compression requires the zstandard package")
+
+		return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+
+	raise ValueError(f"Unknown compression {compression!r}")
+
+
+def decompressStream(fileName: str, compression: Optional[str] = None) -> BinaryIO:
+	"""Open a file written by compressStream for reading, across all gzip members or zstd frames."""
+	if compression is None:
+		return open(fileName, "rb")
+
+	elif compression == "gzip":
+		return gzip.open(fileName, "rb")
+
+	elif compression == "zstd":
+		if zstandard is None:
+			raise ImportError("zstd compression requires the zstandard package")
+
+		return zstandard.ZstdDecompressor().stream_reader(open(fileName, "rb"), read_across_frames=True)
+
+	raise ValueError(f"Unknown compression {compression!r}")
+
+
+class Sink(object):
+	"""Base class of the export output formats.
+
+	A sink receives the rendered rows page by page. Columns and their order are given by the
+	column plan, the headers are the ones of CsvExporter.getHeaders.
+
+	Resumable sinks can be reopened at an offset previously returned by checkpoint(); everything
+	written after that offset is discarded.
+	"""
+	extension = None
+	resumable = False
+
+	def __init__(self, fileName: str, headers: Dict[str, str], plan: List[Column],
+				 compression: Optional[str] = None, writeHeader: bool = True, offset: Optional[int] = None):
+		if offset is not None and not self.resumable:
+			raise ValueError(f"{self.__class__.__name__} cannot be resumed")
+
+		self.fileName = fileName
+		self.headers = headers
+		self.plan = plan
+		self.compression = compression
+
+	@classmethod
+	def getExtension(cls, compression: Optional[str] = None) -> str:
+		return cls.extension + {None: "", "gzip": ".gz", "zstd": ".zst"}[compression]
+
+	@classmethod
+	def merge(cls, fileName: str, headers: Dict[str, str], plan: List[Column],
+			  compression: Optional[str], parts: List[str]) -> None:
+		"""Merge part files written with writeHeader=False into fileName."""
+		with cls(fileName, headers, plan, compression):
+			pass
+
+		# Concatenated gzip members and zstd frames are valid streams, too
+		with open(fileName, "ab") as target:
+			for part in parts:
+				with open(part, "rb") as source:
+					shutil.copyfileobj(source, target)
+
+	@classmethod
+	def readRows(cls, fileName: str, plan: List[Column], compression: Optional[str] = None) -> Iterator[List[Any]]:
+		"""Read the rows of a file written by this sink, in the column order of plan."""
+		raise NotImplementedError()
+
+	def writeRows(self, rows: List[List[Any]]) -> None:
+		raise NotImplementedError()
+
+	def checkpoint(self) -> int:
+		"""Flush everything written so far and return the file offset to resume at."""
+		raise NotImplementedError()
+
+	def close(self) -> None:
+		raise NotImplementedError()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exception, value, tb):
+		self.close()
+		return False
+
+
+class TextSink(Sink):
+	"""Base class of line based output formats, which can be compressed and resumed."""
+	resumable = True
+	newline = None
+
+	def __init__(self, fileName: str, headers: Dict[str, str], plan: List[Column],
+				 compression: Optional[str] = None, writeHeader: bool = True, offset: Optional[int] = None):
+		super().__init__(fileName, headers, plan, compression, writeHeader, offset)
+
+		if offset is None:
+			self.raw = open(fileName, "wb")
+		else:
+			self.raw = open(fileName, "r+b")
+			self.raw.truncate(offset)
+			self.raw.seek(offset)
+
+		self.open()
+
+		if writeHeader and offset is None:
+			self.writeHeader()
+
+	def open(self) -> None:
+		self.compressor = compressStream(self.raw, self.compression)
+		self.stream = io.TextIOWrapper(self.compressor, encoding="utf-8", newline=self.newline)
+
+	def writeHeader(self) -> None:
+		pass
+
+	def checkpoint(self) -> int:
+		if self.compression is None:
+			self.stream.flush()
+			return self.raw.tell()
+
+		# Finish the current gzip member or zstd frame, so the file is valid up to here
+		self.stream.detach()
+		self.compressor.close()
+		self.raw.flush()
+		offset = self.raw.tell()
+
+		self.open()
+		return offset
+
+	def tell(self) -> int:
+		"""Return the number of bytes written to the file so far, without the buffered data."""
+		return self.raw.tell()
+
+	def close(self) -> None:
+		self.stream.close()
+		self.raw.close()
+
+
+class CsvSink(TextSink):
+	extension = ".csv"
+	newline = ""
+
+	def open(self) -> None:
+		super().open()
+		self.writer = csv.writer(self.stream)
+
+	def writeHeader(self) -> None:
+		self.writer.writerow(self.headers.values())
+
+	@classmethod
+	def readRows(cls, fileName: str, plan: List[Column], compression: Optional[str] = None) -> Iterator[List[Any]]:
+		with io.TextIOWrapper(decompressStream(fileName, compression), encoding="utf-8", newline="") as stream:
+			reader = csv.reader(stream)
+			header = next(reader, None)
+
+			if header is not None and len(header) != len(plan):
+				raise ValueError(f"{fileName} has {len(header)} columns instead of {len(plan)}")
+
+			yield from reader
+
+	def writeRows(self, rows: List[List[Any]]) -> None:
+		self.writer.writerows(rows)
+
+
+class JsonlSink(TextSink):
+	"""One JSON object per row, keyed by the header keys. Rendered values keep their type."""
+	extension = ".jsonl"
+	newline = "\n"
+
+	@classmethod
+	def readRows(cls, fileName: str, plan: List[Column], compression: Optional[str] = None) -> Iterator[List[Any]]:
+		keys = [column.key for column in plan]
+
+		with io.TextIOWrapper(decompressStream(fileName, compression), encoding="utf-8", newline="\n") as stream:
+			for line in stream:
+				values = json.loads(line)
+				yield [values.get(key) for key in keys]
+
+	def writeRows(self, rows: List[List[Any]]) -> None:
+		keys = [column.key for column in self.plan]
+		self.stream.writelines(json.dumps(dict(zip(keys, row)), ensure_ascii=False, default=str) + "\n"
+							   for row in rows)
+
+
+class ParquetSink(Sink):
+	"""Columnar output, written in row groups of rowGroupSize rows as the pages arrive.
+
+	Numeric columns are stored as float64, all others as strings; empty values become null.
+	The compression is applied by Parquet itself and the header descriptions are kept as
+	field metadata.
+	"""
+	extension = ".parquet"
+	rowGroupSize = 10000
+
+	def __init__(self, fileName: str, headers: Dict[str, str], plan: List[Column],
+				 compression: Optional[str] = None, writeHeader: bool = True, offset: Optional[int] = None):
+		if pyarrow is None:
+			raise ImportError("Parquet output requires the pyarrow package")
+
+		super().__init__(fileName, headers, plan, compression, writeHeader, offset)
+
+		fields = []
+		self.converters = []
+
+		for column in plan:
+			if column.boneType == "numeric" or column.boneType.startswith("numeric."):
+				fields.append(pyarrow.field(column.key, pyarrow.float64(), metadata={"descr": headers[column.key]}))
+				self.converters.append(self._toFloat)
+			else:
+				fields.append(pyarrow.field(column.key, pyarrow.string(), metadata={"descr": headers[column.key]}))
+				self.converters.append(self._toString)
+
+		self.schema = pyarrow.schema(fields)
+		self.writer = pyarrow.parquet.ParquetWriter(fileName, self.schema, compression=compression or "snappy")
+		self.columns = [[] for _ in plan]
+		self.buffered = 0
+
+	@classmethod
+	def getExtension(cls, compression: Optional[str] = None) -> str:
+		return cls.extension
+
+	@classmethod
+	def merge(cls, fileName: str, headers: Dict[str, str], plan: List[Column],
+			  compression: Optional[str], parts: List[str]) -> None:
+		with cls(fileName, headers, plan, compression) as sink:
+			for part in parts:
+				partFile = pyarrow.parquet.ParquetFile(part)
+				for group in range(partFile.num_row_groups):
+					sink.writer.write_table(partFile.read_row_group(group))
+
+	@classmethod
+	def readRows(cls, fileName: str, plan: List[Column], compression: Optional[str] = None) -> Iterator[List[Any]]:
+		keys = [column.key for column in plan]
+
+		for batch in pyarrow.parquet.ParquetFile(fileName).iter_batches(columns=keys):
+			yield from zip(*(column.to_pylist() for column in batch.columns))
+
+	@staticmethod
+	def _toFloat(value: Any) -> Optional[float]:
+		if value is None or value == CsvExporter.EMPTY_VALUE:
+			return None
+
+		return float(value)
+
+	@staticmethod
+	def _toString(value: Any) -> Optional[str]:
+		if value is None or value == CsvExporter.EMPTY_VALUE:
+			return None
+
+		elif isinstance(value, str):
+			return value
+
+		elif isinstance(value, (dict, list)):
+			return json.dumps(value, ensure_ascii=False, default=str)
+
+		return str(value)
+
+	def writeRows(self, rows: List[List[Any]]) -> None:
+		for row in rows:
+			for values, value in zip(self.columns, row):
+				values.append(value)
+
+		self.buffered += len(rows)
+		if self.buffered >= self.rowGroupSize:
+			self.flush()
+
+	def flush(self) -> None:
+		if not self.buffered:
+			return
+
+		arrays = [pyarrow.array([convert(value) for value in values], type=field.type)
+				  for values, convert, field in zip(self.columns, self.converters, self.schema)]
+		self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+		self.columns = [[] for _ in self.plan]
+		self.buffered = 0
+
+	def close(self) -> None:
+		self.flush()
+		self.writer.close()
+
+
+SINKS = {
+	"csv": CsvSink,
+	"jsonl": JsonlSink,
+	"parquet": ParquetSink,
+}
+
+COMPRESSIONS = ("gzip", "zstd")
+
+
+class ExportCancelled(Exception):
+	pass
 
 
 class CsvExporter(object):
 	EMPTY_VALUE = ""
 
-	def __init__(self, viurClient: ViurClient):
+	def __init__(self, viurClient: Union[ViurClient, AsyncViurClient], structureCache: Optional[StructureCache] = None,
+				 renderMemo: Optional[RenderMemo] = None):
 		self.viurClient = viurClient
+		self.structureCache = structureCache
+		self.renderMemo = RenderMemo() if renderMemo is None else renderMemo
+		self.formats = {}  # (format, id(structure)) -> (structure, CompiledFormat)
+		self.structures = {}  # module -> raw structure
+		self.structuresLock = threading.Lock()
+		self.progressStream = sys.stderr
+		# Set to end running exports after their current page
+		self.stopEvent = None
 
 	def export(self, module: str, fileName: str = None, params: Dict = None,
-			   columns: Optional[List] = None, onlyVisibleBones: bool = False) -> None:
+			   columns: Optional[List] = None, onlyVisibleBones: bool = False, prefetch: int = 0,
+			   format: str = "csv", compression: Optional[str] = None,
+			   checkpoint: bool = False, resume: bool = False, stats: Optional[ExportStats] = None) -> int:
 		"""Export a VIUR-module to a CSV-file.
 
 		:param module: The module name
@@ -226,35 +1144,743 @@ class CsvExporter(object):
 		:param params: Params for list request, e.g. filter or ordering
 		:param columns: Export only these columns
 		:param onlyVisibleBones: Export only visible bones
+		:param prefetch: Amount of list pages fetched ahead while rendering
+		:param format: The output format, one of SINKS
+		:param compression: Compress the output with gzip or zstd
+		:param checkpoint: Save the cursor and row count to a checkpoint file after every page
+		:param resume: Continue an interrupted export of fileName from its checkpoint
+		:param stats: Collect the throughput counters of the export here
+		:return: The number of exported rows
+		"""
+		sinkClass = SINKS[format]
+
+		if stats is None:
+			stats = ExportStats()
+
+		if fileName is None:
+			if resume:
+				raise ValueError("The file name of the export to resume is required")
+
+			fileName = self.defaultFileName(module, sinkClass.getExtension(compression))
+
+		if params is None:
+			params = {}
+		assert isinstance(params, dict)
+		assert columns is None or isinstance(columns, list)
+
+		if (checkpoint or resume) and not sinkClass.resumable:
+			raise ValueError(f"Exports in {format} format cannot be resumed")
+
+		headers, structure, plan = self.loadStructure(module, columns, onlyVisibleBones)
+
+		params = {k: v for k, v in params.items() if k != "cursor"}
+		state = {
+			"module": module,
+			"params": params,
+			"format": format,
+			"compression": compression,
+			"columns": [column.key for column in plan],
+			"cursor": None,
+			"rows": 0,
+			"offset": None,
+		}
+
+		resumedRows = 0
+		if resume:
+			saved = self.loadCheckpoint(fileName)
+
+			for key in ("module", "format", "compression", "columns"):
+				if saved[key] != state[key]:
+					raise ValueError(f"The checkpoint of {fileName} was written with another {key}: {saved[key]!r}")
+
+			state = saved
+			params = dict(state["params"], cursor=state["cursor"])
+			resumedRows = state["rows"]
+			logger.info("Resuming export after %d rows", resumedRows)
+
+		def onPage(page: Dict[str, Any]) -> None:
+			state["offset"] = sink.checkpoint()
+			state["cursor"] = page["cursor"]
+			state["rows"] += len(page["skellist"])
+			self.saveCheckpoint(fileName, state)
+
+		with ProgressLine(stats, self.progressStream):
+			with sinkClass(fileName, headers, plan, compression, offset=state["offset"]) as sink:
+				count = resumedRows + self.writeRows(sink, module, plan, params, prefetch,
+													 onPage=onPage if checkpoint or resume else None,
+													 stats=stats)
+
+			stats.bytesWritten = os.path.getsize(fileName)
+
+			if checkpoint or resume:
+				self.removeCheckpoint(fileName)
+
+			logger.info("Export finished. %d rows written to file: %s", count, fileName)
+
+		return count
+
+	def exportModules(self, modules: List[str], outputDir: Optional[str] = None, concurrency: int = 4,
+					  format: str = "csv", compression: Optional[str] = None,
+					  stats: Optional[ExportStats] = None, **kwargs) -> Dict[str, Dict[str, Any]]:
+		"""Export several modules side by side, each into its own file.
+
+		All exports share the ViurClient, its session and skey pool, and the structure and
+		format caches of this exporter. A failing module is logged and reported, the
+		remaining modules are exported anyway.
+
+		:param modules: The module names
+		:param outputDir: Directory for the generated file names (the current directory if omitted)
+		:param concurrency: Maximum number of modules exported at the same time
+		:param stats: Collect the combined throughput counters of all exports here
+		:return: A summary per module with the file name, the row count and the throughput or the error
+
+		For the remaining parameters see :meth:`export`.
+		"""
+		assert concurrency > 0
+
+		if stats is None:
+			stats = ExportStats()
+
+		# One progress line shows the combined counters, updated by the modules as they run
+		exporter = copy.copy(self)
+		exporter.progressStream = None
+		exporter.stopEvent = threading.Event()
+
+		extension = SINKS[format].getExtension(compression)
+		results = {}
+
+		def exportModule(module: str) -> Tuple[str, int, ExportStats]:
+			fileName = self.defaultFileName(module, extension)
+			if outputDir:
+				fileName = os.path.join(outputDir, fileName)
+
+			moduleStats = ExportStats(parent=stats)
+			results[module] = {"file": fileName}
+
+			count = exporter.export(module, fileName, format=format, compression=compression,
+									stats=moduleStats, **kwargs)
+			return fileName, count, moduleStats
+
+		executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+		futures = {executor.submit(exportModule, module): module for module in modules}
+
+		with ProgressLine(stats, self.progressStream):
+			try:
+				for nr, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+					module = futures[future]
+
+					try:
+						fileName, count, moduleStats = future.result()
+					except Exception as e:
+						logger.error("Export of module %r failed: %s", module, e)
+						results[module]["error"] = str(e)
+						continue
+
+					results[module].update(rows=count, stats=moduleStats.summary())
+					logger.info("Module %r finished (%d/%d): %d rows in %.1fs", module, nr, len(modules),
+								count, moduleStats.elapsed)
+
+			except KeyboardInterrupt:
+				# Drop the queued modules and end the running ones after their current page
+				exporter.stopEvent.set()
+				executor.shutdown(wait=False, cancel_futures=True)
+				raise
+
+			executor.shutdown()
+
+		failed = [module for module in modules if "error" in results[module]]
+		logger.info("Exported %d of %d modules, %d rows in total%s", len(modules) - len(failed), len(modules),
+					stats.rows, f", failed: {', '.join(failed)}" if failed else "")
+
+		return {module: results[module] for module in modules}
+
+	async def exportAsync(self, module: str, fileName: str = None, params: Dict = None,
+						  columns: Optional[List] = None, onlyVisibleBones: bool = False, prefetch: int = 0,
+						  format: str = "csv", compression: Optional[str] = None,
+						  stats: Optional[ExportStats] = None) -> int:
+		"""Export a VIUR-module like :meth:`export`, fetching its pages with an AsyncViurClient.
+
+		The viurClient of this exporter has to be an AsyncViurClient. Several exports can then run
+		as tasks of one event loop, see :meth:`exportModulesAsync`. Checkpoints are not supported.
+
+		For the parameters see :meth:`export`.
+		:return: The number of exported rows
 		"""
+		sinkClass = SINKS[format]
+
+		if stats is None:
+			stats = ExportStats()
+
 		if fileName is None:
-			fileName = "export_%s_%s.csv" % (module, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"))
+			fileName = self.defaultFileName(module, sinkClass.getExtension(compression))
 
 		if params is None:
 			params = {}
 		assert isinstance(params, dict)
 		assert columns is None or isinstance(columns, list)
 
+		await self.fetchStructureAsync(module)
+		headers, structure, plan = self.loadStructure(module, columns, onlyVisibleBones)
+
+		params = {k: v for k, v in params.items() if k != "cursor"}
+
+		with ProgressLine(stats, self.progressStream):
+			with sinkClass(fileName, headers, plan, compression) as sink:
+				count = await self.writeRowsAsync(sink, module, plan, params, prefetch, stats=stats)
+
+			stats.bytesWritten = os.path.getsize(fileName)
+
+			logger.info("Export finished. %d rows written to file: %s", count, fileName)
+
+		return count
+
+	async def exportModulesAsync(self, modules: List[str], outputDir: Optional[str] = None, concurrency: int = 4,
+								 format: str = "csv", compression: Optional[str] = None,
+								 stats: Optional[ExportStats] = None, **kwargs) -> Dict[str, Dict[str, Any]]:
+		"""Export several modules like :meth:`exportModules`, as tasks of one event loop instead of threads.
+
+		The viurClient of this exporter has to be an AsyncViurClient; its maxConcurrency limits the
+		requests of all exports together.
+
+		For the parameters see :meth:`exportModules` and :meth:`exportAsync`.
+		"""
+		assert concurrency > 0
+
+		if stats is None:
+			stats = ExportStats()
+
+		# One progress line shows the combined counters, updated by the modules as they run
+		exporter = copy.copy(self)
+		exporter.progressStream = None
+
+		extension = SINKS[format].getExtension(compression)
+		semaphore = asyncio.Semaphore(concurrency)
+		results = {}
+		finished = 0
+
+		async def exportModule(module: str) -> None:
+			nonlocal finished
+
+			fileName = self.defaultFileName(module, extension)
+			if outputDir:
+				fileName = os.path.join(outputDir, fileName)
+
+			moduleStats = ExportStats(parent=stats)
+			results[module] = {"file": fileName}
+
+			async with semaphore:
+				try:
+					count = await exporter.exportAsync(module, fileName, format=format, compression=compression,
+													   stats=moduleStats, **kwargs)
+				except Exception as e:
+					logger.error("Export of module %r failed: %s", module, e)
+					results[module]["error"] = str(e)
+					return
+
+			finished += 1
+			results[module].update(rows=count, stats=moduleStats.summary())
+			logger.info("Module %r finished (%d/%d): %d rows in %.1fs", module, finished, len(modules),
+						count, moduleStats.elapsed)
+
+		with ProgressLine(stats, self.progressStream):
+			await asyncio.gather(*(exportModule(module) for module in modules))
+
+		failed = [module for module in modules if "error" in results[module]]
+		logger.info("Exported %d of %d modules, %d rows in total%s", len(modules) - len(failed), len(modules),
+					stats.rows, f", failed: {', '.join(failed)}" if failed else "")
+
+		return {module: results[module] for module in modules}
+
+	def exportSharded(self, module: str, shards: int, fileName: str = None, params: Dict = None,
+					  columns: Optional[List] = None, onlyVisibleBones: bool = False, prefetch: int = 0,
+					  format: str = "csv", compression: Optional[str] = None,
+					  shardBone: str = "creationdate", bounds: Optional[List[Any]] = None,
+					  stats: Optional[ExportStats] = None) -> int:
+		"""Export a VIUR-module to a CSV-file using one worker process per shard.
+
+		The module is split into disjoint value ranges of shardBone. Every shard is exported
+		by its own process and ViurClient session into a part file; the part files are merged
+		afterwards. Entities without a value in shardBone are not matched by range queries,
+		so shardBone must be set on every entity (which is the case for creationdate).
+
+		:param shards: The number of shards
+		:param shardBone: The bone the module is split by
+		:param bounds: Explicit split values for shardBone (computed from the data if omitted)
+		:return: The number of exported rows
+
+		For the remaining parameters see :meth:`export`.
+		"""
+		sinkClass = SINKS[format]
+
+		if stats is None:
+			stats = ExportStats()
+
+		if fileName is None:
+			fileName = self.defaultFileName(module, sinkClass.getExtension(compression))
+
+		if params is None:
+			params = {}
+		assert isinstance(params, dict)
+		assert shards > 0
+
+		headers, structure, plan = self.loadStructure(module, columns, onlyVisibleBones)
+
+		if bounds is None:
+			bounds = self.getShardBounds(module, shardBone, shards, params)
+
+		shardParams = self.getShardParams(shardBone, bounds, params)
+		logger.info("Exporting %r in %d shards by %r, bounds: %r", module, len(shardParams), shardBone, bounds)
+
+		client = self.viurClient
+		jobs = [{
+			"host": client.host,
+			"user": client.user,
+			"password": client.password,
+			"module": module,
+			"fileName": f"{fileName}.part{nr}",
+			"headers": headers,
+			"structure": structure,
+			"paramsList": paramsList,
+			"prefetch": prefetch,
+			"format": format,
+			"compression": compression,
+		} for nr, paramsList in enumerate(shardParams)]
+
+		# The shards send their counters to the progress line as they go; each ends with None
+		progress = multiprocessing.Queue()
+
+		def receiveProgress() -> None:
+			for _ in jobs:
+				for name, args in iter(progress.get, None):
+					getattr(stats, name)(*args)
+
+		with ProgressLine(stats, self.progressStream):
+			receiver = threading.Thread(target=receiveProgress, daemon=True)
+			receiver.start()
+
+			with multiprocessing.Pool(len(jobs), _initShardWorker, (progress,)) as pool:
+				counts = pool.map(_exportShard, jobs)
+				receiver.join()
+
+			parts = [job["fileName"] for job in jobs]
+			sinkClass.merge(fileName, headers, plan, compression, parts)
+			stats.bytesWritten = os.path.getsize(fileName)
+
+			for part in parts:
+				os.remove(part)
+
+			count = sum(counts)
+			logger.info("Export finished. %d rows written to file: %s", count, fileName)
+
+		return count
+
+	def exportIncremental(self, module: str, fileName: str = None, stateFileName: str = None,
+						  snapshotFileName: Optional[str] = None, changeBone: str = "changedate",
+						  overlap: int = 300, params: Dict = None, columns: Optional[List] = None,
+						  onlyVisibleBones: bool = False, prefetch: int = 0, format: str = "csv",
+						  compression: Optional[str] = None, stats: Optional[ExportStats] = None) -> int:
+		"""Export only the entries changed since the previous run into a delta file.
+
+		The largest value of changeBone seen is stored as high-water mark in a state file. The
+		next run only requests entries with a larger value, reaching overlap seconds back for
+		date bones to catch entries which were written while the previous run was listing.
+		The key column is always exported.
+
+		If snapshotFileName is given, the delta is merged into that snapshot: rows of changed
+		entries are replaced by key and new entries are appended. Deleted entries cannot be
+		detected this way and remain in the snapshot.
+
+		:param stateFileName: The file keeping the high-water mark between runs
+		:param snapshotFileName: Merge the delta into this snapshot file
+		:param changeBone: The bone holding the change date of an entry
+		:param overlap: Seconds the date high-water mark is lowered by for the next query
+		:return: The number of rows in the delta
+
+		For the remaining parameters see :meth:`export`.
+		"""
+		sinkClass = SINKS[format]
+
+		if stats is None:
+			stats = ExportStats()
+
+		if fileName is None:
+			fileName = self.defaultFileName(f"{module}_delta", sinkClass.getExtension(compression))
+
+		if stateFileName is None:
+			stateFileName = f"export_{module}.state.json"
+
+		if params is None:
+			params = {}
+		assert isinstance(params, dict)
+
+		try:
+			with open(stateFileName, "r", encoding="utf-8") as state_file:
+				state = json.load(state_file)
+		except FileNotFoundError:
+			state = {"module": module, "changeBone": changeBone, "highWater": None}
+
+		for key, value in (("module", module), ("changeBone", changeBone)):
+			if state[key] != value:
+				raise ValueError(f"{stateFileName} was written for another {key}: {state[key]!r}")
+
+		headers, structure, plan = self.loadStructure(module, columns, onlyVisibleBones, withKey=True)
+
+		if "orderby" in params and params["orderby"] != changeBone:
+			logger.warning("Ordering by %r is replaced by %r for the incremental export", params["orderby"], changeBone)
+
+		params = {k: v for k, v in params.items() if k not in ("orderby", "orderdir", "cursor")}
+		params["orderby"] = changeBone
+
+		highWater = state["highWater"]
+		if highWater is not None:
+			params[f"{changeBone}$gt"] = self.lowerHighWater(highWater, overlap)
+			logger.info("Exporting entries of %r changed since %s", module, params[f"{changeBone}$gt"])
+		else:
+			logger.info("No high-water mark in %s, exporting all entries of %r", stateFileName, module)
+
+		def onPage(page: Dict[str, Any]) -> None:
+			nonlocal highWater
+			# Ordered by changeBone, so the last entry has the largest value
+			if page["skellist"][-1].get(changeBone) is not None:
+				highWater = page["skellist"][-1][changeBone]
+
+		with ProgressLine(stats, self.progressStream):
+			with sinkClass(fileName, headers, plan, compression) as sink:
+				count = self.writeRows(sink, module, plan, params, prefetch, onPage=onPage, stats=stats)
+
+			stats.bytesWritten = os.path.getsize(fileName)
+			logger.info("Delta export finished. %d rows written to file: %s", count, fileName)
+
+			if snapshotFileName:
+				total = self.mergeSnapshot(sinkClass, snapshotFileName, fileName, headers, plan, compression,
+										   stats=stats)
+				logger.info("Merged delta into snapshot %s, which has %d rows now", snapshotFileName, total)
+
+		state["highWater"] = highWater
+		state["rows"] = count
+		state["finished"] = datetime.now().isoformat()
+		writeJsonAtomic(stateFileName, state)
+
+		return count
+
+	@staticmethod
+	def lowerHighWater(highWater: Any, overlap: int) -> Any:
+		"""Move a date high-water mark overlap seconds back; other values are returned unchanged."""
+		if not overlap or not isinstance(highWater, str):
+			return highWater
+
+		try:
+			value, dateFormat = parseDate(highWater)
+		except ValueError:
+			return highWater
+
+		return formatDate(value - timedelta(seconds=overlap), dateFormat)
+
+	def mergeSnapshot(self, sinkClass: type, snapshotFileName: str, deltaFileName: str, headers: Dict[str, str],
+					  plan: List[Column], compression: Optional[str] = None, chunkSize: int = 1000,
+					  stats: Optional[ExportStats] = None) -> int:
+		"""Replace the rows of snapshotFileName by the rows with the same key in deltaFileName.
+
+		:param stats: Add the size of the new snapshot to the bytes written here
+
+		:return: The number of rows in the new snapshot
+		"""
+		keyIndex = [column.key for column in plan].index("key")
+
+		# An entity changed while the delta was paged is listed twice, only its last row counts
+		delta = {}
+		for row in sinkClass.readRows(deltaFileName, plan, compression):
+			delta.pop(row[keyIndex], None)
+			delta[row[keyIndex]] = row
+
+		rows = iter(delta.values())
+		if os.path.exists(snapshotFileName):
+			unchanged = (row for row in sinkClass.readRows(snapshotFileName, plan, compression)
+						 if row[keyIndex] not in delta)
+			rows = itertools.chain(unchanged, rows)
+
+		count = 0
+		with sinkClass(snapshotFileName + ".tmp", headers, plan, compression) as sink:
+			while chunk := list(itertools.islice(rows, chunkSize)):
+				sink.writeRows(chunk)
+				count += len(chunk)
+
+		os.replace(snapshotFileName + ".tmp", snapshotFileName)
+
+		if stats is not None:
+			stats.bytesWritten += os.path.getsize(snapshotFileName)
+
+		return count
+
+	def getShardBounds(self, module: str, shardBone: str, shards: int, params: Dict) -> List[Any]:
+		"""Compute shards - 1 evenly spaced split values between the smallest and largest value of shardBone.
+
+		Only numeric and date values can be interpolated; for other bones explicit bounds must be given.
+		"""
+		def edge(descending: bool) -> Any:
+			edgeParams = dict(params, orderby=shardBone, amount=1)
+			if descending:
+				edgeParams["orderdir"] = 1
+
+			page = next(self.viurClient.listPages(module, edgeParams), None)
+			return page["skellist"][0][shardBone] if page else None
+
+		low = edge(False)
+		high = edge(True)
+
+		if low is None or high is None or shards < 2:
+			return []
+
+		if isinstance(low, (int, float)) and isinstance(high, (int, float)):
+			step = (high - low) / shards
+			bounds = [low + step * i for i in range(1, shards)]
+
+			if isinstance(low, int) and isinstance(high, int):
+				bounds = [int(bound) for bound in bounds]
+
+			# Drop duplicate bounds of narrow ranges, keeping the order
+			return list(dict.fromkeys(bound for bound in bounds if low < bound <= high))
+
+		if isinstance(low, str) and isinstance(high, str):
+			try:
+				(lowDate, dateFormat), (highDate, _) = parseDate(low), parseDate(high)
+			except ValueError:
+				pass
+			else:
+				step = (highDate - lowDate) / shards
+				bounds = dict.fromkeys(lowDate + step * i for i in range(1, shards))
+
+				return [formatDate(bound, dateFormat) for bound in bounds if lowDate < bound <= highDate]
+
+		raise ValueError(f"Cannot compute shard bounds from values of {shardBone!r}, please specify them")
+
+	def getShardParams(self, shardBone: str, bounds: List[Any], params: Dict) -> List[List[Dict]]:
+		"""Build the list request params of every shard from the split values.
+
+		Only the $lt, $gt and equality filters are used, so every bound gets its own equality
+		query which is exported by the shard following it.
+		"""
+		if "orderby" in params and params["orderby"] != shardBone:
+			logger.warning("Ordering by %r is replaced by %r for the sharded export", params["orderby"], shardBone)
+
+		params = {k: v for k, v in params.items() if k not in ("orderby", "orderdir", "cursor")}
+		params["orderby"] = shardBone
+
+		shardParams = []
+		lower = None
+
+		for upper in bounds + [None]:
+			paramsList = []
+
+			if lower is not None:
+				paramsList.append(dict(params, **{shardBone: lower}))
+
+			rangeParams = dict(params)
+			if lower is not None:
+				rangeParams[f"{shardBone}$gt"] = lower
+			if upper is not None:
+				rangeParams[f"{shardBone}$lt"] = upper
+
+			paramsList.append(rangeParams)
+			shardParams.append(paramsList)
+			lower = upper
+
+		return shardParams
+
+	def fetchStructure(self, module: str) -> List[List[Any]]:
+		with self.structuresLock:
+			if module in self.structures:
+				return self.structures[module]
+
 		req = self.viurClient.view(module, "structure")
 
 		assert req.ok, (req.status_code, req.reason)
 		if req.url.endswith("/vi/s/main.html"):
 			raise ValueError(f"Module {module!r} does not exists")
 
-		rawStructure = req.json()["structure"]
+		structure = req.json()["structure"]
+
+		with self.structuresLock:
+			self.structures[module] = structure
+
+		return structure
+
+	async def fetchStructureAsync(self, module: str) -> None:
+		"""Fetch the structure of a module with an AsyncViurClient into the memo of :meth:`fetchStructure`.
+
+		Nothing is fetched while the structure cache holds a fresh copy.
+		"""
+		cache = self.structureCache
+		entry = cache.load(self.viurClient.host, module) if cache else None
+
+		if module in self.structures or (entry is not None and cache.isFresh(entry)):
+			return
+
+		req = await self.viurClient.view(module, "structure")
+
+		assert req.ok, (req.status_code, req.content)
+		if req.url.endswith("/vi/s/main.html"):
+			raise ValueError(f"Module {module!r} does not exists")
+
+		with self.structuresLock:
+			self.structures[module] = req.json()["structure"]
+
+	def loadStructure(self, module: str, columns: Optional[List] = None, onlyVisibleBones: bool = False,
+					  withKey: bool = False) -> Tuple[Dict[str, str], Dict[str, Dict], List[Column]]:
+		"""Return the headers, the prepared structure and the column plan of a module.
+
+		With a structureCache, all of them are taken from the cache while it is fresh.
+
+		For the parameters see :meth:`prepareStructure`.
+		"""
+		cache = self.structureCache
+		host = self.viurClient.host
+		entry = cache.load(host, module) if cache else None
+		changed = False
+
+		if entry is None or not cache.isFresh(entry):
+			rawStructure = self.fetchStructure(module)
+			digest = StructureCache.hashStructure(rawStructure)
+
+			if entry is None or entry["hash"] != digest:
+				logger.debug("Structure of %r changed or is not cached", module)
+				entry = {"hash": digest, "structure": rawStructure, "variants": {}}
+
+			entry["fetched"] = time.time()
+			changed = True
+
+		variantKey = json.dumps([columns, onlyVisibleBones, withKey])
+		variant = entry["variants"].get(variantKey)
+
+		if variant is None:
+			headers, structure = self.prepareStructure(entry["structure"], columns, onlyVisibleBones, withKey)
+			variant = entry["variants"][variantKey] = {
+				"headers": headers,
+				"structure": structure,
+				"plan": [column[:4] for column in self.buildColumnPlan(structure)],
+			}
+			changed = True
+
+		if cache and changed:
+			cache.save(host, module, entry)
+
+		return variant["headers"], variant["structure"], self.restoreColumnPlan(variant["plan"], variant["structure"])
+
+	def prepareStructure(self, rawStructure: List[List[Any]], columns: Optional[List] = None,
+						 onlyVisibleBones: bool = False,
+						 withKey: bool = False) -> Tuple[Dict[str, str], Dict[str, Dict]]:
+		"""Select the exported bones of a structure and return their headers and structure.
+
+		:param rawStructure: The structure as returned by the server
+		:param columns: Export only these columns
+		:param onlyVisibleBones: Export only visible bones
+		:param withKey: Always export the key, as first column if it was not selected
+		"""
 		visibleColumns = [k for k, v in rawStructure
 						  if (columns is None or k in columns) and (not onlyVisibleBones or v["visible"])]
 		headers = self.getHeaders(rawStructure, visibleColumns)
 		structure = {k: v for k, v in rawStructure if k in visibleColumns}
 
-		with Spinner():
-			with open(fileName, "w", newline="", encoding="utf-8") as csv_file:
-				writer = csv.writer(csv_file)
-				writer.writerow(headers.values())
-				writer.writerows(map(functools.partial(self.renderRow, structure=structure),
-									 self.viurClient.list(module, params)))
+		if withKey and "key" not in structure:
+			keyStructure = dict(rawStructure).get("key") or {"type": "key", "descr": "Key", "multiple": False}
+			structure = {"key": keyStructure, **structure}
+			headers = {"key": keyStructure["descr"], **headers}
+
+		return headers, structure
+
+	def writeRows(self, sink: Sink, module: str, plan: List[Column], params: Dict, prefetch: int = 0,
+				  onPage: Optional[Callable[[Dict[str, Any]], None]] = None,
+				  stats: Optional[ExportStats] = None) -> int:
+		"""Render all entries of the list request into sink.
+
+		:param onPage: Called with the list response after each page was handed to the sink
+		:param stats: Count the rows, bytes and times here
+		:return: The number of written rows
+		"""
+		if stats is None:
+			stats = ExportStats()
+
+		count = 0
+		for page in self.viurClient.listPages(module, dict(params), prefetch, stats):
+			if self.stopEvent is not None and self.stopEvent.is_set():
+				raise ExportCancelled(f"Export of {module} was cancelled")
+
+			start = time.perf_counter()
+			rows = [self.renderRow(skel, plan) for skel in page["skellist"]]
+			rendered = time.perf_counter()
+			sink.writeRows(rows)
+
+			stats.addRows(len(rows), rendered - start, time.perf_counter() - rendered)
+			# Only an estimate for the progress line, the exports set the final file size
+			if isinstance(sink, TextSink):
+				stats.bytesWritten = sink.tell()
+			count += len(rows)
 
-			logger.info("Export finished. File: %s", fileName)
+			if onPage:
+				onPage(page)
+
+		return count
+
+	async def writeRowsAsync(self, sink: Sink, module: str, plan: List[Column], params: Dict, prefetch: int = 0,
+							 stats: Optional[ExportStats] = None) -> int:
+		"""Render all entries of the list request into sink, like :meth:`writeRows` with an AsyncViurClient.
+
+		:param stats: Count the rows, bytes and times here
+		:return: The number of written rows
+		"""
+		if stats is None:
+			stats = ExportStats()
+
+		pages = self.viurClient.listPages(module, dict(params), stats)
+		if prefetch > 0:
+			pages = prefetchedAsync(pages, prefetch)
+
+		count = 0
+		async for page in pages:
+			start = time.perf_counter()
+			rows = [self.renderRow(skel, plan) for skel in page["skellist"]]
+			rendered = time.perf_counter()
+			sink.writeRows(rows)
+
+			stats.addRows(len(rows), rendered - start, time.perf_counter() - rendered)
+			if isinstance(sink, TextSink):
+				stats.bytesWritten = sink.tell()
+			count += len(rows)
+
+		return count
+
+	@staticmethod
+	def getCheckpointFileName(fileName: str) -> str:
+		return fileName + ".checkpoint"
+
+	def loadCheckpoint(self, fileName: str) -> Dict[str, Any]:
+		try:
+			with open(self.getCheckpointFileName(fileName), "r", encoding="utf-8") as checkpoint_file:
+				return json.load(checkpoint_file)
+		except FileNotFoundError:
+			raise ValueError(f"There is no checkpoint to resume the export of {fileName}")
+
+	def saveCheckpoint(self, fileName: str, state: Dict[str, Any]) -> None:
+		writeJsonAtomic(self.getCheckpointFileName(fileName), state)
+
+	def removeCheckpoint(self, fileName: str) -> None:
+		try:
+			os.remove(self.getCheckpointFileName(fileName))
+		except FileNotFoundError:
+			pass
+
+	def getFormat(self, format: str, structure: Union[Dict, List, None]) -> CompiledFormat:
+		"""Return the CompiledFormat of format for structure, compiling it on first use."""
+		try:
+			return self.formats[(format, id(structure))][1]
+		except KeyError:
+			compiled = CompiledFormat(format, structure)
+			self.formats[(format, id(structure))] = (structure, compiled)
+			return compiled
+
+	@staticmethod
+	def defaultFileName(module: str, extension: str = ".csv") -> str:
+		return "export_%s_%s%s" % (module, datetime.now().strftime("%Y-%m-%d_%H-%M-%S"), extension)
 
 	def getHeaders(self, structure: Dict[str, Dict], visibleColumns: List[str]) -> Dict[str, str]:
 		headers = {}
@@ -270,17 +1896,116 @@ class CsvExporter(object):
 
 		return headers
 
-	def renderRow(self, skel: Dict[str, Any], structure: Dict[str, Dict]) -> List[Any]:
-		data = []
+	def buildColumnPlan(self, structure: Dict[str, Dict]) -> List[Column]:
+		"""Build one specialised renderer per output column, in the order of getHeaders."""
+		plan = []
 
 		for boneName, boneStructure in structure.items():
 			if boneStructure.get("languages"):
 				for lang in boneStructure["languages"]:
-					data.append(self.renderBoneValue(boneName, skel[boneName], structure, lang))
+					plan.append(Column(".".join((boneName, lang)), boneName, lang, boneStructure["type"],
+									   self.getRenderer(boneStructure, lang)))
 			else:
-				data.append(self.renderBoneValue(boneName, skel[boneName], structure))
+				plan.append(Column(boneName, boneName, None, boneStructure["type"], self.getRenderer(boneStructure)))
 
-		return data
+		return plan
+
+	def restoreColumnPlan(self, spec: List[List[Any]], structure: Dict[str, Dict]) -> List[Column]:
+		"""Rebuild a column plan from the key, boneName, language and boneType of its columns."""
+		return [Column(key, boneName, language, boneType, self.getRenderer(structure[boneName], language))
+				for key, boneName, language, boneType in spec]
+
+	def getRenderer(self, boneStructure: Dict[str, Any], language: Optional[str] = None) -> Callable[[Any], Any]:
+		"""Return a callable rendering a raw bone value like renderBoneValue does, resolved for this bone."""
+		render = self.getValueRenderer(boneStructure)
+		empty = self.EMPTY_VALUE
+
+		if language:
+			def renderer(boneValue):
+				boneValue = boneValue.get(language)
+				return render(boneValue) if boneValue else empty
+		else:
+			def renderer(boneValue):
+				return render(boneValue) if boneValue else empty
+
+		return renderer
+
+	def getValueRenderer(self, boneStructure: Dict[str, Any]) -> Callable[[Any], Any]:
+		"""Return the renderer for non-empty values of a bone, see renderBoneValue."""
+		boneType = boneStructure["type"]
+
+		if boneType == "str" or boneType.startswith("str."):
+			if boneStructure["multiple"]:
+				return ", ".join
+
+			return lambda boneValue: ", ".join(boneValue) if isinstance(boneValue, list) else boneValue
+
+		elif boneType == "select" or boneType.startswith("select."):
+			values = dict(boneStructure.get("values") or ())
+
+			def renderSelect(boneValue):
+				return ", ".join(values.get(x, x) for x in boneValue)
+
+			if boneStructure["multiple"]:
+				return renderSelect
+
+			return lambda boneValue: renderSelect(boneValue) if isinstance(boneValue, list) else boneValue
+
+		elif boneType == "treeitem.file":
+			template = self.getFormat(boneStructure["format"], boneStructure)
+			memo = self.renderMemo
+
+			def renderFile(fileRel):
+				return "%s (%s)" % (template.render(fileRel), fileRel["dest"].get("servingurl"))
+
+			if template.destOnly:
+				renderUncached = renderFile
+
+				def renderFile(fileRel):
+					destKey = memo.getDestKey(fileRel)
+					if destKey is None:
+						return renderUncached(fileRel)
+
+					return memo.get(("file", template, destKey), lambda: renderUncached(fileRel))
+
+			def renderFiles(boneValue):
+				if not isinstance(boneValue, list):
+					boneValue = [boneValue]
+
+				return "\n".join([renderFile(fileRel) for fileRel in boneValue])
+
+			return renderFiles
+
+		elif boneType == "numeric" or boneType.startswith("numeric."):
+			precision = boneStructure["precision"]
+			return lambda boneValue: round(boneValue, precision)
+
+		elif boneType == "relational" or boneType.startswith("relational."):
+			template = self.getFormat(boneStructure["format"], boneStructure)
+			if not template.destOnly:
+				return template.render
+
+			memo = self.renderMemo
+
+			def renderRelation(relation):
+				destKey = memo.getDestKey(relation)
+				if destKey is None:
+					return template.render(relation)
+
+				return memo.get(("relation", template, destKey), lambda: template.render(relation))
+
+			def renderRelations(boneValue):
+				if isinstance(boneValue, list):
+					return ", ".join([renderRelation(relation) for relation in boneValue])
+
+				return renderRelation(boneValue)
+
+			return renderRelations
+
+		return lambda boneValue: boneValue
+
+	def renderRow(self, skel: Dict[str, Any], plan: List[Column]) -> List[Any]:
+		return [render(skel[boneName]) for key, boneName, language, boneType, render in plan]
 
 	def renderBoneValue(self, boneName: str, boneValue: Any, structure: Dict[str, Dict],
 						language: Optional[str] = None) -> Any:
@@ -311,7 +2036,7 @@ class CsvExporter(object):
 				boneValue = [boneValue]
 			res = []
 			for fileRel in boneValue:
-				res.append("%s (%s)" % (formatString(boneStructure["format"], boneValue, boneStructure),
+				res.append("%s (%s)" % (self.getFormat(boneStructure["format"], boneStructure).render(fileRel),
 										fileRel["dest"].get("servingurl")))
 			return "\n".join(res)
 
@@ -319,12 +2044,76 @@ class CsvExporter(object):
 			return round(boneValue, boneStructure["precision"])
 
 		elif boneType == "relational" or boneType.startswith("relational."):
-			return formatString(boneStructure["format"], boneValue, boneStructure)
+			return self.getFormat(boneStructure["format"], boneStructure).render(boneValue)
 
 		else:
 			return boneValue
 
 
+class _ShardProgress(object):
+	"""Passes the counters of a shard on to the ExportStats of the parent process, see
+	:meth:`CsvExporter.exportSharded`."""
+
+	def __init__(self, queue: multiprocessing.Queue):
+		self.queue = queue
+
+	def addPage(self, *args) -> None:
+		self.queue.put(("addPage", args))
+
+	def addRows(self, *args) -> None:
+		self.queue.put(("addRows", args))
+
+	def addBytesWritten(self, *args) -> None:
+		self.queue.put(("addBytesWritten", args))
+
+
+_shardProgress = None
+
+
+def _initShardWorker(progress: multiprocessing.Queue) -> None:
+	global _shardProgress
+	_shardProgress = progress
+
+
+def _exportShard(job: Dict[str, Any]) -> int:
+	"""Export one shard within a worker process, using its own ViurClient session."""
+	stats = ExportStats(parent=_ShardProgress(_shardProgress))
+	count = 0
+
+	try:
+		client = ViurClient(job["host"], job["user"], job["password"])
+		exporter = CsvExporter(client)
+		plan = exporter.buildColumnPlan(job["structure"])
+
+		try:
+			with SINKS[job["format"]](job["fileName"], job["headers"], plan, job["compression"], writeHeader=False) as sink:
+				for params in job["paramsList"]:
+					count += exporter.writeRows(sink, job["module"], plan, params, job["prefetch"], stats=stats)
+		finally:
+			client.logout()
+	finally:
+		# Ends the counters of this shard, also if it failed
+		_shardProgress.put(None)
+
+	logger.debug("Shard %s finished with %d rows", job["fileName"], count)
+	return count
+
+
+async def _exportAsync(exporter: CsvExporter, args: argparse.Namespace,
+					   stats: ExportStats) -> Optional[Dict[str, Dict[str, Any]]]:
+	"""Run the exports of the CLI on the AsyncViurClient of exporter, in one event loop."""
+	async with exporter.viurClient as client:
+		modules = await client.getModules() if args.all_modules else args.export
+
+		if args.all_modules or len(modules) > 1:
+			return await exporter.exportModulesAsync(modules, args.output_dir, args.concurrency, format=args.format,
+													 compression=args.compress, onlyVisibleBones=True,
+													 prefetch=args.prefetch, stats=stats)
+
+		await exporter.exportAsync(modules[0], args.output, onlyVisibleBones=True, prefetch=args.prefetch,
+								   format=args.format, compression=args.compress, stats=stats)
+
+
 if __name__ == "__main__":
 	ap = argparse.ArgumentParser(description="ViUR CSV Exporter CLI")
 	ap.add_argument("-c", "--connect", required=True, metavar="HOST", type=str,
@@ -333,10 +2122,54 @@ if __name__ == "__main__":
 	ap.add_argument("-p", "--password", type=str, required=True, help="Password")
 
 	ap.add_argument("-V", "--verbose", action="store_true", help="Verbose mode")
+	ap.add_argument("--stats-json", metavar="FILE", type=str,
+					help="Write a summary of the export throughput to FILE")
+	ap.add_argument("--structure-ttl", metavar="SECONDS", type=float, default=60 * 60,
+					help="Use cached module structures for SECONDS before checking them again")
+	ap.add_argument("--no-structure-cache", action="store_true",
+					help="Always fetch module structures and don't cache them on disk")
+	ap.add_argument("--render-memo", metavar="N", type=int, default=10000,
+					help="Keep up to N rendered relations and files of referenced entities (0 disables it)")
+	ap.add_argument("--prefetch", metavar="PAGES", type=int, default=2,
+					help="Fetch up to PAGES list pages ahead while rendering (0 disables prefetching)")
 
 	action = ap.add_mutually_exclusive_group(required=True)
-	action.add_argument("-e", "--export", metavar="module", type=str,
-						help="Export this module as csv")
+	action.add_argument("-e", "--export", metavar="module", type=str, nargs="+",
+						help="Export these modules, each into its own file")
+	action.add_argument("-a", "--all-modules", action="store_true",
+						help="Export all list modules of the application")
+
+	ap.add_argument("-o", "--output", metavar="FILE", type=str, help="Output file name (generated if omitted)")
+	ap.add_argument("--output-dir", metavar="DIR", type=str,
+					help="Directory for the generated output file names of several modules")
+	ap.add_argument("--concurrency", metavar="N", type=int, default=4,
+					help="Export up to N modules at the same time")
+	ap.add_argument("-f", "--format", choices=SINKS.keys(), default="csv", help="Output format")
+	ap.add_argument("-z", "--compress", choices=COMPRESSIONS, help="Compress the output on the fly")
+
+	ap.add_argument("--async", action="store_true", dest="useAsync",
+					help="Fetch the pages of all exports from one event loop instead of threads (requires aiohttp)")
+
+	ap.add_argument("--resume", action="store_true",
+					help="Continue the interrupted export of --output from its checkpoint file")
+	ap.add_argument("--no-checkpoint", action="store_true",
+					help="Don't save a checkpoint after every page, which --resume needs")
+
+	ap.add_argument("--incremental", action="store_true",
+					help="Only export entries changed since the previous incremental run")
+	ap.add_argument("--change-bone", metavar="BONE", type=str, default="changedate",
+					help="Bone holding the change date used by --incremental")
+	ap.add_argument("--state", metavar="FILE", type=str,
+					help="State file keeping the high-water mark of --incremental (export_<module>.state.json)")
+	ap.add_argument("--snapshot", metavar="FILE", type=str,
+					help="Merge the delta of --incremental into this snapshot file, deduplicated by key")
+
+	ap.add_argument("--shards", metavar="N", type=int, default=1,
+					help="Split the export into N shards which are exported in parallel processes")
+	ap.add_argument("--shard-bone", metavar="BONE", type=str, default="creationdate",
+					help="Bone used to split the module into shards; must be set on every entity")
+	ap.add_argument("--shard-bounds", metavar="VALUES", type=lambda x: x.split(","),
+					help="Comma separated split values for the shard bone (computed from the data if omitted)")
 
 	args = ap.parse_args()
 
@@ -345,12 +2178,83 @@ if __name__ == "__main__":
 
 	logger.debug("%s called with %r", sys.argv[0], args)
 
-	vc = ViurClient(args.connect, args.username, args.password)
+	sharded = args.shards > 1 or args.shard_bounds
+	multiple = args.all_modules or len(args.export) > 1
+	# Checkpoints of several modules could never be resumed
+	checkpoint = (not args.no_checkpoint and not sharded and not args.incremental and not multiple
+				  and not args.useAsync and SINKS[args.format].resumable)
+
+	if args.resume and not args.output:
+		ap.error("--resume requires the --output file of the interrupted export")
+	if args.resume and sharded:
+		ap.error("Sharded exports cannot be resumed")
+	if args.incremental and (sharded or args.resume):
+		ap.error("Incremental exports cannot be sharded or resumed")
+
+	if args.useAsync and (args.resume or args.incremental or sharded):
+		ap.error("--async exports cannot be resumed, incremental or sharded")
+
+	if multiple and (args.output or args.resume or args.incremental or sharded):
+		ap.error("Several modules cannot be exported with --output, --resume, --incremental or shards")
+
+	module = None if multiple else args.export[0]
+	if module and not args.output:
+		args.output = CsvExporter.defaultFileName(module + ("_delta" if args.incremental else ""),
+												  SINKS[args.format].getExtension(args.compress))
+
+	if args.useAsync:
+		# Logs in once the event loop runs
+		vc = AsyncViurClient(args.connect, args.username, args.password, maxConcurrency=max(10, args.concurrency + 2))
+	else:
+		vc = ViurClient(args.connect, args.username, args.password, poolSize=max(10, args.concurrency + 2))
+	exporter = CsvExporter(vc, None if args.no_structure_cache else StructureCache(ttl=args.structure_ttl),
+						   RenderMemo(args.render_memo))
+	stats = ExportStats()
+	results = None
 
 	try:
-		if args.export:
-			CsvExporter(vc).export(args.export, onlyVisibleBones=True)
+		if args.useAsync:
+			results = asyncio.run(_exportAsync(exporter, args, stats))
+		elif multiple:
+			modules = vc.getModules() if args.all_modules else args.export
+			results = exporter.exportModules(modules, args.output_dir, args.concurrency, format=args.format,
+											 compression=args.compress, onlyVisibleBones=True,
+											 prefetch=args.prefetch, checkpoint=checkpoint, stats=stats)
+		else:
+			if args.incremental:
+				exporter.exportIncremental(module, args.output, args.state, args.snapshot,
+										   changeBone=args.change_bone, onlyVisibleBones=True,
+										   prefetch=args.prefetch, format=args.format,
+										   compression=args.compress, stats=stats)
+			elif sharded:
+				exporter.exportSharded(module, args.shards, args.output, onlyVisibleBones=True,
+									   prefetch=args.prefetch, format=args.format, compression=args.compress,
+									   shardBone=args.shard_bone, bounds=args.shard_bounds, stats=stats)
+			else:
+				exporter.export(module, args.output, onlyVisibleBones=True, prefetch=args.prefetch,
+								format=args.format, compression=args.compress,
+								checkpoint=checkpoint, resume=args.resume, stats=stats)
 	except KeyboardInterrupt:
-		logger.info("KeyboardInterrupt. Export might be incomplete!")
+		if checkpoint or args.resume:
+			logger.info("KeyboardInterrupt. Export is incomplete, continue it with --resume -o %s", args.output)
+		else:
+			logger.info("KeyboardInterrupt. Export might be incomplete!")
+
+	logger.info("%s", stats.progress().strip())
+
+	memo = exporter.renderMemo.summary()
+	logger.debug("Render memo: %d hits, %d misses, %d fragments kept", memo["hits"], memo["misses"], memo["size"])
+
+	if args.stats_json:
+		with open(args.stats_json, "w", encoding="utf-8") as stats_file:
+			if multiple:
+				json.dump(dict(stats.summary(), renderMemo=memo, modules=results), stats_file, indent=2)
+			else:
+				json.dump(dict(stats.summary(), renderMemo=memo, module=module, file=args.output), stats_file,
+						  indent=2)
+
+	if not args.useAsync:
+		vc.logout()
 
-	vc.logout()
+	if results and any("error" in result for result in results.values()):
+		sys.exit(1)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Shared security key (skey) provider for the ViUR client scripts.
+
+ViUR requires a fresh, single-use skey for every state-changing request. Fetching
+it right before each request doubles the number of round-trips, so the SkeyPool
+keeps a stock of skeys which is refilled by a background thread whenever it runs
+low.
+
+AsyncSkeyPool does the same for asyncio clients, refilling in a task of the
+running event loop instead of a thread.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# HTTP status ViUR answers with when a security key was rejected.
+SKEY_REJECTED_STATUS = 412
+
+
+class SkeyPool(object):
+	"""Thread-safe pool of prefetched skeys.
+
+	:param fetch: Callable returning one fresh skey from the server.
+	:param batchSize: Amount of skeys to keep in stock.
+	:param lowWater: Refill starts when the stock drops to this amount.
+	:param maxAge: Seconds after which a pooled skey is considered stale and discarded.
+	"""
+
+	def __init__(self, fetch: Callable[[], str], batchSize: int = 10,
+				 lowWater: Optional[int] = None, maxAge: float = 10 * 60):
+		assert batchSize > 0
+		self.fetch = fetch
+		self.batchSize = batchSize
+		self.lowWater = batchSize // 2 if lowWater is None else lowWater
+		self.maxAge = maxAge
+
+		self._skeys = deque()  # (timestamp, skey)
+		self._generation = 0
+		self._cond = threading.Condition()
+		self._closed = False
+		self._thread = None
+
+	def get(self) -> str:
+		"""Take a skey from the pool, fetching one synchronously if the pool ran dry."""
+		with self._cond:
+			self._discardStale()
+			skey = self._skeys.popleft()[1] if self._skeys else None
+			self._wakeRefill()
+
+		if skey is None:
+			skey = self.fetch()
+
+		return skey
+
+	def invalidate(self) -> None:
+		"""Drop all pooled skeys, e.g. after a login changed the session.
+
+		The pool is refilled by the next get(), so clients which never need a skey don't fetch any.
+		"""
+		with self._cond:
+			self._generation += 1
+			self._skeys.clear()
+
+	def close(self) -> None:
+		"""Stop the refill thread."""
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+
+	def retry(self, func: Callable[[str], "requests.Response"], attempts: int = 3) -> "requests.Response":
+		"""Call func with a pooled skey and retry with fresh ones if the server rejects it.
+
+		:param func: Callable which performs the request using the given skey and returns the response.
+		:param attempts: Maximum number of tries.
+		"""
+		for attempt in range(attempts):
+			response = func(self.get())
+
+			if response.status_code != SKEY_REJECTED_STATUS:
+				break
+
+			logger.debug("skey rejected (attempt %d/%d), invalidating pool", attempt + 1, attempts)
+			self.invalidate()
+
+		return response
+
+	def _discardStale(self) -> None:
+		limit = time.time() - self.maxAge
+		while self._skeys and self._skeys[0][0] < limit:
+			self._skeys.popleft()
+
+	def _wakeRefill(self) -> None:
+		if self._closed or len(self._skeys) > self.lowWater:
+			return
+
+		if self._thread is None or not self._thread.is_alive():
+			self._thread = threading.Thread(target=self._refill, name="SkeyPool", daemon=True)
+			self._thread.start()
+		else:
+			self._cond.notify_all()
+
+	def _refill(self) -> None:
+		while True:
+			with self._cond:
+				while not self._closed and len(self._skeys) >= self.batchSize:
+					self._cond.wait()
+
+				if self._closed:
+					return
+
+				generation = self._generation
+
+			try:
+				skey = self.fetch()
+			except Exception as e:
+				logger.warning("Unable to prefetch skey: %s", e)
+				return
+
+			with self._cond:
+				# Skeys fetched before an invalidation belong to the old session
+				if generation == self._generation:
+					self._skeys.append((time.time(), skey))
+
+
+class AsyncSkeyPool(object):
+	"""Asyncio counterpart of SkeyPool, to be used from within one event loop.
+
+	:param fetch: Coroutine function returning one fresh skey from the server.
+	:param batchSize: Amount of skeys to keep in stock.
+	:param lowWater: Refill starts when the stock drops to this amount.
+	:param maxAge: Seconds after which a pooled skey is considered stale and discarded.
+	"""
+
+	def __init__(self, fetch: Callable[[], Awaitable[str]], batchSize: int = 10,
+				 lowWater: Optional[int] = None, maxAge: float = 10 * 60):
+		assert batchSize > 0
+		self.fetch = fetch
+		self.batchSize = batchSize
+		self.lowWater = batchSize // 2 if lowWater is None else lowWater
+		self.maxAge = maxAge
+
+		self._skeys = deque()  # (timestamp, skey)
+		self._generation = 0
+		self._closed = False
+		self._task = None
+
+	async def get(self) -> str:
+		"""Take a skey from the pool, fetching one right away if the pool ran dry."""
+		self._discardStale()
+		skey = self._skeys.popleft()[1] if self._skeys else None
+		self._wakeRefill()
+
+		if skey is None:
+			skey = await self.fetch()
+
+		return skey
+
+	def invalidate(self) -> None:
+		"""Drop all pooled skeys, e.g. after a login changed the session.
+
+		The pool is refilled by the next get(), so clients which never need a skey don't fetch any.
+		"""
+		self._generation += 1
+		self._skeys.clear()
+
+	def close(self) -> None:
+		"""Stop refilling the pool."""
+		self._closed = True
+
+		if self._task is not None:
+			self._task.cancel()
+
+	async def retry(self, func: Callable[[str], Awaitable[Any]], attempts: int = 3) -> Any:
+		"""Await func with a pooled skey and retry with fresh ones if the server rejects it.
+
+		:param func: Coroutine function which performs the request using the given skey and returns the response.
+		:param attempts: Maximum number of tries.
+		"""
+		for attempt in range(attempts):
+			response = await func(await self.get())
+
+			if response.status_code != SKEY_REJECTED_STATUS:
+				break
+
+			logger.debug("skey rejected (attempt %d/%d), invalidating pool", attempt + 1, attempts)
+			self.invalidate()
+
+		return response
+
+	def _discardStale(self) -> None:
+		limit = time.time() - self.maxAge
+		while self._skeys and self._skeys[0][0] < limit:
+			self._skeys.popleft()
+
+	def _wakeRefill(self) -> None:
+		if self._closed or len(self._skeys) > self.lowWater:
+			return
+
+		if self._task is None or self._task.done():
+			self._task = asyncio.ensure_future(self._refill())
+
+	async def _refill(self) -> None:
+		while not self._closed and len(self._skeys) < self.batchSize:
+			generation = self._generation
+
+			try:
+				skeys = await asyncio.gather(*(self.fetch() for _ in range(self.batchSize - len(self._skeys))))
+			except Exception as e:
+				logger.warning("Unable to prefetch skeys: %s", e)
+				return
+
+			# Skeys fetched before an invalidation belong to the old session
+			if generation == self._generation:
+				now = time.time()
+				self._skeys.extend((now, skey) for skey in skeys)